@@ -8,6 +8,10 @@ from pathlib import Path
 import logging
 import sys
 
+# The tracking sheet loader is shared with the other showcase scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "umccr_pipeline"))
+from tracking_workbook import read_tracking_workbook  # noqa: E402
+
 """
 Objective:
 Create a set of directories for each sample pair in the run containing
@@ -317,58 +321,29 @@ def read_sample_sheet(fastq_csv_path):
 
 def read_tracking_sheet(tracking_sheet_path):
     """
-    Read the tracking sheet
+    Read the tracking sheet (only the metadata columns, from the copy read before if the sheet has not changed)
     Returns
     -------
         tracking_sheet_df: pd.DataFrame with the following columns
             Dataframe of samplesheet. Data columns are as follows:
             ==========                 ==============================================================
             LibraryID
-            SampleName
+            Sample_ID (SampleSheet)
             SampleID
-            ExternalSampleID
             SubjectID
-            ExternalSubjectID
             Phenotype
-            Quality
-            Source
-            ProjectName
-            ProjectOwner
-            ExperimentID
             Type
-            Assay
-            Coverage (X)
-            IDT Index , unless stated
-            Baymax run#
-            Comments
-            rRNA
-            qPCR ID
-            Sample_ID (SampleSheet)
             ==========                ==============================================================
     """
 
-    tracking_sheets = []
-
-    # Initialise in a excel file
-    logger.info("Loading excel file")
-    xl = pd.ExcelFile(tracking_sheet_path)
-
-    # Check sheet names - we just want from 2019 onwards
-    valid_sheet_names = [sheet_name
-                         for sheet_name in xl.sheet_names
-                         if sheet_name.isnumeric()
-                         and sheet_name not in OMITTED_YEAR_SHEETS]
-    if len(valid_sheet_names) == 0:
-        logger.error("Could not find any valid sheet names in {}".format(tracking_sheet_path))
+    # We just want the year sheets from 2019 onwards
+    try:
+        tracking_sheet_df = read_tracking_workbook(tracking_sheet_path, column_names=METADATA_COLUMNS,
+                                                   omitted_sheet_names=OMITTED_YEAR_SHEETS, logger=logger)
+    except ValueError as error:
+        logger.error(error)
         sys.exit(1)
 
-    # read tracking sheet
-    for sheet_name in valid_sheet_names:
-        logger.info("Reading sheet %s" % sheet_name)
-        tracking_sheets.append(xl.parse(header=0, sheet_name=sheet_name))
-
-    tracking_sheet_df = pd.concat(tracking_sheets)
-
     return tracking_sheet_df
 
 
@@ -14,7 +14,6 @@ If --v2 specified:
 """
 
 # Imports
-import re
 import os
 import pandas as pd
 import logging
@@ -23,11 +22,14 @@ from pathlib import Path
 import sys
 from copy import deepcopy
 
+# The samplesheet parser is shared with the pipeline scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "umccr_pipeline"))
+from samplesheet import read_samplesheet, SampleSheet, DataTable  # noqa: E402
+
 # Set logging level
 logging.basicConfig(level=logging.DEBUG)
 
 # Globals
-SAMPLESHEET_HEADER_REGEX = r"^\[(\S+)\](,+)?"  # https://regex101.com/r/5nbe9I/1
 V2_SAMPLESHEET_HEADER_VALUES = {"Data": "BCLConvert_Data",
                                 "Settings": "BCLConvert_Settings"}
 V2_FILE_FORMAT_VERSION = "2"
@@ -122,74 +124,30 @@ def set_args(args):
 
 def read_samplesheet_csv(samplesheet_csv_path):
     """
-    Read the samplesheet like a dodgy INI parser
+    Read the samplesheet with the samplesheet parser shared with the pipeline scripts
     :param samplesheet_csv_path:
-    :return:
+    :return: dict of sections (section name -> Section / list / DataTable)
     """
-    with open(samplesheet_csv_path, "r") as samplesheet_csv_h:
-        # Read samplesheet in
-        sample_sheet_sections = {}
-        current_section = None
-        current_section_item_list = []
-        header_match_regex = re.compile(SAMPLESHEET_HEADER_REGEX)
-
-        for line in samplesheet_csv_h.readlines():
-            # Check if blank line
-            if line.strip().rstrip(",") == "":
-                continue
-            # Check if the current line is a header
-            header_match_obj = header_match_regex.match(line.strip())
-            if header_match_obj is not None and current_section is None:
-                # First line, don't need to write out previous section to obj
-                # Set current section to first group
-                current_section = header_match_obj.group(1)
-                current_section_item_list = []
-            elif header_match_obj is not None and current_section is not None:
-                # A header further down, write out previous section and then reset sections
-                sample_sheet_sections[current_section] = current_section_item_list
-                # Now reset sections
-                current_section = header_match_obj.group(1)
-                current_section_item_list = []
-            # Make sure the first line is a section
-            elif current_section is None and header_match_obj is None:
-                logging.error("Top line of csv was not a section header. Exiting")
-                sys.exit(1)
-            else:  # We're in a section
-                if not current_section == "Data":
-                    # Strip trailing slashes from line
-                    current_section_item_list.append(line.strip().rstrip(","))
-                else:
-                    # Don't strip trailing slashes from line
-                    current_section_item_list.append(line.strip())
-
-        # Write out the last section
-        sample_sheet_sections[current_section] = current_section_item_list
-
-        return sample_sheet_sections
+    try:
+        return read_samplesheet(samplesheet_csv_path, validate=False).sections
+    except ValueError as error:
+        logging.error("Could not read samplesheet: {}. Exiting".format(error))
+        sys.exit(1)
 
 
 def configure_samplesheet_obj(sample_sheet_obj):
     """
-    Each section of the samplesheet obj is in a ',' delimiter ini format
+    Each section of the samplesheet obj is in a ',' delimiter ini format (a dict)
     Except for [Reads] which is just a list
-    And [Data] which is a dataframe
+    And [Data] which is converted from the columns of the parser to a dataframe
     :param sample_sheet_obj:
     :return:
     """
 
-    for section_name, section_str_list in sample_sheet_obj.items():
-        if section_name == "Data":
+    for section_name, section in sample_sheet_obj.items():
+        if isinstance(section, DataTable):
             # Convert to dataframe
-            sample_sheet_obj[section_name] = pd.DataFrame(columns=section_str_list[0].split(","),
-                                                          data=[row.split(",") for row in
-                                                                section_str_list[1:]])
-        elif section_name == "Reads":
-            # Keep as a list
-            continue
-        else:
-            # Convert to dict
-            sample_sheet_obj[section_name] = {line.split(",", 1)[0]: line.split(",", 1)[-1]
-                                              for line in section_str_list}
+            sample_sheet_obj[section_name] = pd.DataFrame(section.columns)
 
     return sample_sheet_obj
 
@@ -372,22 +330,12 @@ def write_samplesheet(samplesheet_obj, output_file, is_v2):
     if is_v2:
         samplesheet_obj = convert_samplesheet_to_v2(samplesheet_obj)
 
-    # Write the output file
-    with open(output_file, 'w') as samplesheet_h:
-        for section, section_values in samplesheet_obj.items():
-            # Write out the section header
-            samplesheet_h.write("[{}]\n".format(section))
-            # Write out values
-            if type(section_values) == list:  # [Reads] for v1 samplesheets
-                # Write out each item in a new line
-                samplesheet_h.write("\n".join(section_values))
-            elif type(section_values) == dict:
-                samplesheet_h.write("\n".join(map(str, ["{},{}".format(key, value)
-                                                        for key, value in section_values.items()])))
-            elif type(section_values) == pd.DataFrame:
-                section_values.to_csv(samplesheet_h, index=False, header=True, sep=",")
-            # Add new line before the next section
-            samplesheet_h.write("\n\n")
+    # Write the output file, dataframes are converted back to the columns of the parser
+    sections = {section: DataTable.from_columns(section_values.to_dict('list'))
+                if type(section_values) == pd.DataFrame else section_values
+                for section, section_values in samplesheet_obj.items()}
+    with open(output_file, 'w', newline='') as samplesheet_h:
+        SampleSheet(sections).write(samplesheet_h, padded=False, lineterminator="\n")
 
 
 def main():
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import os
+import io
 import pandas as pd
 import argparse
 import sys
@@ -7,9 +8,15 @@ from pathlib import Path
 import re
 import logging
 
+# The sample sheet parser and tracking sheet loader are shared with the pipeline and other showcase scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "umccr_pipeline"))
+from samplesheet import read_samplesheet, SampleSheet, DATA_SECTION_NAME  # noqa: E402
+from tracking_workbook import read_tracking_workbook  # noqa: E402
+
 # Globals
 HEADER_LINE_PRECURSOR = "[Data]"  # Used to separate metadata from samplesheet info
 OMITTED_YEAR_SHEETS = ["2018"]  # Has a different number of columns to following years
+TRACKING_SHEET_COLUMNS = ["Type", "Sample_ID (SampleSheet)"]  # The only columns used
 # Head rows that need to be changed for V2 sample sheets
 V2_METADATA_COLUMN_CHANGES = {"Adapter": "AdapterRead1"}
 # Column names that need to be changed for V2 sample sheets
@@ -146,26 +153,6 @@ def create_output_dir(output_dir):
     os.makedirs(output_dir, exist_ok=True)
 
 
-def get_start_row(sample_sheet):
-    """
-    Find on which line [Data] exists.
-    :param sample_sheet: path to the samplesheet
-    :return: An integer specifying which row the [Data] header is on.
-    """
-
-    # Iterate through lines - return line number that contains the header line
-    with open(sample_sheet, 'r') as samplesheet_fh:
-        for line_number, line in enumerate(samplesheet_fh.readlines()):
-            if line.strip().startswith(HEADER_LINE_PRECURSOR):
-                break
-        else:
-            logger.info("Could not find data line")
-            sys.exit(1)
-
-    # Return which line we found '[Data]' on
-    return line_number
-
-
 def read_sample_sheet(sample_sheet):
     """
     Read the samplesheet in two parts,
@@ -192,25 +179,30 @@ def read_sample_sheet(sample_sheet):
             index2_len          The length of the second index - using in groupings
             ==========  ==============================================================
     """
-    # Find the pivot (The row that contains [Data] that splits the samplesheet from the header
-    start_row = get_start_row(sample_sheet)
-
     logger.info("Reading in sample sheet")
 
-    # Initialise lines that comprise the header rows
-    sample_sheet_header_rows = []
+    # Read the sample sheet in a single pass with the parser shared with the pipeline scripts
+    try:
+        sample_sheet_obj = read_samplesheet(sample_sheet, validate=False)
+    except ValueError as error:
+        logger.error("Could not read sample sheet: {}".format(error))
+        sys.exit(1)
+    if DATA_SECTION_NAME not in sample_sheet_obj.sections:
+        logger.info("Could not find data line")
+        sys.exit(1)
 
-    # Read header rows
-    with open(sample_sheet, 'r') as sample_sheet_h:
-        for i, line in enumerate(sample_sheet_h.readlines()):
-            if i < start_row:
-                sample_sheet_header_rows.append(line.strip().rstrip(",") + "\n")
-                i += 1
-            else:
-                break
+    # The header rows are the (unpadded) rows of all sections before [Data], followed by an empty row
+    header_sections = {}
+    for section_name, section in sample_sheet_obj.sections.items():
+        if section_name == DATA_SECTION_NAME:
+            break
+        header_sections[section_name] = section
+    header_rows_h = io.StringIO()
+    SampleSheet(header_sections).write(header_rows_h, padded=False, lineterminator="\n")
+    sample_sheet_header_rows = header_rows_h.getvalue().splitlines(keepends=True) + ["\n"]
 
-    # Re-read the sample sheet
-    sample_sheet_df = pd.read_csv(sample_sheet, skiprows=start_row+1, header=0)
+    # The sample sheet data from the columns of the parser
+    sample_sheet_df = pd.DataFrame(sample_sheet_obj.data.columns)
 
     # Strip Ns at the end of indexes
     sample_sheet_df = sample_sheet_df.rename(columns={
@@ -331,57 +323,24 @@ def convert_sample_sheet_to_tso500(sample_sheet_df):
 
 def read_tracking_sheet(tracking_sheet):
     """
-    Read the tracking sheet
+    Read the tracking sheet (only the columns used, from the copy read before if the sheet has not changed)
     return:
         tracking_sheet_df: pd.DataFrame with the following columns
             Dataframe of samplesheet. Data columns are as follows:
             ==========                 ==============================================================
-            LibraryID
-            SampleName
-            SampleID
-            ExternalSampleID
-            SubjectID
-            ExternalSubjectID
-            Phenotype
-            Quality
-            Source
-            ProjectName
-            ProjectOwner
-            ExperimentID
             Type
-            Assay
-            Coverage (X)
-            IDT Index , unless stated
-            Baymax run#
-            Comments
-            rRNA
-            qPCR ID
             Sample_ID (SampleSheet)
             ==========                ==============================================================
     """
 
-    tracking_sheets = []
-
-    # Initialise in a excel file
-    logger.info("Loading excel file")
-    xl = pd.ExcelFile(tracking_sheet)
-
-    # Check sheet names - we just want from 2019 onwards
-    valid_sheet_names = [sheet_name
-                         for sheet_name in xl.sheet_names
-                         if sheet_name.isnumeric()
-                         and sheet_name not in OMITTED_YEAR_SHEETS]
-    if len(valid_sheet_names) == 0:
-        logger.error("Could not find any valid sheet names in {}".format(tracking_sheet))
+    # We just want the year sheets from 2019 onwards
+    try:
+        tracking_sheet_df = read_tracking_workbook(tracking_sheet, column_names=TRACKING_SHEET_COLUMNS,
+                                                   omitted_sheet_names=OMITTED_YEAR_SHEETS, logger=logger)
+    except ValueError as error:
+        logger.error(error)
         sys.exit(1)
 
-    # read tracking sheet
-    for sheet_name in valid_sheet_names:
-        logger.info("Reading sheet %s" % sheet_name)
-        tracking_sheets.append(xl.parse(header=0, sheet_name=sheet_name))
-
-    tracking_sheet_df = pd.concat(tracking_sheets)
-
     return tracking_sheet_df
 
 
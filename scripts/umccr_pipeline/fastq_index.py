@@ -0,0 +1,108 @@
+"""
+Index of the FASTQ files of a run's bcl2fastq output, built with a single walk of the output directory.
+
+bcl2fastq writes the FASTQs of a sample to <output>/<Sample_Project>/<Sample_ID>/, named after the
+library (Sample_Name), e.g. L2100001_S1_L001_R1_001.fastq.gz. Instead of listing a sample's directory
+for every lookup (slow on the shared network storage), the output is walked once with os.scandir and
+the FASTQs (with their sizes) are kept by (project, sample ID). The index can be saved as JSON next to
+the output, so later steps can use it instead of walking the output again.
+"""
+import os
+import re
+import json
+import collections
+from datetime import datetime
+
+FASTQ_SUFFIX = '.fastq.gz'
+# bcl2fastq only writes FASTQs to the output directory itself (Undetermined) and to <project>/<sample ID>/
+MAX_DEPTH = 2
+# the library of a FASTQ: the name up to the sample number, e.g. L2100001 of L2100001_S1_L001_R1_001.fastq.gz
+fastq_name_re = re.compile(r'(.+?)_S\d+(?:_L\d{3})?_[RI]\d_\d{3}\.fastq\.gz$')
+
+FastqFile = collections.namedtuple('FastqFile', ['name', 'size'])
+
+
+def get_library(fastq_name):
+    match = fastq_name_re.match(fastq_name)
+    return match.group(1) if match else fastq_name[:-len(FASTQ_SUFFIX)]
+
+
+class FastqIndex:
+
+    def __init__(self, base_dir, fastqs=None):
+        self.base_dir = base_dir
+        self.fastqs = fastqs if fastqs is not None else dict()  # (project, sample ID) -> list of FastqFile
+
+    @classmethod
+    def build(cls, base_dir):
+        """
+        Index the FASTQs in the given (bcl2fastq output) directory. A missing directory gives an empty index.
+        """
+        fastqs = collections.defaultdict(list)
+        directories = [(base_dir, ())]
+        while directories:
+            directory, key = directories.pop()
+            try:
+                entries = list(os.scandir(directory))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir() and len(key) < MAX_DEPTH:
+                    directories.append((entry.path, key + (entry.name,)))
+                elif entry.name.endswith(FASTQ_SUFFIX) and entry.is_file():
+                    fastqs[key].append(FastqFile(entry.name, entry.stat().st_size))
+        return cls(base_dir, {key: sorted(files) for key, files in fastqs.items()})
+
+    def get_fastqs(self, project, sample_id, library_id):
+        # the FASTQs of the library, as globbed with <project>/<sample ID>/<library ID>*.fastq.gz
+        return [fastq for fastq in self.fastqs.get((project, sample_id), [])
+                if fastq.name.startswith(library_id)]
+
+    def get_libraries(self):
+        # (project, sample ID, library) -> list of FastqFile
+        libraries = collections.defaultdict(list)
+        for key, files in self.fastqs.items():
+            for fastq in files:
+                libraries[(*key, get_library(fastq.name))].append(fastq)
+        return libraries
+
+    def to_dict(self):
+        libraries = list()
+        for key, files in sorted(self.get_libraries().items()):
+            # FASTQs outside of <project>/<sample ID>/ (e.g. Undetermined) have no project and sample ID
+            project, sample_id = key[:-1] if len(key) == 3 else (None, None)
+            libraries.append({
+                'directory': '/'.join(key[:-1]),
+                'project': project,
+                'sample_id': sample_id,
+                'library': key[-1],
+                'files': len(files),
+                'size': sum(fastq.size for fastq in files),
+                'fastqs': [fastq._asdict() for fastq in files]})
+        return {
+            'base_dir': self.base_dir,
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'libraries': libraries}
+
+    def write(self, path):
+        # write to a temporary file first, so readers never see a partial index
+        with open(path + '.tmp', 'w') as index_file:
+            json.dump(self.to_dict(), index_file, indent=1)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def read(cls, path):
+        with open(path) as index_file:
+            index = json.load(index_file)
+        fastqs = collections.defaultdict(list)
+        for library in index['libraries']:
+            key = tuple(library['directory'].split('/')) if library['directory'] else ()
+            fastqs[key].extend(FastqFile(fastq['name'], fastq['size']) for fastq in library['fastqs'])
+        return cls(index['base_dir'], {key: sorted(files) for key, files in fastqs.items()})
+
+
+def get_index_path(bcl2fastq_base_dir, runfolder):
+    # next to (not in) the run's bcl2fastq output, so it's not part of the output's checksums and sync
+    return os.path.join(bcl2fastq_base_dir, runfolder + '.fastq-index.json')
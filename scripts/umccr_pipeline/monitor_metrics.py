@@ -0,0 +1,78 @@
+"""
+Timings (and gauges) of the runfolder monitor, written as a Prometheus textfile, e.g. for the node_exporter
+textfile collector.
+
+Each timing is a summary: the total count and sum of all observations, and the 0.5 and 0.95 quantiles of the
+last SAMPLE_COUNT observations.
+"""
+import os
+import math
+import threading
+import collections
+
+SAMPLE_COUNT = 1000
+QUANTILES = (0.5, 0.95)
+PREFIX = 'runfolder_monitor_'
+
+
+def get_quantile(sorted_values, quantile):
+    # nearest-rank quantile of the (sorted, non-empty) values
+    return sorted_values[max(0, math.ceil(quantile * len(sorted_values)) - 1)]
+
+
+class MonitorMetrics:
+
+    def __init__(self, sample_count=SAMPLE_COUNT):
+        self.sample_count = sample_count
+        self.samples = {}  # name -> deque of the last observations
+        self.counts = collections.Counter()
+        self.sums = collections.Counter()
+        self.descriptions = {}
+        # observations come from the event loop and the workers
+        self.lock = threading.Lock()
+
+    def describe(self, name, description):
+        self.descriptions[name] = description
+
+    def observe(self, name, seconds):
+        with self.lock:
+            self.samples.setdefault(name, collections.deque(maxlen=self.sample_count)).append(seconds)
+            self.counts[name] += 1
+            self.sums[name] += seconds
+
+    def get_summaries(self):
+        # name -> count and quantiles (of the recent observations) of every timing observed so far
+        with self.lock:
+            samples = {name: sorted(values) for name, values in self.samples.items()}
+            counts, sums = dict(self.counts), dict(self.sums)
+        summaries = {}
+        for name, values in samples.items():
+            summaries[name] = {'count': counts[name], 'sum': sums[name]}
+            for quantile in QUANTILES:
+                summaries[name][f"p{quantile * 100:g}"] = get_quantile(values, quantile)
+        return summaries
+
+    def get_text(self, gauges):
+        # the summaries and gauges (name -> value) in the Prometheus text format
+        lines = []
+        for name, summary in sorted(self.get_summaries().items()):
+            if name in self.descriptions:
+                lines.append(f"# HELP {PREFIX}{name} {self.descriptions[name]}")
+            lines.append(f"# TYPE {PREFIX}{name} summary")
+            for quantile in QUANTILES:
+                lines.append(f'{PREFIX}{name}{{quantile="{quantile:g}"}} {summary[f"p{quantile * 100:g}"]:.6f}')
+            lines.append(f"{PREFIX}{name}_sum {summary['sum']:.6f}")
+            lines.append(f"{PREFIX}{name}_count {summary['count']}")
+        for name, value in sorted(gauges.items()):
+            if name in self.descriptions:
+                lines.append(f"# HELP {PREFIX}{name} {self.descriptions[name]}")
+            lines.append(f"# TYPE {PREFIX}{name} gauge")
+            lines.append(f"{PREFIX}{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path, gauges):
+        # written to a temporary file first, so the collector never reads a partial file
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as textfile:
+            textfile.write(self.get_text(gauges))
+        os.replace(tmp_path, path)
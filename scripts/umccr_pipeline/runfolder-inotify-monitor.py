@@ -1,13 +1,22 @@
 import os.path
-import sys
+import argparse
 import atexit
 import boto3
+import re
 import json
 import time
+import queue
 import logging
+import fnmatch
+import collections
+import threading
+from botocore.config import Config
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from logging.handlers import RotatingFileHandler
 from inotify_simple import INotify, flags
 from pathlib import Path
+from runfolder_state import RunfolderState, SEEN, STARTING, STARTED, PREEXISTING
+from monitor_metrics import MonitorMetrics
 
 DEPLOY_ENV = os.getenv('DEPLOY_ENV')
 SCRIPT = os.path.basename(__file__)
@@ -15,17 +24,75 @@ SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
 if DEPLOY_ENV == 'prod':
     LOG_FILE_NAME = os.path.join(SCRIPT_DIR, SCRIPT + ".log")
+    STATE_DB_NAME = os.path.join(SCRIPT_DIR, SCRIPT + ".state.db")
 else:
     LOG_FILE_NAME = os.path.join(SCRIPT_DIR, SCRIPT + ".dev.log")
+    STATE_DB_NAME = os.path.join(SCRIPT_DIR, SCRIPT + ".dev.state.db")
 
 
 WATCH_FLAGS = flags.CREATE | flags.MOVED_TO  # creattion (and possibly renaming) events
 SLACK_TOPIC = "UMCCR runfolder monitor"
 FLAG_FILE_NAME = "CopyComplete.txt"
-
-lambda_client = boto3.client('lambda')
-pipeline_client = client = boto3.client('stepfunctions')
+# arrival of samplesheets (with --samplesheets), notified like the former samplesheet-monitor.sh did
+SAMPLESHEET_FILE_NAME = "SampleSheet.csv"
+SAMPLESHEET_SLACK_TOPIC = "Incoming run monitor"
+SAMPLESHEET_SLACK_TITLE = "New runfolder detected"
+# besides runfolders, directories created in them (up to this depth below the monitored root) are watched
+SAMPLESHEET_WATCH_DEPTH = 2
+SAMPLESHEET_DEBOUNCE = 60  # seconds, repeated events for the same samplesheet within are not notified
+# Polling (--watch-mode poll, for shared storage written from other hosts, which inotify doesn't see): the
+# runfolders are scanned every POLL_MIN_INTERVAL seconds while runs are copied, the interval doubles with every scan
+# without changes while idle (up to POLL_MAX_INTERVAL). A runfolder without flag counts as being copied for
+# ACTIVE_PERIOD seconds after its last modification.
+POLL_MIN_INTERVAL = 15
+POLL_MAX_INTERVAL = 300
+ACTIVE_PERIOD = 3 * 24 * 3600
+MTIME_RESOLUTION = 2  # seconds, runfolders modified this close to a scan are scanned again
+# runfolders in these states are done with (their pipeline was started), their watches are removed
+HANDLED_STATES = (STARTING, STARTED, PREEXISTING)
+# seconds between the checks for handled runfolders watched longer than the retention (with --watch-retention)
+RETENTION_CHECK_INTERVAL = 3600
+# pipeline starts requested (but not confirmed, e.g. failed) at least this many seconds ago are requested again
+START_RETRY_INTERVAL = 600
+# Slack notifications and pipeline starts are handled by worker threads, so slow AWS calls don't hold up the
+# reading of (and bookkeeping for) inotify events
+WORKER_COUNT = 4
+SHUTDOWN_TIMEOUT = 60  # seconds to wait for queued work on shutdown
+# timings (with --metrics-file), written every METRICS_INTERVAL seconds, from the flag file's modification (by the
+# sequencer) to its detection, to the confirmed pipeline start
+METRICS_INTERVAL = 15
+FLAG_DETECTION = 'flag_detection_seconds'
+FLAG_TO_START = 'flag_to_start_seconds'
+QUEUE_WAIT = 'queue_wait_seconds'
+SLACK_INVOKE = 'slack_invoke_seconds'
+START_EXECUTION = 'start_execution_seconds'
+# failed (throttled, timed out, ...) AWS calls are retried with backoff by botocore
+aws_config = Config(retries={'max_attempts': 5, 'mode': 'standard'})
+
+lambda_client = boto3.client('lambda', config=aws_config)
+pipeline_client = client = boto3.client('stepfunctions', config=aws_config)
 inotify_service = INotify()
+work_queue = queue.Queue()  # (function, keyword arguments) to call by the workers, None to stop a worker
+workers = []
+runfolder_state = None  # RunfolderState, opened on start
+samplesheet_notify_times = {}  # samplesheet path -> time of the last notification
+watched_runfolders = set()  # names of the runfolders currently watched (or polled) for their flag
+metrics = MonitorMetrics()
+metrics.describe(FLAG_DETECTION, 'Time from the flag file modification to its detection.')
+metrics.describe(FLAG_TO_START, 'Time from the flag file modification to the confirmed pipeline start.')
+metrics.describe(QUEUE_WAIT, 'Time notifications and pipeline starts waited for a worker.')
+metrics.describe(SLACK_INVOKE, 'Duration of the Slack Lambda invocations.')
+metrics.describe(START_EXECUTION, 'Duration of the Step Functions start_execution calls.')
+metrics.describe('queue_depth', 'Notifications and pipeline starts waiting for a worker.')
+metrics.describe('watched_runfolders', 'Runfolders watched for their flag file.')
+# runfolders not monitored: names matching any of the patterns, and (existing) ones not modified for max_age days
+exclude_patterns = []
+max_age = None
+# days after their pipeline start that the watches of handled runfolders are kept (None: as long as keep_watches)
+watch_retention = None
+
+# the state of a runfolder at its last scan (polling), the times in seconds
+PolledRunfolder = collections.namedtuple('PolledRunfolder', ['mtime', 'scan_time', 'ready', 'samplesheet'])
 
 
 # shutdown hook
@@ -33,6 +100,9 @@ inotify_service = INotify()
 def cleanup():
     logger.warn("Shutting down...")
     inotify_service.close()
+    stop_workers()
+    if runfolder_state:
+        runfolder_state.close()
     logger.warn("Shutdown complete.")
 
 
@@ -54,6 +124,45 @@ def getLogger():
     return new_logger
 
 
+def run_worker():
+    while True:
+        work = work_queue.get()
+        try:
+            if work is None:
+                return
+            function, kwargs, submit_time = work
+            metrics.observe(QUEUE_WAIT, time.monotonic() - submit_time)
+            function(**kwargs)
+        except Exception:
+            logger.exception(f"Failed to {work[0].__name__} with {work[1]}")
+        finally:
+            work_queue.task_done()
+
+
+def start_workers(count=WORKER_COUNT):
+    for _ in range(count):
+        worker = threading.Thread(target=run_worker, daemon=True)
+        worker.start()
+        workers.append(worker)
+
+
+def stop_workers(timeout=SHUTDOWN_TIMEOUT):
+    # let the workers finish the queued work first
+    for _ in workers:
+        work_queue.put(None)
+    deadline = time.monotonic() + timeout
+    for worker in workers:
+        worker.join(max(0, deadline - time.monotonic()))
+    if any(worker.is_alive() for worker in workers):
+        logger.warn(f"Shutting down with about {work_queue.qsize()} unfinished work items")
+    workers.clear()
+
+
+def submit(function, **kwargs):
+    # queue the call for the workers (returns immediately)
+    work_queue.put((function, kwargs, time.monotonic()))
+
+
 def notify_slack(topic, title, message, lambda_name):
     logger.debug(f"Sending slack message: {message} with title: {title}")
     payload = {
@@ -62,108 +171,539 @@ def notify_slack(topic, title, message, lambda_name):
         "message": message
     }
 
+    # asynchronous invocation: returns as soon as the event is queued by Lambda
+    start = time.perf_counter()
     response = lambda_client.invoke(
         FunctionName=lambda_name,
-        InvocationType='RequestResponse',
+        InvocationType='Event',
         Payload=json.dumps(payload)
     )
+    metrics.observe(SLACK_INVOKE, time.perf_counter() - start)
 
     return response
 
 
-def start_pipeline(state_machine_arn, runfolder):
+def get_execution_name(runfolder):
+    # The name has to be unique for at least 90 days. It's the same for every start request of a runfolder, so that
+    # repeated requests (e.g. after a restart) can't start a second pipeline for the run.
+    return re.sub(r'[^A-Za-z0-9_-]', '_', f"{runfolder}_execution")[:80]
+
+
+def start_pipeline(state_machine_arn, runfolder, monitored_path, slack_lambda_name):
     logger.info(f"Starting pipeline for {runfolder}")
     payload = {
         "runfolder": runfolder
     }
 
-    # the name has to be unique for at least 90 days
-    execution_name = f"{runfolder}_execution_{round(time.time())}"
-
-    response = client.start_execution(
-        stateMachineArn=state_machine_arn,
-        name=execution_name,
-        input=json.dumps(payload)
-    )
+    execution_name = get_execution_name(runfolder)
+    start = time.perf_counter()
+    try:
+        response = client.start_execution(
+            stateMachineArn=state_machine_arn,
+            name=execution_name,
+            input=json.dumps(payload)
+        )
+        execution_arn = response['executionArn']
+    except client.exceptions.ExecutionAlreadyExists:
+        logger.warn(f"Pipeline for {runfolder} was started before ({execution_name})")
+        response = None
+        execution_arn = state_machine_arn.replace(':stateMachine:', ':execution:') + ':' + execution_name
+    except Exception:
+        # failed even after botocore's retries, the start is requested again later (see retry_unconfirmed_starts)
+        notify_slack(topic=SLACK_TOPIC,
+                     title=runfolder,
+                     message="ERROR starting pipeline! The start will be retried.",
+                     lambda_name=slack_lambda_name)
+        raise
+    metrics.observe(START_EXECUTION, time.perf_counter() - start)
+    runfolder_state.set_started(monitored_path, runfolder, execution_arn)
+    if response:
+        record_flag_latency(monitored_path, runfolder)
 
     return response
 
 
-def run_monitor(monitored_path, slack_lambda_name, state_machine_arn):
+def record_flag_latency(monitored_path, runfolder):
+    # the time from the flag file modification to its detection (recorded in the state store) and to now
+    try:
+        flag_mtime = os.stat(os.path.join(monitored_path, runfolder, FLAG_FILE_NAME)).st_mtime
+    except OSError:
+        return
+    detection_time = runfolder_state.get_runfolder(monitored_path, runfolder)['flag_time']
+    # the flag is written by the sequencer (or file server) clock, which may be a bit ahead of ours
+    flag_to_start = max(0, time.time() - flag_mtime)
+    metrics.observe(FLAG_TO_START, flag_to_start)
+    if detection_time:
+        flag_detection = max(0, detection_time - flag_mtime)
+        metrics.observe(FLAG_DETECTION, flag_detection)
+        logger.info(f"Pipeline for {runfolder} started {flag_to_start:.1f}s after its flag file was written "
+                    f"(detected after {flag_detection:.1f}s)")
+
+
+def trigger_pipeline(monitored_path, runfolder, slack_lambda_name, state_machine_arn):
+    submit(notify_slack, topic=SLACK_TOPIC,
+                         title=runfolder,
+                         message="Runfolder ready flag detected.",
+                         lambda_name=slack_lambda_name)
+    submit(start_pipeline, state_machine_arn=state_machine_arn,
+                           runfolder=runfolder,
+                           monitored_path=monitored_path,
+                           slack_lambda_name=slack_lambda_name)
+
+
+def handle_flag(monitored_path, runfolder, slack_lambda_name, state_machine_arn):
+    runfolder_state.set_ready(monitored_path, runfolder)
+    if runfolder_state.claim_start(monitored_path, runfolder):
+        trigger_pipeline(monitored_path, runfolder, slack_lambda_name, state_machine_arn)
+    else:
+        logger.info(f"Pipeline for {runfolder} was requested before, ignoring flag file")
+
+
+def is_excluded(runfolder_path, check_age=True):
+    if any(fnmatch.fnmatch(runfolder_path.name, pattern) for pattern in exclude_patterns):
+        return True
+    try:
+        return check_age and max_age is not None and time.time() - runfolder_path.stat().st_mtime > max_age * 86400
+    except OSError:
+        return True  # removed since listed (or unreadable)
+
+
+def get_runfolder_paths(monitored_path):
+    runfolder_paths = []
+    for child_path in Path(monitored_path).iterdir():
+        if child_path.is_dir():
+            if is_excluded(child_path):
+                logger.debug(f"Ignoring path: {child_path}")
+            else:
+                runfolder_paths.append(child_path)
+    return runfolder_paths
+
+
+def catch_up(monitored_path, runfolder_paths, slack_lambda_name, state_machine_arn, retry_unconfirmed=True):
+    # Start the pipelines of runfolders that became ready while the monitor wasn't running (or events were lost),
+    # and those whose start was requested but not confirmed (the execution names make it safe to request them
+    # again). On the first start with the state store, the runfolders that are ready already are taken as handled.
+    if not runfolder_state.has_runfolders(monitored_path):
+        logger.info(f"Recording the state of {len(runfolder_paths)} existing runfolders")
+        for runfolder_path in runfolder_paths:
+            is_ready = (runfolder_path / FLAG_FILE_NAME).exists()
+            runfolder_state.add_runfolder(monitored_path, runfolder_path.name, PREEXISTING if is_ready else SEEN)
+        return
+
+    for runfolder_path in runfolder_paths:
+        runfolder = runfolder_path.name
+        if runfolder_state.add_runfolder(monitored_path, runfolder):
+            logger.info(f"New runfolder found on catch-up: {runfolder_path}")
+            submit(notify_slack, topic=SLACK_TOPIC,
+                                 title=runfolder,
+                                 message="New runfolder detected.",
+                                 lambda_name=slack_lambda_name)
+        if (runfolder_path / FLAG_FILE_NAME).exists() and runfolder_state.set_ready(monitored_path, runfolder):
+            logger.info(f"Missed flag file found on catch-up: {runfolder_path / FLAG_FILE_NAME}")
+            if runfolder_state.claim_start(monitored_path, runfolder):
+                trigger_pipeline(monitored_path, runfolder, slack_lambda_name, state_machine_arn)
+    if retry_unconfirmed:
+        retry_unconfirmed_starts(monitored_path, slack_lambda_name, state_machine_arn, min_age=0)
+
+
+def retry_unconfirmed_starts(monitored_path, slack_lambda_name, state_machine_arn, min_age=START_RETRY_INTERVAL):
+    # Request the pipeline starts requested at least min_age seconds ago, but not confirmed (failed, or interrupted
+    # by a restart), again. Starts still queued are left alone, though requesting them twice would do no harm.
+    retry_start = time.time() - min_age
+    for row in runfolder_state.get_runfolders(monitored_path, states=[STARTING]):
+        if row['start_time'] is None or row['start_time'] <= retry_start:
+            logger.info(f"Requesting unconfirmed pipeline start for {row['name']} again")
+            submit(start_pipeline, state_machine_arn=state_machine_arn,
+                                   runfolder=row['name'],
+                                   monitored_path=monitored_path,
+                                   slack_lambda_name=slack_lambda_name)
+
+
+def get_retired_runfolders(monitored_path, keep_watches):
+    # The handled runfolders not to watch (or look at) any more: all of them, or, if their watches are kept, those
+    # started more than the retention ago (runfolders handled before the monitor ran count from when first seen).
+    handled = runfolder_state.get_runfolders(monitored_path, states=HANDLED_STATES)
+    if not keep_watches:
+        return {row['name'] for row in handled}
+    if watch_retention is None:
+        return set()
+    retention_start = time.time() - watch_retention * 86400
+    return {row['name'] for row in handled if (row['start_time'] or row['seen_time']) < retention_start}
+
+
+def notify_samplesheet(samplesheet_path, slack_lambda_name):
+    # notify the arrival of a samplesheet, unless it was notified within the debounce period (e.g. rewritten)
+    now = time.monotonic()
+    for path, notify_time in list(samplesheet_notify_times.items()):
+        if now - notify_time > SAMPLESHEET_DEBOUNCE:
+            del samplesheet_notify_times[path]
+    if samplesheet_path in samplesheet_notify_times:
+        logger.debug(f"Ignored repeated event for samplesheet {samplesheet_path}")
+        return
+    samplesheet_notify_times[samplesheet_path] = now
+    logger.info(f"New samplesheet detected: {samplesheet_path}")
+    submit(notify_slack, topic=SAMPLESHEET_SLACK_TOPIC,
+                         title=SAMPLESHEET_SLACK_TITLE,
+                         message=os.path.dirname(samplesheet_path) + '/',
+                         lambda_name=slack_lambda_name)
+
+
+def run_monitor(monitored_path, slack_lambda_name, state_machine_arn, watch_samplesheets=False, keep_watches=False):
+    # samplesheets may still be added after the flag (e.g. a corrected one), so their runfolders stay watched
+    keep_watches = keep_watches or watch_samplesheets
     wd_dir_map = {}
+    wd_depth_map = {}  # watch descriptor -> depth of the watched folder below the root (runfolders: 1)
 
     # Add root folder as watched folder
     root_wd = inotify_service.add_watch(monitored_path, WATCH_FLAGS)
     wd_dir_map[root_wd] = monitored_path
-
-    # Add all existing runfolders to the ones being watched
+    wd_depth_map[root_wd] = 0
+
+    def add_watch(folder_path, depth):
+        wd = inotify_service.add_watch(folder_path, WATCH_FLAGS)
+        wd_dir_map[wd] = folder_path
+        wd_depth_map[wd] = depth
+        if depth == 1:
+            watched_runfolders.add(os.path.basename(folder_path))
+
+    def watch_samplesheet_folder(folder_path, depth):
+        # Watch a folder created in a runfolder for samplesheets. Its sub-directories (up to the watch depth) and
+        # samplesheets may have been created before the watch was added, so they are looked for as well.
+        logger.debug(f"Adding path to monitor for samplesheets: {folder_path}")
+        try:
+            add_watch(folder_path, depth)
+        except OSError as err:
+            logger.warn(f"Could not add watch for {folder_path}: {err}")
+            return
+        find_samplesheets(folder_path, depth)
+
+    def find_samplesheets(folder_path, depth):
+        # the instrument creates (and removes) short-lived folders, which may be gone (or unreadable) by now
+        try:
+            with os.scandir(folder_path) as entries:
+                for entry in entries:
+                    if entry.name == SAMPLESHEET_FILE_NAME:
+                        notify_samplesheet(entry.path, slack_lambda_name)
+                    elif depth < SAMPLESHEET_WATCH_DEPTH and entry.is_dir():
+                        watch_samplesheet_folder(entry.path, depth + 1)
+        except OSError as err:
+            logger.warn(f"Could not look for samplesheets in {folder_path}: {err}")
+
+    def get_watched_runfolders():
+        return {wd_dir_map[wd] for wd, depth in wd_depth_map.items() if depth == 1}
+
+    def unwatch_runfolder(runfolder_path):
+        # Remove the watches of the runfolder (and the folders in it). Their map entries are removed with the IGNORED
+        # event confirming the removal, as events of the watches may still be queued.
+        for wd, folder_path in list(wd_dir_map.items()):
+            if wd != root_wd and (folder_path == runfolder_path or folder_path.startswith(runfolder_path + os.sep)):
+                try:
+                    inotify_service.rm_watch(wd)
+                except OSError:
+                    pass  # removed already (e.g. the folder was deleted)
+
+    def unwatch_handled_runfolders():
+        # stop watching the runfolders whose pipelines have been started (or, if kept, past the retention)
+        retired = get_retired_runfolders(monitored_path, keep_watches)
+        for runfolder_path in get_watched_runfolders():
+            if os.path.basename(runfolder_path) in retired:
+                logger.debug(f"Removing watch of handled runfolder {runfolder_path}")
+                unwatch_runfolder(runfolder_path)
+
+    def rescan():
+        # after lost events (queue overflow): watch new runfolders and look for the flags (and samplesheets) of the
+        # runfolders not handled yet, handled runfolders are not looked at (unless their watches are kept)
+        retired = get_retired_runfolders(monitored_path, keep_watches)
+        watched = get_watched_runfolders()
+        runfolder_paths = [path for path in get_runfolder_paths(monitored_path) if path.name not in retired]
+        for runfolder_path in runfolder_paths:
+            if str(runfolder_path) not in watched:
+                logger.info(f"Adding path to monitor: {runfolder_path}")
+                try:
+                    add_watch(str(runfolder_path), 1)
+                except OSError as err:
+                    logger.warn(f"Could not add watch for {runfolder_path}: {err}")
+                    continue
+            if watch_samplesheets:
+                find_samplesheets(str(runfolder_path), 1)
+        catch_up(monitored_path, runfolder_paths, slack_lambda_name, state_machine_arn, retry_unconfirmed=False)
+        unwatch_handled_runfolders()
+
+    # Add all existing runfolders (not handled yet) to the ones being watched
     logger.info("Adding child folders of monitored root path...")
-    root_path = Path(monitored_path)
-    for child_path in root_path.iterdir():
-        if child_path.is_dir():
-            # Add a hack to exclude certain folders from being monitored
-            # TODO: find better way to do this
-            if '200401_A00130_0135_AH2JJCDSXY' in child_path.name:
-                logger.info(f"Ignoring path: {child_path}")
-            else:
-                logger.info(f"Adding path to monitor: {child_path}")
-                ch_wd = inotify_service.add_watch(child_path, WATCH_FLAGS)
-                wd_dir_map[ch_wd] = child_path
+    runfolder_paths = get_runfolder_paths(monitored_path)
+    retired = get_retired_runfolders(monitored_path, keep_watches)
+    for child_path in runfolder_paths:
+        if child_path.name not in retired:
+            logger.info(f"Adding path to monitor: {child_path}")
+            try:
+                add_watch(str(child_path), 1)
+            except OSError as err:
+                logger.warn(f"Could not add watch for {child_path}: {err}")
+
+    # after adding the watches, so that no flag can be missed in between (detecting it twice does no harm)
+    catch_up(monitored_path, runfolder_paths, slack_lambda_name, state_machine_arn)
+    unwatch_handled_runfolders()
+    next_retention_check = time.monotonic() + RETENTION_CHECK_INTERVAL
+    next_start_retry = time.monotonic() + START_RETRY_INTERVAL
 
     while 1:
-        # TODO: monitor for folder deletion events, to remove watches for removed runfolder?
-        for event in inotify_service.read(read_delay=500):
+        # the watches kept for handled runfolders are dropped after the retention, also while no events arrive
+        if keep_watches and watch_retention is not None and time.monotonic() >= next_retention_check:
+            unwatch_handled_runfolders()
+            next_retention_check = time.monotonic() + RETENTION_CHECK_INTERVAL
+        if time.monotonic() >= next_start_retry:
+            retry_unconfirmed_starts(monitored_path, slack_lambda_name, state_machine_arn)
+            next_start_retry = time.monotonic() + START_RETRY_INTERVAL
+        for event in inotify_service.read(timeout=min(RETENTION_CHECK_INTERVAL, START_RETRY_INTERVAL) * 1000,
+                                          read_delay=500):
             reported_flags = flags.from_mask(event.mask)
 
+            if flags.Q_OVERFLOW in reported_flags:
+                logger.warn("Inotify event queue overflow, events have been lost. Rescanning...")
+                rescan()
+            elif flags.IGNORED in reported_flags:
+                # the watch was removed (by unwatch_runfolder or because the folder was deleted)
+                logger.debug(f"Watch removed for {wd_dir_map.get(event.wd)}")
+                if wd_depth_map.pop(event.wd, None) == 1:
+                    watched_runfolders.discard(os.path.basename(wd_dir_map[event.wd]))
+                wd_dir_map.pop(event.wd, None)
+            elif event.wd not in wd_dir_map:
+                logger.debug(f"Ignored event for removed watch: {event.name}")
             # we're only interested in creation events
-            if flags.CREATE in reported_flags or flags.MOVED_TO in reported_flags:
+            elif flags.CREATE in reported_flags or flags.MOVED_TO in reported_flags:
                 parent_path = wd_dir_map[event.wd]  # map the current watch descriptor to the watched folder
                 current_path = os.path.join(parent_path, event.name)  # the full path of the event
                 # and only directory creations in the root folder (direct sub-directories)
-                if flags.ISDIR in reported_flags and event.wd is root_wd:
+                if flags.ISDIR in reported_flags and event.wd == root_wd:
+                    if is_excluded(Path(current_path), check_age=False):
+                        logger.info(f"Ignoring new runfolder: {current_path}")
+                        continue
                     logger.info(f"New runfolder detected: {current_path}")
+                    runfolder_state.add_runfolder(monitored_path, event.name)
                     try:
                         # try add a watch for the newly created directory (runfolder)
                         # these watches are automatically removed when the directory is deleted
-                        wd = inotify_service.add_watch(current_path, WATCH_FLAGS)
-                        wd_dir_map[wd] = current_path
+                        add_watch(current_path, 1)
+                        if watch_samplesheets:
+                            find_samplesheets(current_path, 1)
                     except OSError as err:
-                        notify_slack(topic=SLACK_TOPIC,
-                                     title=event.name,
-                                     message="ERROR creating watch for new runfolder!",
-                                     lambda_name=slack_lambda_name)
-                    notify_slack(topic=SLACK_TOPIC,
-                                 title=event.name,
-                                 message="New runfolder detected.",
-                                 lambda_name=slack_lambda_name)
-                # or the creation of the ready flag file
-                elif event.name == FLAG_FILE_NAME:
+                        submit(notify_slack, topic=SLACK_TOPIC,
+                                             title=event.name,
+                                             message="ERROR creating watch for new runfolder!",
+                                             lambda_name=slack_lambda_name)
+                    submit(notify_slack, topic=SLACK_TOPIC,
+                                         title=event.name,
+                                         message="New runfolder detected.",
+                                         lambda_name=slack_lambda_name)
+                # or, for samplesheets, directories created in runfolders (watched lazily instead of the whole tree)
+                elif flags.ISDIR in reported_flags and watch_samplesheets and \
+                        wd_depth_map[event.wd] < SAMPLESHEET_WATCH_DEPTH:
+                    watch_samplesheet_folder(current_path, wd_depth_map[event.wd] + 1)
+                # or the creation of a samplesheet
+                elif event.name == SAMPLESHEET_FILE_NAME and watch_samplesheets:
+                    notify_samplesheet(current_path, slack_lambda_name)
+                # or the creation of the ready flag file (in a runfolder)
+                elif event.name == FLAG_FILE_NAME and wd_depth_map[event.wd] == 1:
                     logger.info(f"New flag file detected: {current_path}")
                     # found a flag file, so the directory linked to the watch descriptor is the runfolder
                     runfolder = os.path.basename(parent_path)
-                    notify_slack(topic=SLACK_TOPIC,
-                                 title=runfolder,
-                                 message="Runfolder ready flag detected.",
-                                 lambda_name=slack_lambda_name)
-                    start_pipeline(state_machine_arn=state_machine_arn,
-                                   runfolder=runfolder)
-                    # Could remove watch for this run, instead of watching it until the directory is removed
+                    handle_flag(monitored_path, runfolder, slack_lambda_name, state_machine_arn)
+                    # the runfolder doesn't need to be watched any more
+                    if not keep_watches:
+                        unwatch_runfolder(parent_path)
                 else:  # Ignore other events
                     logger.debug(f"Ignored CREATE/MOVE_TO event for {event.name}")
             else:  # Ignore event types we haven't signed up for (e.g. DELETE_SELF)
                 logger.debug(f"Ignored event with flags {reported_flags} for {event.name}")
 
 
-if __name__ == "__main__":
-    logger = getLogger()
+def scan_runfolder(runfolder_path):
+    # the modification time of the runfolder and whether it has a flag file and samplesheet (one stat and readdir)
+    mtime = runfolder_path.stat().st_mtime
+    with os.scandir(runfolder_path) as entries:
+        names = {entry.name for entry in entries}
+    return PolledRunfolder(mtime, time.time(), FLAG_FILE_NAME in names, SAMPLESHEET_FILE_NAME in names)
+
+
+def poll_runfolders(monitored_path, polled_runfolders, slack_lambda_name, state_machine_arn, watch_samplesheets):
+    # One scan of the monitored root: new runfolders are read, runfolders without flag are read again if they
+    # have been modified since their last scan, runfolders with flag are not looked at any more. With samplesheets,
+    # runfolders with flag (but no samplesheet, within the watch retention) are read again if modified as well, as
+    # a samplesheet may still be added. That doesn't count as a change, so it doesn't shorten the scan interval.
+    # Returns whether anything changed and whether any run is (probably) still being copied.
+    changed = copying = False
+    runfolders = set()
+    retired = get_retired_runfolders(monitored_path, keep_watches=True) if watch_samplesheets else set()
+    for runfolder_path in get_runfolder_paths(monitored_path):
+        runfolder = runfolder_path.name
+        runfolders.add(runfolder)
+        last_scan = polled_runfolders.get(runfolder)
+        was_ready = bool(last_scan and last_scan.ready)
+        if was_ready and (not watch_samplesheets or last_scan.samplesheet or runfolder in retired):
+            continue
+        try:
+            if last_scan:
+                mtime = runfolder_path.stat().st_mtime
+                copying = copying or (not was_ready and time.time() - mtime < ACTIVE_PERIOD)
+                if mtime == last_scan.mtime and mtime < last_scan.scan_time - MTIME_RESOLUTION:
+                    continue
+            scan = scan_runfolder(runfolder_path)
+        except OSError as err:
+            logger.warn(f"Could not scan {runfolder_path}: {err}")  # e.g. removed since listed
+            continue
+        changed = changed or not was_ready
+        polled_runfolders[runfolder] = scan
+
+        if last_scan is None:
+            logger.info(f"New runfolder detected: {runfolder_path}")
+            runfolder_state.add_runfolder(monitored_path, runfolder)
+            submit(notify_slack, topic=SLACK_TOPIC,
+                                 title=runfolder,
+                                 message="New runfolder detected.",
+                                 lambda_name=slack_lambda_name)
+        if watch_samplesheets and scan.samplesheet and not (last_scan and last_scan.samplesheet):
+            notify_samplesheet(str(runfolder_path / SAMPLESHEET_FILE_NAME), slack_lambda_name)
+        if scan.ready and not was_ready:
+            logger.info(f"New flag file detected: {runfolder_path / FLAG_FILE_NAME}")
+            handle_flag(monitored_path, runfolder, slack_lambda_name, state_machine_arn)
+
+    for runfolder in set(polled_runfolders) - runfolders:
+        logger.info(f"Runfolder removed: {runfolder}")
+        del polled_runfolders[runfolder]
+    return changed, copying
+
+
+def run_poller(monitored_path, slack_lambda_name, state_machine_arn, watch_samplesheets=False):
+    # the alternative to run_monitor for storage inotify doesn't work for
+    logger.info("Scanning child folders of monitored root path...")
+    polled_runfolders = {}  # runfolder name -> PolledRunfolder
+    runfolder_paths = get_runfolder_paths(monitored_path)
+    for runfolder_path in runfolder_paths:
+        try:
+            polled_runfolders[runfolder_path.name] = scan_runfolder(runfolder_path)
+        except OSError as err:
+            logger.warn(f"Could not scan {runfolder_path}: {err}")
+    watched_runfolders.update(runfolder for runfolder, scan in polled_runfolders.items() if not scan.ready)
+    catch_up(monitored_path, runfolder_paths, slack_lambda_name, state_machine_arn)
+
+    interval = POLL_MIN_INTERVAL
+    next_start_retry = time.monotonic() + START_RETRY_INTERVAL
+    while 1:
+        time.sleep(interval)
+        if time.monotonic() >= next_start_retry:
+            retry_unconfirmed_starts(monitored_path, slack_lambda_name, state_machine_arn)
+            next_start_retry = time.monotonic() + START_RETRY_INTERVAL
+        changed, copying = poll_runfolders(monitored_path, polled_runfolders, slack_lambda_name, state_machine_arn,
+                                           watch_samplesheets)
+        watched_runfolders.clear()
+        watched_runfolders.update(runfolder for runfolder, scan in polled_runfolders.items() if not scan.ready)
+        interval = POLL_MIN_INTERVAL if changed or copying else min(POLL_MAX_INTERVAL, interval * 2)
+        logger.debug(f"Next scan in {interval}s")
+
+
+def get_gauges():
+    return {'queue_depth': work_queue.qsize(), 'watched_runfolders': len(watched_runfolders)}
+
+
+def run_metrics_writer(metrics_file):
+    while True:
+        try:
+            metrics.write_textfile(metrics_file, get_gauges())
+        except OSError as err:
+            logger.warn(f"Could not write metrics to {metrics_file}: {err}")
+        time.sleep(METRICS_INTERVAL)
+
+
+def get_status(monitored_path):
+    # the watched runfolders with their state, the number of runfolders per state, and the metrics
+    runfolders = runfolder_state.get_runfolders(monitored_path)
+    state_counts = collections.Counter(row['state'] for row in runfolders)
+    return {
+        'path': monitored_path,
+        'runfolders': {row['name']: dict(row) for row in runfolders if row['name'] in watched_runfolders},
+        'states': dict(state_counts),
+        'gauges': get_gauges(),
+        'timings': metrics.get_summaries()
+    }
 
-    # TODO: validate input
-    path_to_monitor = sys.argv[1]
-    slack_lambda_name = sys.argv[2]
-    state_machine_arn = sys.argv[3]
 
-    logger.warn(f"Starting runfolder monitor on path: {path_to_monitor}")
+def start_status_server(port, monitored_path):
+    # local HTTP endpoint: the status as JSON (/) and the metrics in the Prometheus format (/metrics)
+    class StatusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, content_type = metrics.get_text(get_gauges()), 'text/plain; version=0.0.4'
+            elif self.path in ('/', '/status'):
+                body, content_type = json.dumps(get_status(monitored_path), indent=2), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.end_headers()
+            self.wfile.write(body.encode())
+
+        def log_message(self, format, *args):
+            logger.debug(f"Status request: {format % args}")
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), StatusHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Serving the monitor status on http://127.0.0.1:{port}/")
+    return server
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Monitor runfolders and start the pipeline for the ready ones.')
+    parser.add_argument('path_to_monitor', help='Folder the runfolders are written to.')
+    parser.add_argument('slack_lambda_name', help='Lambda sending the Slack notifications.')
+    parser.add_argument('state_machine_arn', help='Step Functions state machine of the pipeline.')
+    parser.add_argument('--samplesheets', action='store_true',
+                        help='Also notify the arrival of samplesheets (SampleSheet.csv) in the runfolders.')
+    parser.add_argument('--watch-mode', choices=['inotify', 'poll'], default='inotify',
+                        help='How to watch the path: inotify events (default) or polling, for shared storage ' +
+                             'written to from other hosts.')
+    parser.add_argument('--exclude', action='append', default=[], metavar='PATTERN',
+                        help='Do not monitor runfolders with names matching the (glob) pattern (can be repeated).')
+    parser.add_argument('--max-age', type=float, metavar='DAYS',
+                        help='Do not monitor existing runfolders not modified for more than the given days.')
+    parser.add_argument('--keep-watches', action='store_true',
+                        help='Keep watching runfolders after their pipeline was started (inotify, implied by ' +
+                             '--samplesheets, as samplesheets may be added later).')
+    parser.add_argument('--watch-retention', type=float, metavar='DAYS',
+                        help='Stop watching runfolders the given days after their pipeline was started (with ' +
+                             '--keep-watches or --samplesheets, default: keep watching them).')
+    parser.add_argument('--metrics-file', metavar='PATH',
+                        help='Write the timings and queue depth to the Prometheus textfile (e.g. for node_exporter).')
+    parser.add_argument('--status-port', type=int, metavar='PORT',
+                        help='Serve the status of the watched runfolders (and the metrics) on localhost.')
+    return parser.parse_args()
+
 
-    run_monitor(monitored_path=path_to_monitor, 
-                slack_lambda_name=slack_lambda_name, 
-                state_machine_arn=state_machine_arn)
+if __name__ == "__main__":
+    logger = getLogger()
+    args = parse_args()
+
+    logger.warn(f"Starting runfolder monitor on path: {args.path_to_monitor}")
+    runfolder_state = RunfolderState(STATE_DB_NAME)
+    exclude_patterns = args.exclude
+    max_age = args.max_age
+    watch_retention = args.watch_retention
+    start_workers()
+    if args.metrics_file:
+        threading.Thread(target=run_metrics_writer, args=(args.metrics_file,), daemon=True).start()
+    if args.status_port:
+        start_status_server(args.status_port, args.path_to_monitor)
+
+    if args.watch_mode == 'poll':
+        run_poller(monitored_path=args.path_to_monitor,
+                   slack_lambda_name=args.slack_lambda_name,
+                   state_machine_arn=args.state_machine_arn,
+                   watch_samplesheets=args.samplesheets)
+    else:
+        run_monitor(monitored_path=args.path_to_monitor,
+                    slack_lambda_name=args.slack_lambda_name,
+                    state_machine_arn=args.state_machine_arn,
+                    watch_samplesheets=args.samplesheets,
+                    keep_watches=args.keep_watches)
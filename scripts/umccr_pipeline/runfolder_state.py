@@ -0,0 +1,93 @@
+"""
+Persistent (SQLite) state of the runfolders seen by the runfolder monitor, so that a restarted monitor can tell
+which runfolders became ready (and which pipelines were started) while it was down.
+
+A runfolder goes through the states
+  seen        the runfolder exists
+  ready       the ready flag (CopyComplete.txt) was detected
+  starting    the pipeline start was requested
+  started     the pipeline was started (the execution ARN is recorded)
+  preexisting the runfolder existed when the monitor was first started with the store (never started)
+Moving to 'starting' is a single conditional update, so a pipeline start is only ever requested once, even if the
+flag is detected several times (or by more than one process sharing the store).
+"""
+import time
+import sqlite3
+import threading
+
+SEEN = 'seen'
+READY = 'ready'
+STARTING = 'starting'
+STARTED = 'started'
+PREEXISTING = 'preexisting'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runfolders (
+    root TEXT NOT NULL,
+    name TEXT NOT NULL,
+    state TEXT NOT NULL,
+    seen_time REAL NOT NULL,
+    flag_time REAL,
+    start_time REAL,
+    execution_arn TEXT,
+    PRIMARY KEY (root, name)
+)
+"""
+
+
+class RunfolderState:
+
+    def __init__(self, path):
+        self.path = path
+        # one connection shared by the monitor's threads, writes are serialised (and committed) under the lock
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def execute(self, sql, parameters=()):
+        with self.lock, self.connection:
+            return self.connection.execute(sql, parameters).rowcount
+
+    def query(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def has_runfolders(self, root):
+        return bool(self.query("SELECT 1 FROM runfolders WHERE root = ? LIMIT 1", (root,)))
+
+    def get_runfolder(self, root, name):
+        # the runfolder's row (None if it was never seen)
+        rows = self.query("SELECT * FROM runfolders WHERE root = ? AND name = ?", (root, name))
+        return rows[0] if rows else None
+
+    def get_runfolders(self, root, states=None):
+        if states is None:
+            return self.query("SELECT * FROM runfolders WHERE root = ? ORDER BY name", (root,))
+        return self.query(f"SELECT * FROM runfolders WHERE root = ? AND state IN ({','.join('?' * len(states))}) "
+                          "ORDER BY name", (root, *states))
+
+    def add_runfolder(self, root, name, state=SEEN):
+        # record a runfolder, returns whether it is new
+        return self.execute("INSERT OR IGNORE INTO runfolders (root, name, state, seen_time) VALUES (?, ?, ?, ?)",
+                            (root, name, state, time.time())) == 1
+
+    def set_ready(self, root, name):
+        # record the detection of the ready flag, returns whether it is the first detection
+        self.add_runfolder(root, name)
+        return self.execute("UPDATE runfolders SET state = ?, flag_time = ? WHERE root = ? AND name = ? AND state = ?",
+                            (READY, time.time(), root, name, SEEN)) == 1
+
+    def claim_start(self, root, name):
+        # move a ready runfolder to 'starting', returns False if its start was requested before
+        return self.execute("UPDATE runfolders SET state = ?, start_time = ? WHERE root = ? AND name = ? AND state = ?",
+                            (STARTING, time.time(), root, name, READY)) == 1
+
+    def set_started(self, root, name, execution_arn):
+        self.execute("UPDATE runfolders SET state = ?, execution_arn = ? WHERE root = ? AND name = ?",
+                     (STARTED, execution_arn, root, name))
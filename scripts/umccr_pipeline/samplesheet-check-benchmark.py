@@ -0,0 +1,137 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+from datetime import datetime
+from samplesheet import read_samplesheet
+from synthetic_samplesheets import generate_samples, write_samplesheet, get_tracking_sheets, FixtureTrackingSheets
+
+################################################################################
+# Benchmark of the validation and split steps of samplesheet-check.py on synthetic SampleSheets,
+# run offline against a matching synthetic tracking sheet. The best time of each step is recorded
+# as JSON and can be compared to the results of a previous run to catch regressions:
+#   python samplesheet-check-benchmark.py [--samples 96 384 1536] [--output results.json]
+#                                         [--baseline previous-results.json]
+
+os.environ.setdefault('DEPLOY_ENV', 'dev')  # the check logs to its dev log file
+samplesheet_check = __import__('samplesheet-check')
+
+# keep the console readable, the check still logs everything to its log file
+samplesheet_check.console_handler.setLevel(logging.CRITICAL)
+
+
+def time_step(function, repeat, setup):
+    # best time of the function over the repetitions, called with fresh arguments from setup (not timed)
+    times = list()
+    for _ in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run_benchmark(sample_count, repeat, work_dir, seed):
+    samplesheet_path = os.path.join(work_dir, f"SampleSheet.{sample_count}.csv")
+    samples = generate_samples(sample_count, seed=seed)
+    write_samplesheet(samplesheet_path, samples)
+
+    # load the tracking data as the check does, from the synthetic tabs
+    samplesheet_check.tracking_sheet_cache = FixtureTrackingSheets(get_tracking_sheets(samples, seed=seed))
+    samplesheet_check.library_tracking_spreadsheet.clear()
+    samplesheet = read_samplesheet(samplesheet_path)
+    for year in samplesheet_check.get_years_from_samplesheet(samplesheet):
+        samplesheet_check.library_tracking_spreadsheet[year] = samplesheet_check.get_library_index(year)
+    samplesheet_check.import_library_sheet_validation_from_google()
+
+    def get_samplesheet():
+        return read_samplesheet(samplesheet_path),
+
+    def get_sorted_samples():
+        samplesheet = read_samplesheet(samplesheet_path)
+        return samplesheet_check.getSortedSamples(samplesheet), samplesheet_path, samplesheet
+
+    timings = {
+        'checkSampleSheetForIndexClashes':
+            time_step(samplesheet_check.checkSampleSheetForIndexClashes, repeat, get_samplesheet),
+        'checkMetadataCorrespondence':
+            time_step(samplesheet_check.checkMetadataCorrespondence, repeat, get_samplesheet),
+        'getSortedSamples': time_step(samplesheet_check.getSortedSamples, repeat, get_samplesheet),
+        'writeSammpleSheets': time_step(samplesheet_check.writeSammpleSheets, repeat, get_sorted_samples)}
+    return {
+        'samples': sample_count,
+        'rows': len(samplesheet),
+        'index_clashes': len(samplesheet_check.checkSampleSheetForIndexClashes(samplesheet)),
+        'has_metadata_error': samplesheet_check.checkMetadataCorrespondence(samplesheet),
+        'timings': timings}
+
+
+def get_regressions(results, baseline, tolerance, min_difference):
+    # steps that took more than (1 + tolerance) times their baseline time (and at least min_difference seconds longer)
+    baseline_timings = {result['samples']: result['timings'] for result in baseline['results']}
+    regressions = list()
+    for result in results['results']:
+        for step, seconds in result['timings'].items():
+            baseline_seconds = baseline_timings.get(result['samples'], {}).get(step)
+            if baseline_seconds is None:
+                continue
+            if seconds > baseline_seconds * (1 + tolerance) and seconds - baseline_seconds > min_difference:
+                regressions.append((result['samples'], step, baseline_seconds, seconds))
+    return regressions
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser(description='Benchmark the steps of the samplesheet check on synthetic sheets.')
+    parser.add_argument('--samples', type=int, nargs='+', default=[96, 384, 1536],
+                        help="The numbers of samples of the synthetic SampleSheets.")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="The number of repetitions of each step (the best time is recorded).")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="The seed for generating the synthetic sheets.")
+    parser.add_argument('--output',
+                        help="Where to write the JSON results to (default: print them).")
+    parser.add_argument('--baseline',
+                        help="JSON results of a previous run to compare to. Exits with 1 on regressions.")
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help="Allowed slowdown relative to the baseline (default: 0.5, i.e. 50%%).")
+    parser.add_argument('--min-difference', type=float, default=0.01,
+                        help="Ignore slowdowns of less than this many seconds (default: 0.01).")
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_arg_parser().parse_args()
+
+    results = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'repeat': args.repeat,
+        'seed': args.seed,
+        'results': list()}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for sample_count in args.samples:
+            result = run_benchmark(sample_count, args.repeat, work_dir, args.seed)
+            results['results'].append(result)
+            print(f"{sample_count} samples ({result['rows']} rows): " +
+                  ', '.join(f"{step} {seconds * 1000:.1f}ms" for step, seconds in result['timings'].items()),
+                  file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = get_regressions(results, json.load(baseline_file), args.tolerance, args.min_difference)
+        for sample_count, step, baseline_seconds, seconds in regressions:
+            print(f"Regression: {step} with {sample_count} samples took {seconds * 1000:.1f}ms " +
+                  f"(baseline {baseline_seconds * 1000:.1f}ms)", file=sys.stderr)
+        if regressions:
+            exit(1)
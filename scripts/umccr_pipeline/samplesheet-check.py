@@ -2,11 +2,16 @@ import sys
 import os
 import re
 import argparse
+import queue
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 import collections
-from sample_sheet import SampleSheet  # https://github.com/clintval/sample-sheet
-from gspread_pandas import Spread
+import pandas
+from samplesheet import read_samplesheet
+from tracking_sheet import TrackingSheetCache, LibraryIndex
+from sheets_client import log_call_stats
+from validation_report import ValidationReport
 
 
 import warnings
@@ -38,6 +43,12 @@ metadata_column_names = (
     phenotype_column_name,
     source_column_name,
     quality_column_name)
+# Low cardinality columns of the tracking sheet, loaded as categoricals
+categorical_column_names = (
+    type_column_name,
+    phenotype_column_name,
+    source_column_name,
+    quality_column_name)
 val_phenotype_column_name = "PhenotypeValues"
 val_quality_column_name = "QualityValues"
 val_source_column_name = "SourceValues"
@@ -52,6 +63,15 @@ metadata_validation_column_names = (
     val_type_column_name,
     val_project_name_column_name,
     val_project_owner_column_name)
+# Log records let through per category (e.g. a check rule) and interval (seconds), all findings go to the report
+# (and findings failing the check are always logged)
+LOG_RECORDS_PER_CATEGORY = 20
+LOG_RATE_INTERVAL = 60
+CONSOLE_LOG_LEVEL = logging.WARNING  # what is logged to the console (and returned by the validation service)
+# the report is written next to the samplesheet (e.g. SampleSheet.validation.json), unless a path is given
+REPORT_SUFFIX = '.validation.json'
+# Columns of the metadata findings table
+findings_column_names = ['Sample_ID', 'Sample_Name', 'Level', 'Rule', 'Message', 'FailsCheck']
 
 # Regex pattern for Sample ID/Name
 topup_exp = '(?:_topup\d?)'
@@ -78,6 +98,37 @@ else:
     lab_spreadsheet_id = '1pZRph8a6-795odibsvhxCqfC6l0hHZzKbGYpesgNXOA'  # Lab metadata tracking sheet (prod)
 
 
+class LogRateLimitFilter(logging.Filter):
+    # Lets at most max_records records per category through per interval and counts the suppressed ones.
+    # The category of a record is given with extra={'category': ...}, otherwise it's the logging call.
+    # Records given with extra={'fails_check': True} are always let through.
+    def __init__(self, max_records, interval):
+        super().__init__()
+        self.max_records = max_records
+        self.interval = interval
+        self.windows = dict()  # category -> (start of the current interval, records let through)
+        self.suppressed = collections.Counter()  # category -> suppressed records
+
+    def filter(self, record):
+        if getattr(record, 'fails_check', False):
+            return True
+        category = getattr(record, 'category', None) or f"{record.funcName}:{record.lineno}"
+        start, count = self.windows.get(category, (record.created, 0))
+        if record.created - start >= self.interval:
+            start, count = record.created, 0
+        if count >= self.max_records:
+            self.suppressed[category] += 1
+            return False
+        self.windows[category] = (start, count + 1)
+        return True
+
+    def pop_suppressed(self):
+        suppressed = self.suppressed
+        self.windows = dict()
+        self.suppressed = collections.Counter()
+        return suppressed
+
+
 def getLogger():
     new_logger = logging.getLogger(__name__)
     new_logger.setLevel(logging.DEBUG)
@@ -92,24 +143,30 @@ def getLogger():
 
     # create a console handler
     console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.WARNING)
+    console_handler.setLevel(CONSOLE_LOG_LEVEL)
     console_handler.setFormatter(formatter)
 
-    # add the handlers to the logger
-    new_logger.addHandler(file_handler)
-    new_logger.addHandler(console_handler)
+    # the handlers write in a background thread (flushed at exit), so the checks don't wait for log I/O
+    log_queue = queue.Queue()
+    listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    new_logger.addHandler(QueueHandler(log_queue))
+    new_logger.addFilter(log_rate_limit_filter)
 
-    return new_logger
+    # the console handler is returned as well, as it isn't among the handlers of the logger
+    return new_logger, console_handler
 
 
-# method to count the differences between two strings
-# NOTE: strings have to be of equal length
-def str_compare(a, b):
-    cnt = 0
-    for i, j in zip(a, b):
-        if i != j:
-            cnt += 1
-    return cnt
+def log_suppressed_records():
+    for category, count in log_rate_limit_filter.pop_suppressed().items():
+        logger.warning(f"Suppressed {count} further log records of {category}")
+
+
+def report_finding(check, level, rule, message, sample_id='', sample_name='', fails_check=True):
+    # every finding goes to the validation report, the log (rate limited per rule) is for humans
+    validation_report.add_finding(check, level, rule, message, sample_id, sample_name, fails_check)
+    logger.log(logging.getLevelName(level), message, extra={'category': rule, 'fails_check': fails_check})
 
 
 def get_year_from_lib_id(library_id):
@@ -129,28 +186,30 @@ def get_years_from_samplesheet(samplesheet):
 
 def get_library_sheet_from_google(year):
     logger.info(f"Loading tracking data for year {year}")
-    spread = Spread(lab_spreadsheet_id)
-    library_tracking_spreadsheet_df = spread.sheet_to_df(sheet=year, index=0, header_rows=1, start_row=1)
-    hit = library_tracking_spreadsheet_df.iloc[0]
-    logger.debug(f"First record: {hit}")
+    library_tracking_spreadsheet_df = tracking_sheet_cache.get_sheet(year, column_names=metadata_column_names,
+                                                                     categorical_column_names=categorical_column_names)
+    logger.debug(f"Columns: {list(library_tracking_spreadsheet_df.columns)}")
     for column_name in metadata_column_names:
-        logger.debug(f"Checking for column name {column_name}...")
-        if column_name not in hit:
+        if column_name not in library_tracking_spreadsheet_df.columns:
             logger.error(f"Could not find column {column_name}. The file is not structured as expected! Aborting.")
             exit(-1)
     logger.info(f"Loaded {len(library_tracking_spreadsheet_df.index)} records from library tracking sheet.")
     return library_tracking_spreadsheet_df
 
 
+def get_library_index(year):
+    library_index = LibraryIndex(get_library_sheet_from_google(year), library_id_column_name)
+    if library_index.duplicates:
+        logger.warning(f"Library IDs with multiple entries for year {year}: {sorted(library_index.duplicates)}")
+    return library_index
+
+
 def import_library_sheet_validation_from_google():
     global validation_df
-    spread = Spread(lab_spreadsheet_id)
-    validation_df = spread.sheet_to_df(sheet='Validation', index=0, header_rows=1, start_row=1)
-    hit = validation_df.iloc[0]
-    logger.debug(f"First record of validation data: {hit}")
+    validation_df = tracking_sheet_cache.get_sheet('Validation', column_names=metadata_validation_column_names)
+    logger.debug(f"Columns of validation data: {list(validation_df.columns)}")
     for column_name in metadata_validation_column_names:
-        logger.debug(f"Checking for column name {column_name}...")
-        if column_name not in hit:
+        if column_name not in validation_df.columns:
             logger.error(f"Could not find column {column_name}. The file is not structured as expected! Aborting.")
             exit(-1)
     logger.info(f"Loaded library tracking sheet validation data.")
@@ -158,11 +217,12 @@ def import_library_sheet_validation_from_google():
 
 def get_meta_data_by_library_id(library_id):
     year = get_year_from_lib_id(library_id)
-    library_tracking_spreadsheet_df = library_tracking_spreadsheet.get(year)
-    try:
-        hit = library_tracking_spreadsheet_df[library_tracking_spreadsheet_df[library_id_column_name] == library_id]
-    except (KeyError, NameError, TypeError, Exception) as er:
-        logger.error(f"Error trying to find library ID {library_id}! Error: {er}")
+    library_index = library_tracking_spreadsheet.get(year)
+    if library_index is None:
+        logger.error(f"No tracking data loaded for year {year}, can't look up library ID {library_id}!")
+        hit = list()
+    else:
+        hit = library_index.get_rows(library_id)
 
     # We expect exactly one matching record, not more, not less!
     if len(hit) == 1:
@@ -179,10 +239,10 @@ def checkSampleSheetMetadata(samplesheet):
     has_error = False
     if not samplesheet.Header.Assay:
         has_error = True
-        logger.error("Assay not defined in Header!")
+        report_finding('header', 'ERROR', 'assay_missing', "Assay not defined in Header!")
     if not samplesheet.Header.get('Experiment Name'):
         has_error = True
-        logger.error("Experiment Name not defined in Header!")
+        report_finding('header', 'ERROR', 'experiment_name_missing', "Experiment Name not defined in Header!")
 
     return has_error
 
@@ -196,164 +256,260 @@ def checkSampleAndLibraryIdFormat(samplesheet):
         # Checkt that the IDs are not the same
         if sample.Sample_ID == sample.Sample_Name:
             has_error = True
-            logger.error(f"Sample_ID '{sample.Sample_ID}' cannot be the same as the Sample_Name!")
+            report_finding('id_format', 'ERROR', 'sample_id_is_sample_name',
+                           f"Sample_ID '{sample.Sample_ID}' cannot be the same as the Sample_Name!",
+                           sample.Sample_ID, sample.Sample_Name)
         # check Sample ID against expected format
         if not (regex_sample_id.fullmatch(sample.Sample_ID) or regex_sample_id_ctl.fullmatch(sample.Sample_ID)):
             has_error = True
-            logger.error(f"Sample_ID '{sample.Sample_ID}' did not match the expected pattern!")
+            report_finding('id_format', 'ERROR', 'sample_id_format',
+                           f"Sample_ID '{sample.Sample_ID}' did not match the expected pattern!",
+                           sample.Sample_ID, sample.Sample_Name)
         # check Sample Name against expected format
         if not regex_sample_name.fullmatch(sample.Sample_Name):
             has_error = True
-            logger.error(f"Sample_Name '{sample.Sample_Name}' did not match the expected pattern!")
+            report_finding('id_format', 'ERROR', 'sample_name_format',
+                           f"Sample_Name '{sample.Sample_Name}' did not match the expected pattern!",
+                           sample.Sample_ID, sample.Sample_Name)
 
     return has_error
 
 
-def checkMetadataCorrespondence(samplesheet):
-    logger.info("Checking SampleSheet data against metadata")
-    has_error = False
-    global validation_df
+def get_tracking_records():
+    # The loaded tracking sheet records of all years in one table, one record per year and library ID.
+    # 'Records' holds the number of records found for the library ID in its year.
+    year_dfs = list()
+    for year, library_index in library_tracking_spreadsheet.items():
+        # categorical columns as plain values, so they can be concatenated across years and filled
+        year_df = library_index.sheet_df[list(metadata_column_names)].astype(object)
+        year_df['Year'] = year
+        year_dfs.append(year_df)
+    tracking_df = pandas.concat(year_dfs, ignore_index=True)
+    tracking_df['Records'] = tracking_df.groupby(['Year', library_id_column_name])[library_id_column_name] \
+        .transform('size')
+    return tracking_df.drop_duplicates(subset=['Year', library_id_column_name])
+
+
+def validateMetadataCorrespondence(samplesheet):
+    # Validate the samples of the samplesheet against the tracking sheet and the allowed values.
+    # The samplesheet [Data] rows are joined against the tracking records once and each rule is evaluated as a
+    # mask over all samples. Returns a findings table with one row per sample and failed rule (in samplesheet order).
+    samples_df = pandas.DataFrame([(sample.Sample_ID, sample.Sample_Name) for sample in samplesheet],
+                                  columns=['Sample_ID', 'Sample_Name'])
+    if samples_df.empty:
+        return pandas.DataFrame(columns=findings_column_names)
+    samples_df['Year'] = samples_df['Sample_Name'].map(get_year_from_lib_id)
+
+    tracking_df = get_tracking_records()
+    samples_df = samples_df.merge(tracking_df, how='left',
+                                  left_on=['Year', 'Sample_Name'], right_on=['Year', library_id_column_name])
+    samples_df['Records'] = samples_df['Records'].fillna(0)
+    samples_df[list(metadata_column_names)] = samples_df[list(metadata_column_names)].fillna('')
+
+    # only samples with exactly one tracking record are validated any further
+    found = samples_df['Records'] == 1
+    metadata_sample_ids = samples_df[sample_id_column_name] + '_' + samples_df[library_id_column_name]
+    checked = found & (samples_df[type_column_name] != '10X')  # 10X samples usually don't comply
+
+    owner_counts = validation_df[val_project_owner_column_name].value_counts()
+    name_counts = validation_df[val_project_name_column_name].value_counts()
+    project_owner_unknown = samples_df[project_owner_column_name].map(owner_counts).fillna(0) != 1
+    project_name_unknown = samples_df[project_name_column_name].map(name_counts).fillna(0) != 1
+
+    # the primary library of a topup has to exist (exactly once)
+    is_topup = samples_df['Sample_Name'].str.contains(topup_exp)
+    primary_library_ids = samples_df['Sample_Name'].str.replace(topup_exp, '', regex=True)
+    record_counts = tracking_df.set_index(['Year', library_id_column_name])['Records']
+    primary_keys = pandas.MultiIndex.from_arrays([primary_library_ids.map(get_year_from_lib_id), primary_library_ids])
+    primary_missing = record_counts.reindex(primary_keys).fillna(0).values != 1
+
+    # (rule, mask, level, fails the check, message)
+    rules = [
+        ('library_missing', samples_df['Records'] == 0, 'ERROR', False,
+         lambda s: f"No entry for library ID {s.Sample_Name}"),
+        ('library_multiple', samples_df['Records'] > 1, 'ERROR', False,
+         lambda s: f"Multiple entries for library ID {s.Sample_Name}!"),
+        ('sample_id_mismatch', found & (metadata_sample_ids != samples_df['Sample_ID']), 'ERROR', True,
+         lambda s: f"Sample_ID of SampleSheet ({s.Sample_ID}) does not match " +
+                   f"SampleID/LibraryID of metadata ({s.SampleID}_{s.LibraryID})"),
+        ('subject_id_missing', checked & (samples_df[subject_id_column_name] == ''), 'WARNING', False,
+         lambda s: f"No subject ID for {s.Sample_ID}"),
+        ('type_unsupported', checked & ~samples_df[type_column_name].isin(validation_df[val_type_column_name].values),
+         'WARNING', False, lambda s: f"Unsupported Type '{s.Type}' for {s.Sample_ID}"),
+        ('phenotype_unsupported',
+         checked & ~samples_df[phenotype_column_name].isin(validation_df[val_phenotype_column_name].values),
+         'WARNING', False, lambda s: f"Unsupproted Phenotype '{s.Phenotype}' for {s.Sample_ID}"),
+        ('quality_unsupported',
+         checked & ~samples_df[quality_column_name].isin(validation_df[val_quality_column_name].values),
+         'WARNING', False, lambda s: f"Unsupproted Quality '{s.Quality}' for {s.Sample_ID}"),
+        ('source_unsupported',
+         checked & ~samples_df[source_column_name].isin(validation_df[val_source_column_name].values),
+         'WARNING', False, lambda s: f"Unsupproted Source '{s.Source}' for {s.Sample_ID}"),
+        ('project_owner_missing', checked & (samples_df[project_owner_column_name] == ''), 'ERROR', True,
+         lambda s: f"No project owner found for sample {s.Sample_ID}"),
+        ('project_owner_unknown', checked & project_owner_unknown, 'ERROR', True,
+         lambda s: f"Project owner {s.ProjectOwner} not found in allowed values!"),
+        ('project_name_missing', checked & (samples_df[project_name_column_name] == ''), 'ERROR', True,
+         lambda s: f"No project name found for sample {s.Sample_ID}"),
+        ('project_name_unknown', checked & project_name_unknown, 'ERROR', True,
+         lambda s: f"Project name {s.ProjectName} not found in allowed values!"),
+        ('topup_primary_missing', found & is_topup & primary_missing, 'ERROR', True,
+         lambda s: f"Couldn't find library {s.PrimaryLibraryID} for topup {s.Sample_Name}"),
+    ]
+
+    samples_df['PrimaryLibraryID'] = primary_library_ids
+    findings = list()
+    for rule_order, (rule, mask, level, fails_check, message) in enumerate(rules):
+        for sample in samples_df[mask].itertuples():
+            findings.append((sample.Index, rule_order, sample.Sample_ID, sample.Sample_Name, level, rule,
+                             message(sample), fails_check))
+    findings.sort(key=lambda finding: finding[:2])
+    return pandas.DataFrame([finding[2:] for finding in findings], columns=findings_column_names)
 
-    for sample in samplesheet:
-        ss_sample_name = sample.Sample_Name  # SampleSheet Sample_Name == LIMS LibraryID
-        ss_sample_id = sample.Sample_ID  # SampleSheet Sample_ID == LIMS SampleID_LibraryID
-        logger.debug(f"Checking Sammple_ID/Sample_Name: {ss_sample_id}/{ss_sample_name}")
-
-        # Make sure the ID exists and is unique
-        column_values = get_meta_data_by_library_id(ss_sample_name)
-        if len(column_values) != 1:
-            has_error = False
-            continue
-        logger.debug(f"Retrieved values: {column_values} for sample {ss_sample_name}.")
-
-        # check sample ID/Name match
-        ss_sn = column_values[sample_id_column_name].item() + '_' + column_values[library_id_column_name].item()
-        if ss_sn != ss_sample_id:
-            has_error = True
-            logger.error(f"Sample_ID of SampleSheet ({ss_sample_id}) does not match " +
-                         f"SampleID/LibraryID of metadata ({ss_sn})")
-
-        # exclude 10X samples for now, as they usually don't comply
-        if column_values[type_column_name].item() != '10X':
-            # check presence of subject ID
-            if column_values[subject_id_column_name].item() == '':
-                logger.warn(f"No subject ID for {ss_sample_id}")
-
-            # check controlled vocab: phenotype, type, source, quality: WARN if not present
-            if column_values[type_column_name].item() not in validation_df[val_type_column_name].values:
-                logger.warn(f"Unsupported Type '{column_values[type_column_name].item()}' for {ss_sample_id}")
-            if column_values[phenotype_column_name].item() not in validation_df[val_phenotype_column_name].values:
-                logger.warn(f"Unsupproted Phenotype '{column_values[phenotype_column_name].item()}' for {ss_sample_id}")
-            if column_values[quality_column_name].item() not in validation_df[val_quality_column_name].values:
-                logger.warn(f"Unsupproted Quality '{column_values[quality_column_name].item()}' for {ss_sample_id}")
-            if column_values[source_column_name].item() not in validation_df[val_source_column_name].values:
-                logger.warn(f"Unsupproted Source '{column_values[source_column_name].item()}' for {ss_sample_id}")
-
-            # check project name: WARN if not consistent
-            p_name = column_values[project_name_column_name].item()
-            p_owner = column_values[project_owner_column_name].item()
-            if p_owner == '':
-                has_error = True
-                logger.error(f"No project owner found for sample {sample.Sample_ID}")
-            if len(validation_df[validation_df[val_project_owner_column_name] == p_owner]) != 1:
-                has_error = True
-                logger.error(f"Project owner {p_owner} not found in allowed values!")
-            if p_name == '':
-                has_error = True
-                logger.error(f"No project name found for sample {sample.Sample_ID}")
-            if len(validation_df[validation_df[val_project_name_column_name] == p_name]) != 1:
-                has_error = True
-                logger.error(f"Project name {p_name} not found in allowed values!")
-
-        # check that the primary library for the topup exists
-        if regex_topup.search(sample.Sample_Name):
-            orig_library_id = regex_topup.sub('', sample.Sample_Name)
-            if len(get_meta_data_by_library_id(orig_library_id)) != 1:
-                logger.error(f"Couldn't find library {orig_library_id} for topup {sample.Sample_Name}")
-                has_error = True
 
-    return has_error
-
-
-def checkSampleSheetForIndexClashes(samplesheet):
+def checkMetadataCorrespondence(samplesheet):
+    logger.info("Checking SampleSheet data against metadata")
+    findings_df = validateMetadataCorrespondence(samplesheet)
+    for finding in findings_df.itertuples():
+        report_finding('metadata', finding.Level, finding.Rule, finding.Message, finding.Sample_ID,
+                       finding.Sample_Name, bool(finding.FailsCheck))
+    logger.info(f"Metadata check: {len(findings_df.index)} findings for {findings_df['Sample_ID'].nunique()} samples")
+
+    # missing or ambiguous tracking records are reported, but (as before) don't fail the check
+    return bool(findings_df['FailsCheck'].any())
+
+
+# Index comparisons between two samples (in the order they are reported) and their labels
+index_comparisons = {
+    ('i7', 'i7'): (1, 'i7'),
+    ('i7', 'i5'): (2, 'i7/i5'),
+    ('i5', 'i7'): (3, 'i5/i7'),
+    ('i5', 'i5'): (4, 'i5/i5')}
+# The substring checks historically report both mixed i7/i5 comparisons as 'i5/i7'
+substring_comparison_labels = {1: 'i7', 2: 'i5/i7', 3: 'i5/i7', 4: 'i5/i5'}
+
+# A clash between two indexes of the same sample (other_sample is None) or of two samples in the same lane.
+# kinds: the clashing indexes, e.g. ('i7', 'i5'); clash_type: 'too similar' or 'substring'
+IndexClash = collections.namedtuple('IndexClash', ['sample', 'other_sample', 'kinds', 'clash_type', 'message'])
+
+
+def get_index_neighbourhood(index):
+    # Two indexes of equal length differ by at most one base if and only if they share at least
+    # one of these keys: the index with one position masked (an empty index only matches itself)
+    if len(index) == 0:
+        return ['']
+    return [index[:i] + '.' + index[i + 1:] for i in range(len(index))]
+
+
+def get_samples_by_lane(samplesheet):
+    # group samples by lane, keeping their position in the samplesheet (used to report in sheet order)
+    lane_samples = collections.defaultdict(list)
+    for position, sample in enumerate(samplesheet):
+        lane_samples[sample.Lane].append((position, sample))
+    return lane_samples
+
+
+def get_lane_indexes(lane_samples):
+    # (position, kind, index, sample) for the N-stripped i7 and i5 of all samples, in samplesheet order
+    lane_indexes = list()
+    for position, sample in lane_samples:
+        lane_indexes.append((position, 'i7', sample.index.replace('N', ''), sample))
+        lane_indexes.append((position, 'i5', sample.index2.replace('N', ''), sample))
+    return lane_indexes
+
+
+def findSimilarIndexes(lane_indexes):
+    # Find all pairs of indexes in a lane with at most one mismatch (i7/i5 of the same sample and
+    # i7/i5 across samples) using a hash index over the 1-mismatch neighbourhood of each index.
+    # Returns clashes keyed by (position, other position, comparison), see checkSampleSheetForIndexClashes.
+    neighbourhood_index = collections.defaultdict(list)
+    for entry in lane_indexes:
+        for key in get_index_neighbourhood(entry[2]):
+            neighbourhood_index[key].append(entry)
+
+    clashes = dict()
+    for entries in neighbourhood_index.values():
+        # entries are in samplesheet order (i7 before i5), so the first of a pair is always the earlier sample
+        for i, (position, kind, index, sample) in enumerate(entries):
+            for other_position, other_kind, other_index, sample_other in entries[i + 1:]:
+                if position == other_position:
+                    # i7 and i5 of the same sample (i5 only if there is one)
+                    if len(index) > 0 and len(other_index) > 0:
+                        clashes[(position, -1, 0)] = IndexClash(
+                            sample, None, ('i7', 'i5'), 'too similar',
+                            f"Too similar: i7 and i5 for sample {sample}")
+                elif sample.Sample_ID != sample_other.Sample_ID:
+                    if kind == 'i5' and other_kind == 'i5' and len(index) == 0:
+                        continue  # no i5 to compare
+                    comparison, label = index_comparisons[(kind, other_kind)]
+                    clashes[(position, other_position, comparison)] = IndexClash(
+                        sample, sample_other, (kind, other_kind), 'too similar',
+                        f"Too similar: {label} for samples {sample} and {sample_other}")
+    return clashes
+
+
+def findSubstringIndexes(lane_indexes):
+    # Find all pairs of indexes of different length in a lane where one is contained in the other.
+    # Every substring of every distinct index is looked up in the set of distinct indexes of the lane
+    # (indexes are short, so this is cheap), which yields all containment relations in one pass.
+    # An empty i7 is contained in every other index; empty i5 indexes are never compared.
+    # Returns clashes keyed by (position, other position, comparison), see checkSampleSheetForIndexClashes.
+    entries_by_index = collections.defaultdict(list)
+    for entry in lane_indexes:
+        if len(entry[2]) > 0 or entry[1] == 'i7':
+            entries_by_index[entry[2]].append(entry)
+
+    containers = collections.defaultdict(set)  # index -> longer indexes in the lane that contain it
+    for index in entries_by_index:
+        if len(index) > 0 and '' in entries_by_index:
+            containers[''].add(index)
+        for length in range(1, len(index)):
+            for start in range(len(index) - length + 1):
+                if index[start:start + length] in entries_by_index:
+                    containers[index[start:start + length]].add(index)
+
+    clashes = dict()
+    for index, container_indexes in containers.items():
+        for container_index in container_indexes:
+            for entry in entries_by_index[index]:
+                for other_entry in entries_by_index[container_index]:
+                    # order each pair by samplesheet position
+                    (position, kind, _, sample), (other_position, other_kind, _, sample_other) = \
+                        sorted((entry, other_entry), key=lambda e: (e[0], e[1] == 'i5'))
+                    if position == other_position:
+                        # i5 of a sample contained in its i7
+                        if entry[1] == 'i5':
+                            clashes[(position, -1, 0)] = IndexClash(
+                                sample, None, ('i7', 'i5'), 'substring',
+                                f"Substring: i5 of i7 for sample {sample}")
+                    elif sample.Sample_ID != sample_other.Sample_ID:
+                        comparison, _ = index_comparisons[(kind, other_kind)]
+                        clashes[(position, other_position, comparison)] = IndexClash(
+                            sample, sample_other, (kind, other_kind), 'substring',
+                            f"Substring: {substring_comparison_labels[comparison]} " +
+                            f"for samples {sample} and {sample_other}")
+    return clashes
+
+
+def checkSampleSheetForIndexClashes(samplesheet, fail_on_index_clash=False):
     logger.info("Checking SampleSheet for index clashes")
-    has_error = False
 
-    remaining_samples = list()
-    for sample in samplesheet:
-        remaining_samples.append(sample)
+    # Only samples in the same lane can clash, so each lane is checked on its own.
+    # Clashes are reported in samplesheet order, i.e. the own i7/i5 of a sample first,
+    # then its i7/i7, i7/i5, i5/i7 and i5/i5 comparisons with later samples
+    clashes = dict()
+    for lane, lane_samples in get_samples_by_lane(samplesheet).items():
+        logger.debug(f"Checking indexes of {len(lane_samples)} samples in lane {lane}")
+        lane_indexes = get_lane_indexes(lane_samples)
+        clashes.update(findSimilarIndexes(lane_indexes))
+        clashes.update(findSubstringIndexes(lane_indexes))
 
-    for sample in samplesheet:
-        remaining_samples.remove(sample)
-        logger.info(f"Comparing indexes of sample {sample}")
-        sample_i7 = sample.index.replace('N', '')
-        sample_i5 = sample.index2.replace('N', '')
-        # compare i7 to i5 of sample
-        if len(sample_i5) > 0:
-            if len(sample_i7) == len(sample_i5):
-                if str_compare(sample_i7, sample_i5) <= 1:
-                    logger.error(f"Too similar: i7 and i5 for sample {sample}")
-                    has_error = True
-            else:
-                if sample_i5 in sample_i7:
-                    logger.error(f"Substring: i5 of i7 for sample {sample}")
-                    has_error = True
-        else:
-            logger.debug(f"Skipping i5 index of sample {sample}")
-        for sample_other in remaining_samples:
-            logger.info(f"Checking indexes of sample {sample} against {sample_other}")
-            if sample.Sample_ID != sample_other.Sample_ID and sample.lane == sample_other.lane:
-                sample_other_i7 = sample_other.index.replace('N', '')
-                sample_other_i5 = sample_other.index2.replace('N', '')
-                # compare i7 of sample to i7 of other sample
-                if len(sample_i7) == len(sample_other_i7):
-                    if str_compare(sample_i7, sample_other_i7) <= 1:
-                        logger.error(f"Too similar: i7 for samples {sample} and {sample_other}")
-                        has_error = True
-                else:
-                    if sample_other_i7 in sample_i7 or sample_i7 in sample_other_i7:
-                        logger.error(f"Substring: i7 for samples {sample} and {sample_other}")
-                        has_error = True
-                # compare i7 of sample to i5 of other sample
-                if len(sample_i7) == len(sample_other_i5):
-                    if str_compare(sample_i7, sample_other_i5) <= 1:
-                        logger.error(f"Too similar: i7/i5 for samples {sample} and {sample_other}")
-                        has_error = True
-                elif len(sample_other_i5) > 0:
-                    if sample_other_i5 in sample_i7 or sample_i7 in sample_other_i5:
-                        logger.error(f"Substring: i5/i7 for samples {sample} and {sample_other}")
-                        has_error = True
-                else:
-                    logger.info(f"Skipping i5 index of sample {sample_other}")
-                # compare i5 of sample to i7 of other sample
-                if len(sample_i5) == len(sample_other_i7):
-                    if str_compare(sample_i5, sample_other_i7) <= 1:
-                        logger.error(f"Too similar: i5/i7 for samples {sample} and {sample_other}")
-                        has_error = True
-                elif len(sample_i5) > 0:
-                    if sample_i5 in sample_other_i7 or sample_other_i7 in sample_i5:
-                        logger.error(f"Substring: i5/i7 for samples {sample} and {sample_other}")
-                        has_error = True
-                else:
-                    logger.info(f"Skipping i5 index of sample {sample}")
-                # compare i5 of sample to i5 of other sample
-                if len(sample_i5) > 0:
-                    if len(sample_i5) == len(sample_other_i5):
-                        if str_compare(sample_i5, sample_other_i5) <= 1:
-                            logger.error(f"Too similar: i5/i5 for samples {sample} and {sample_other}")
-                            has_error = True
-                    elif len(sample_other_i5) > 0:
-                        if sample_i5 in sample_other_i5 or sample_other_i5 in sample_i5:
-                            logger.error(f"Substring: i5/i5 for samples {sample} and {sample_other}")
-                            has_error = True
-                    else:
-                        logger.info(f"Skipping i5 index of sample {sample_other}")
-                else:
-                    logger.info(f"Skipping i5 index of sample {sample}")
-            else:
-                logger.info(f"Sample sample or different lane")
+    index_clashes = [clashes[key] for key in sorted(clashes)]
+    for clash in index_clashes:
+        report_finding('index', 'ERROR', 'index_' + clash.clash_type.replace(' ', '_'), clash.message,
+                       clash.sample.Sample_ID, clash.sample.Sample_Name, fail_on_index_clash)
 
-    return has_error
+    return index_clashes
 
 
 def getSortedSamples(samplesheet):
@@ -391,17 +547,12 @@ def writeSammpleSheets(sample_list, sheet_path, template_sheet):
         count += 1
         logger.debug(f"{len(sample_list[key])} samples with idx lengths {key[1]}/{key[2]} for {key[0]} dataset")
 
-        new_sample_sheet = SampleSheet()
-        new_sample_sheet.Header = template_sheet.Header
-        new_sample_sheet.Reads = template_sheet.Reads
-        new_sample_sheet.Settings = template_sheet.Settings
-        for sample in sample_list[key]:
-            new_sample_sheet.add_sample(sample)
+        new_sample_sheet = template_sheet.with_samples(sample_list[key])
 
         new_sample_sheet_file = os.path.join(samplesheet_dir, samplesheet_name + ".custom." + str(count) + "." + key[0])
         logger.info(f"Creating custom sample sheet: {new_sample_sheet_file}")
         try:
-            with open(new_sample_sheet_file, "w") as ss_writer:
+            with open(new_sample_sheet_file, "w", newline='') as ss_writer:
                 new_sample_sheet.write(ss_writer)
         except Exception as error:
             logger.error(f"Exception writing new sample sheet: {error}")
@@ -412,24 +563,44 @@ def writeSammpleSheets(sample_list, sheet_path, template_sheet):
     return exit_status
 
 
-def main(samplesheet_file_path, check_only):
+def get_report_path(samplesheet_file_path):
+    return os.path.splitext(samplesheet_file_path)[0] + REPORT_SUFFIX
+
+
+def main(samplesheet_file_path, check_only, fail_on_index_clash=False, report_path=None):
+    global validation_report
+    validation_report = ValidationReport(samplesheet_file_path)
+    log_rate_limit_filter.pop_suppressed()
     logger.info(f"Checking SampleSheet {samplesheet_file_path}")
-    original_sample_sheet = SampleSheet(samplesheet_file_path)
+    original_sample_sheet = read_samplesheet(samplesheet_file_path)
 
     # Run some consistency checks
     years = get_years_from_samplesheet(original_sample_sheet)
     logger.info(f"Samplesheet contains IDs from {len(years)} years: {years}")
     for year in years:
-        library_tracking_spreadsheet[year] = get_library_sheet_from_google(year)
+        library_tracking_spreadsheet[year] = get_library_index(year)
     import_library_sheet_validation_from_google()
+    log_call_stats(logger)
     # TODO: replace has_error return with enum and expand to error, warning, info?
     has_header_error = checkSampleSheetMetadata(original_sample_sheet)
     has_id_error = checkSampleAndLibraryIdFormat(original_sample_sheet)
-    has_index_error = checkSampleSheetForIndexClashes(original_sample_sheet)
+    index_clashes = checkSampleSheetForIndexClashes(original_sample_sheet, fail_on_index_clash)
     has_metadata_error = checkMetadataCorrespondence(original_sample_sheet)
-    # Only fail on metadata or id errors
-    if has_index_error:
-        print("Index errors detected. Note: the pipeline will ignore those, please make sure to review those errors!")
+    log_suppressed_records()
+    report_path = report_path or get_report_path(samplesheet_file_path)
+    try:
+        validation_report.write(report_path)
+        logger.info(f"Wrote {len(validation_report.findings)} findings to {report_path}")
+    except OSError as err:
+        logger.warning(f"Could not write the findings to {report_path}: {err}")
+    # Only fail on metadata or id errors (and index clashes if requested)
+    if index_clashes:
+        print(f"{len(index_clashes)} index errors detected:")
+        for clash in index_clashes:
+            print(f"  {clash.message}")
+        if fail_on_index_clash:
+            raise ValueError("Index clashes detected. Please review the index errors!")
+        print("Note: the pipeline will ignore those, please make sure to review those errors!")
     if has_header_error or has_id_error or has_metadata_error:
         raise ValueError("Pipeline breaking validation detected errors. Please review the error logs!")
 
@@ -446,13 +617,32 @@ def main(samplesheet_file_path, check_only):
                            sheet_path=samplesheet_file_path,
                            template_sheet=original_sample_sheet)
 
+    log_suppressed_records()
     logger.info("All done.")
 
 
 # global variables
 # TODO: should be refactored in proper class variables
-library_tracking_spreadsheet = dict()  # dict of sheets as dataframes
-logger = getLogger()
+library_tracking_spreadsheet = dict()  # dict of sheets indexed by library ID (LibraryIndex) per year
+validation_report = ValidationReport()  # the findings of the current check
+log_rate_limit_filter = LogRateLimitFilter(LOG_RECORDS_PER_CATEGORY, LOG_RATE_INTERVAL)
+logger, console_handler = getLogger()
+tracking_sheet_cache = TrackingSheetCache(lab_spreadsheet_id, logger=logger)  # local snapshots of the tracking sheet
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser(description='Generate data for LIMS spreadsheet.')
+    parser.add_argument('samplesheet',
+                        help="The samplesheet to process.")
+    parser.add_argument('--check-only', action='store_true',
+                        help="Only run the checks, do not split the samplesheet.")
+    parser.add_argument('--fail-on-index-clash', action='store_true',
+                        help="Fail the check if index clashes are detected (by default they are only reported).")
+    parser.add_argument('--report',
+                        help="Write all findings of the checks to this file (JSON, or TSV if the name ends with " +
+                             f".tsv), instead of next to the samplesheet (<samplesheet name>{REPORT_SUFFIX}).")
+    return parser
+
 
 if __name__ == "__main__":
     logger.info(f"Invocation with parameters: {sys.argv[1:]}")
@@ -468,16 +658,10 @@ if __name__ == "__main__":
     ################################################################################
     # argument parsing
 
-    logger.debug("Setting up argument parser.")
-    parser = argparse.ArgumentParser(description='Generate data for LIMS spreadsheet.')
-    parser.add_argument('samplesheet',
-                        help="The samplesheet to process.")
-    parser.add_argument('--check-only', action='store_true',
-                        help="Only run the checks, do not split the samplesheet.")
-
     logger.debug("Parsing arguments.")
-    args = parser.parse_args()
+    args = get_arg_parser().parse_args()
     samplesheet_file_path = args.samplesheet
     check_only = True if args.check_only else False
 
-    main(samplesheet_file_path=samplesheet_file_path, check_only=check_only)
+    main(samplesheet_file_path=samplesheet_file_path, check_only=check_only,
+         fail_on_index_clash=args.fail_on_index_clash, report_path=args.report)
@@ -0,0 +1,67 @@
+import os
+import io
+import sys
+import argparse
+import tempfile
+import timeit
+import warnings
+from samplesheet import read_samplesheet
+from synthetic_samplesheets import generate_samples, write_samplesheet
+
+################################################################################
+# Benchmark of reading and writing (large) SampleSheets with the shared samplesheet parser,
+# compared to the sample_sheet package (if installed) it replaces.
+#   python samplesheet-parser-benchmark.py [--samples 96 384 1536 6144] [--repeat 5]
+
+try:
+    from sample_sheet import SampleSheet  # https://github.com/clintval/sample-sheet
+except ImportError:
+    SampleSheet = None
+
+warnings.simplefilter("ignore")
+
+# the sample_sheet package checks every added sample against all previous ones (quadratic), larger sheets take minutes
+PACKAGE_MAX_SAMPLES = 1536
+
+def get_best_time(function, repeat):
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def run_benchmark(sample_count, repeat, work_dir):
+    path = os.path.join(work_dir, f"SampleSheet.{sample_count}.csv")
+    write_samplesheet(path, generate_samples(sample_count))
+    results = dict()
+
+    samplesheet = read_samplesheet(path)
+    results['parse'] = get_best_time(lambda: read_samplesheet(path), repeat)
+    results['write'] = get_best_time(lambda: samplesheet.write(io.StringIO()), repeat)
+
+    if SampleSheet is not None and sample_count <= PACKAGE_MAX_SAMPLES:
+        package_samplesheet = SampleSheet(path)
+        results['package parse'] = get_best_time(lambda: SampleSheet(path), repeat)
+        results['package write'] = get_best_time(lambda: package_samplesheet.write(io.StringIO()), repeat)
+    return results
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser(description='Benchmark reading and writing of SampleSheets.')
+    parser.add_argument('--samples', type=int, nargs='+', default=[96, 384, 1536, 6144],
+                        help="The numbers of samples of the synthetic SampleSheets.")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="The number of repetitions (the best time is reported).")
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_arg_parser().parse_args()
+    if SampleSheet is None:
+        print("sample_sheet package not installed, only timing the samplesheet parser.", file=sys.stderr)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        print(f"{'samples':>8} " + ' '.join(f"{name:>14}" for name in
+                                            ('parse', 'write', 'package parse', 'package write')))
+        for sample_count in args.samples:
+            results = run_benchmark(sample_count, args.repeat, work_dir)
+            print(f"{sample_count:>8} " + ' '.join(f"{results[name] * 1000:>12.2f}ms" if name in results
+                                                   else f"{'-':>14}"
+                                                   for name in ('parse', 'write', 'package parse', 'package write')))
@@ -0,0 +1,289 @@
+"""
+Reading and writing of Illumina SampleSheets, shared by the pipeline and showcase scripts.
+
+A SampleSheet is read in a single pass over the file into an ordered set of sections:
+key/value sections (e.g. [Header], [Settings]) as Section dicts, list sections (the v1 [Reads])
+as lists and table sections ([Data], or the v2 [BCLConvert_Data] etc.) as column oriented
+DataTables. Values are kept as read (strings), so a sheet can be written back as it was read.
+
+Samples are lightweight views on the rows of the data table and give attribute access to
+the columns (sample.Sample_ID, sample.index, ...), returning None for undefined columns like
+the sample_sheet package (https://github.com/clintval/sample-sheet) this module replaces.
+"""
+import re
+import csv
+
+# sections that are read as tables, the first found is the data table of the sheet
+DATA_SECTION_NAME = 'Data'
+TABLE_SECTION_SUFFIX = '_Data'
+# From the section "Character Encoding" of the Illumina format specification: printable ASCII only
+invalid_character_re = re.compile(r'[^ -~\r\n]')
+section_header_re = re.compile(r'\[(.*)\]')
+index_column_re = re.compile(r'index\d?')
+index_value_re = re.compile(r'^[ACGTN]*$|^SI-[ACGTNS]{2}-[A-H]\d+$')  # incl. 10X sample index names
+
+
+class Section(dict):
+    """
+    Key/value section of a SampleSheet, e.g. [Header] or [Settings]. Values of undefined keys are None.
+    The fields after the value (e.g. key,value1,value2 rows) are kept in extra_fields and written back.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.extra_fields = dict()  # key -> fields after its value
+
+    def __getattr__(self, key):
+        if key.startswith('__'):
+            raise AttributeError(key)
+        return self.get(key)
+
+
+class DataTable:
+    """
+    Table section of a SampleSheet, e.g. [Data], stored by column (column name -> list of values).
+    """
+
+    def __init__(self, column_names=()):
+        self.columns = {column_name: list() for column_name in column_names}
+        self.column_names_lower = {column_name.lower(): column_name for column_name in column_names}
+        self.row_count = 0
+
+    @classmethod
+    def from_columns(cls, columns):
+        # e.g. from a pandas DataFrame: DataTable.from_columns(df.to_dict('list'))
+        table = cls(list(columns))
+        for column_name, values in columns.items():
+            table.columns[column_name] = list(values)
+        table.row_count = len(next(iter(table.columns.values()), []))
+        return table
+
+    def append_row(self, values):
+        # values beyond the table columns are ignored, missing values are empty
+        for column, value in zip(self.columns.values(), values):
+            column.append(value)
+        for column in list(self.columns.values())[len(values):]:
+            column.append('')
+        self.row_count += 1
+
+    def get_column_name(self, name):
+        if name in self.columns:
+            return name
+        return self.column_names_lower.get(name.lower())
+
+    def set_value(self, column_name, position, value):
+        name = self.get_column_name(column_name)
+        if name is None:
+            # a new column, empty for all other rows
+            name = column_name
+            self.columns[name] = [''] * self.row_count
+            self.column_names_lower[name.lower()] = name
+        self.columns[name][position] = value
+
+    def take(self, positions):
+        # new table with the given rows (in the given order)
+        table = DataTable(self.columns)
+        for column_name, values in self.columns.items():
+            table.columns[column_name] = [values[position] for position in positions]
+        table.row_count = len(positions)
+        return table
+
+    def get_rows(self):
+        return zip(*self.columns.values())
+
+    def __len__(self):
+        return self.row_count
+
+    def __iter__(self):
+        for position in range(self.row_count):
+            yield Sample(self, position)
+
+
+class Sample:
+    """
+    A row (sample) of a DataTable, with (case insensitive) attribute access to its columns.
+    """
+    __slots__ = ('table', 'position')
+
+    def __init__(self, table, position):
+        object.__setattr__(self, 'table', table)
+        object.__setattr__(self, 'position', position)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        column_name = self.table.get_column_name(name)
+        return None if column_name is None else self.table.columns[column_name][self.position]
+
+    def __setattr__(self, name, value):
+        self.table.set_value(name, self.position, value)
+
+    def get(self, name, default=None):
+        value = self.__getattr__(name)
+        return default if value is None else value
+
+    def to_dict(self):
+        return {column_name: values[self.position] for column_name, values in self.table.columns.items()}
+
+    def __repr__(self):
+        return f"Sample({self.to_dict()})"
+
+    def __str__(self):
+        return str(self.Sample_ID) if self.Sample_ID is not None else ''
+
+
+class SampleSheet:
+    """
+    A SampleSheet as ordered sections (section name -> Section, list or DataTable).
+    """
+
+    def __init__(self, sections=None):
+        self.sections = dict(sections) if sections else dict()
+
+    @property
+    def Header(self):
+        return self.sections.setdefault('Header', Section())
+
+    @property
+    def Settings(self):
+        return self.sections.setdefault('Settings', Section())
+
+    @property
+    def Reads(self):
+        return self.sections.get('Reads')
+
+    @property
+    def version(self):
+        return 2 if self.Header.get('FileFormatVersion') == '2' else 1
+
+    @property
+    def data(self):
+        # the sample table: [Data] for v1 sheets, the first table section (e.g. [BCLConvert_Data]) for v2
+        if DATA_SECTION_NAME in self.sections:
+            return self.sections[DATA_SECTION_NAME]
+        for section in self.sections.values():
+            if isinstance(section, DataTable):
+                return section
+        return self.sections.setdefault(DATA_SECTION_NAME, DataTable())
+
+    @property
+    def samples(self):
+        return list(self.data)
+
+    def with_samples(self, samples):
+        # copy of this sheet (sharing the non-data sections) with only the given samples of its data table
+        sections = dict(self.sections)
+        data_section_name = next(name for name, section in self.sections.items() if section is self.data)
+        sections[data_section_name] = self.data.take([sample.position for sample in samples])
+        return SampleSheet(sections)
+
+    def write(self, handle, padded=True, lineterminator='\r\n'):
+        # Sections are separated by an empty row. If padded, every row is padded with empty fields to the width
+        # of the data table (as written by the sample_sheet package and Illumina Experiment Manager)
+        writer = csv.writer(handle, lineterminator=lineterminator)
+        width = max(len(self.data.columns), 2) if padded else 0
+
+        def write_row(row):
+            row = list(row)
+            writer.writerow(row + [''] * (width - len(row)))
+
+        for number, (section_name, section) in enumerate(self.sections.items()):
+            if number > 0:
+                write_row([])
+            write_row([f"[{section_name}]"])
+            if isinstance(section, DataTable):
+                write_row(section.columns)
+                for row in section.get_rows():
+                    write_row(row)
+            elif isinstance(section, dict):
+                extra_fields = getattr(section, 'extra_fields', {})
+                for key, value in section.items():
+                    write_row([key, value] + extra_fields.get(key, []))
+            else:
+                for value in section:
+                    write_row([value])
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.data)
+
+
+def validate_data_table(table):
+    # Index values have to be valid and, as dual/single index combinations, unique per lane (or flowcell)
+    index_column_names = [name for name in ('index', 'index2') if name in table.columns]
+    for column_name in table.columns:
+        if index_column_re.match(column_name):
+            for value in table.columns[column_name]:
+                if not index_value_re.match(value):
+                    raise ValueError(f"Not a valid index: {value}")
+    if not index_column_names:
+        return
+    lane_column_name = table.get_column_name('Lane')
+    lanes = table.columns[lane_column_name] if lane_column_name else [None] * len(table)
+    seen = dict()
+    for sample, lane, *indexes in zip(table, lanes, *[table.columns[name] for name in index_column_names]):
+        key = (lane, *indexes)
+        if key in seen:
+            raise ValueError(f"Sample index combination for {sample} has already been added on this lane "
+                             f"or flowcell: {seen[key]}")
+        seen[key] = sample
+
+
+def parse_samplesheet(handle, validate=True):
+    sections = dict()
+    section_name = None
+    section = None
+    for line_number, line in enumerate(csv.reader(handle, skipinitialspace=True), start=1):
+        # drop the padding of the rows, skip empty rows
+        while line and not line[-1].strip():
+            line.pop()
+        if not line:
+            continue
+        if validate:
+            for field in line:
+                if invalid_character_re.search(field):
+                    raise ValueError(f"Sample sheet contains invalid characters on line {line_number}: {''.join(line)}")
+
+        header_match = section_header_re.match(line[0])
+        if header_match:
+            section_name = header_match.group(1)
+            section = sections.get(section_name)
+            continue
+        if section_name is None:
+            raise ValueError(f"Sample sheet line {line_number} is not part of a section: {','.join(line)}")
+
+        if section is None:
+            # the first row of a section determines its type
+            if section_name == DATA_SECTION_NAME or section_name.endswith(TABLE_SECTION_SUFFIX):
+                if any(not column_name for column_name in line):
+                    raise ValueError(f"Header for [{section_name}] section is not allowed to have empty fields: {line}")
+                section = sections[section_name] = DataTable(line)
+                continue
+            section = sections[section_name] = list() if len(line) == 1 else Section()
+
+        if isinstance(section, DataTable):
+            section.append_row(line)
+        elif isinstance(section, list):
+            section.append(line[0])
+        else:
+            section[line[0]] = line[1] if len(line) > 1 else ''
+            if len(line) > 2:
+                section.extra_fields[line[0]] = line[2:]
+
+    samplesheet = SampleSheet(sections)
+    if validate:
+        validate_data_table(samplesheet.data)
+    return samplesheet
+
+
+def read_samplesheet(path, validate=True):
+    """
+    Read the SampleSheet at the given path (or from an open file). Unless validate is False, the sheet is
+    checked for invalid characters and invalid or duplicate indexes (raising a ValueError).
+    """
+    if hasattr(path, 'read'):
+        return parse_samplesheet(path, validate)
+    with open(path, newline='') as handle:
+        return parse_samplesheet(handle, validate)
@@ -0,0 +1,146 @@
+"""
+Rate limited access to the Google Sheets API, shared by the pipeline scripts.
+
+Overlapping pipeline steps (and the concurrent loading of tracking sheet tabs) can exceed the per
+minute read and write quotas of the Sheets API. All calls therefore go through process wide token
+buckets (one for reads, one for writes) and calls failing with a rate limit (429) or server error (5xx)
+are retried with exponential, jittered backoff. Calls that are not idempotent (appends) are only retried
+after a rate limit error: after a server error or timeout they may have been applied, so the caller has
+to check before repeating them. The latency of every call is recorded per operation
+and can be logged as a summary at the end of a script.
+"""
+import time
+import random
+import logging
+import threading
+import requests
+from gspread.exceptions import APIError
+
+# Sheets API quotas (per minute and user) the calls of a process are limited to
+READS_PER_MINUTE = 60
+WRITES_PER_MINUTE = 60
+# retries of failed calls, after waiting between half and all of the backoff (seconds, doubled per retry)
+MAX_RETRIES = 6
+INITIAL_BACKOFF = 2
+MAX_BACKOFF = 64
+retry_status_codes = (429, 500, 502, 503, 504)
+RATE_LIMIT_STATUS_CODE = 429  # the request was rejected (not applied)
+
+
+class TokenBucket:
+    """
+    Rate limit of rate calls per second, allowing bursts of up to capacity calls.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # take a token, waiting until it's available (tokens are taken in order, so waiting calls queue up)
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+read_bucket = TokenBucket(READS_PER_MINUTE / 60, READS_PER_MINUTE / 6)
+write_bucket = TokenBucket(WRITES_PER_MINUTE / 60, WRITES_PER_MINUTE / 6)
+call_stats = dict()  # operation -> [calls, retries, total seconds, max seconds]
+call_stats_lock = threading.Lock()
+
+
+def get_status_code(error):
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', None)
+
+
+def is_retryable(error, idempotent=True):
+    if isinstance(error, APIError):
+        status_code = get_status_code(error)
+        return status_code in retry_status_codes and (idempotent or status_code == RATE_LIMIT_STATUS_CODE)
+    return idempotent  # connection errors and timeouts, the request may have been applied
+
+
+def get_backoff(attempt):
+    # seconds to wait before the retry after the given (0 based) attempt
+    return min(MAX_BACKOFF, INITIAL_BACKOFF * 2 ** attempt) * random.uniform(0.5, 1)
+
+
+def record_call(operation, seconds, retries):
+    with call_stats_lock:
+        stats = call_stats.setdefault(operation, [0, 0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += retries
+        stats[2] += seconds
+        stats[3] = max(stats[3], seconds)
+
+
+def call_api(operation, function, *args, write=False, idempotent=True, logger=None, **kwargs):
+    """
+    Call the (Sheets API) function within the rate limit, retrying rate limited and failed calls (only rate
+    limited calls if the call is not idempotent).
+    """
+    logger = logger if logger else logging.getLogger(__name__)
+    bucket = write_bucket if write else read_bucket
+    for attempt in range(MAX_RETRIES + 1):
+        bucket.acquire()
+        start = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        except (APIError, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+            if attempt == MAX_RETRIES or not is_retryable(error, idempotent):
+                raise
+            backoff = get_backoff(attempt)
+            logger.warning(f"{operation} failed ({get_status_code(error) or type(error).__name__}), " +
+                           f"retry {attempt + 1} in {backoff:.1f}s")
+            time.sleep(backoff)
+            continue
+        seconds = time.perf_counter() - start
+        record_call(operation, seconds, attempt)
+        logger.debug(f"{operation} took {seconds * 1000:.0f}ms")
+        return result
+
+
+def log_call_stats(logger):
+    # log (and reset) the latencies of the calls since the last summary
+    with call_stats_lock:
+        stats = dict(call_stats)
+        call_stats.clear()
+    for operation, (calls, retries, total_seconds, max_seconds) in sorted(stats.items()):
+        logger.info(f"Sheets API {operation}: {calls} calls ({retries} retries), " +
+                    f"mean {total_seconds / calls * 1000:.0f}ms, max {max_seconds * 1000:.0f}ms")
+
+
+class SheetsClient:
+    """
+    Rate limited and retrying access to the values of a (gspread) spreadsheet.
+    """
+
+    def __init__(self, spreadsheet, logger=None):
+        self.spreadsheet = spreadsheet
+        self.logger = logger
+
+    def values_get(self, range_name, params=None):
+        return call_api('values_get', self.spreadsheet.values_get, range_name, params=params, logger=self.logger)
+
+    def values_batch_get(self, ranges, params=None):
+        return call_api('values_batch_get', self.spreadsheet.values_batch_get, ranges, params=params,
+                        logger=self.logger)
+
+    def values_batch_update(self, body):
+        return call_api('values_batch_update', self.spreadsheet.values_batch_update, body, write=True,
+                        logger=self.logger)
+
+    def values_append(self, range_name, params, body):
+        # not retried after server errors or timeouts, the rows may have been appended
+        return call_api('values_append', self.spreadsheet.values_append, range_name, params, body, write=True,
+                        idempotent=False, logger=self.logger)
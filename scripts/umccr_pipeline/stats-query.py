@@ -0,0 +1,93 @@
+import os
+import re
+import sys
+import time
+import argparse
+from stats_store import LANES, SAMPLES, get_store_dir, read_table
+
+################################################################################
+# Queries across the demultiplexing stats of all runs in the stats store (written by update-stats-sheet.py).
+# The results are printed as TSV.
+#   python stats-query.py runs [--year 2020] [--instrument A00130] [--last 100]
+#   python stats-query.py undetermined [--last 100]
+#   python stats-query.py libraries [L2000123 ...] [--year 2020]
+
+GENOME_SIZE = 3200000000
+# topups and reruns of a library (e.g. L2000123_topup2) count towards the library
+library_suffix_re = re.compile(r'_(topup|rerun)\d*$')
+
+
+def get_last_runs(table_df, last):
+    # the rows of the last runs (run IDs start with the run date)
+    if last:
+        run_ids = sorted(table_df['run_id'].unique())[-last:]
+        table_df = table_df[table_df['run_id'].isin(run_ids)]
+    return table_df
+
+
+def query_runs(args):
+    lanes_df = read_table(args.store, LANES, columns=['run_id', 'lane', 'reads_PF', 'bases_PF', 'reads_undetermined'],
+                          years=args.year, instruments=args.instrument)
+    lanes_df = get_last_runs(lanes_df, args.last)
+    runs_df = lanes_df.groupby('run_id').agg(lanes=('lane', 'count'), reads_PF=('reads_PF', 'sum'),
+                                             bases_PF=('bases_PF', 'sum'),
+                                             reads_undetermined=('reads_undetermined', 'sum'))
+    runs_df['undetermined_fraction'] = runs_df['reads_undetermined'] / runs_df['reads_PF']
+    samples_df = read_table(args.store, SAMPLES, columns=['run_id', 'sample_id'], years=args.year,
+                            instruments=args.instrument)
+    samples_df = samples_df[samples_df['run_id'].isin(runs_df.index)]
+    runs_df['samples'] = samples_df.groupby('run_id')['sample_id'].nunique()
+    return runs_df.reset_index()
+
+
+def query_undetermined(args):
+    lanes_df = read_table(args.store, LANES, columns=['run_id', 'lane', 'reads_PF', 'reads_undetermined'],
+                          years=args.year, instruments=args.instrument)
+    lanes_df = get_last_runs(lanes_df, args.last)
+    lanes_df = lanes_df.sort_values(['run_id', 'lane'])
+    lanes_df['undetermined_fraction'] = lanes_df['reads_undetermined'] / lanes_df['reads_PF']
+    return lanes_df
+
+
+def query_libraries(args):
+    samples_df = read_table(args.store, SAMPLES, columns=['run_id', 'sample_name', 'reads', 'bases'],
+                            years=args.year, instruments=args.instrument)
+    samples_df = get_last_runs(samples_df, args.last)
+    samples_df = samples_df.assign(library_id=samples_df['sample_name'].str.replace(library_suffix_re, '', regex=True))
+    if args.library_ids:
+        samples_df = samples_df[samples_df['library_id'].isin(args.library_ids)]
+    libraries_df = samples_df.groupby('library_id').agg(
+        runs=('run_id', 'nunique'), sequenced_as=('sample_name', lambda names: ','.join(sorted(set(names)))),
+        reads=('reads', 'sum'), bases=('bases', 'sum'))
+    libraries_df['genome_equivalents'] = libraries_df['bases'] / float(GENOME_SIZE)
+    return libraries_df.reset_index()
+
+
+def get_arg_parser():
+    # the options of all queries
+    query_parser = argparse.ArgumentParser(add_help=False)
+    query_parser.add_argument('--store', default=get_store_dir(os.getenv('DEPLOY_ENV')),
+                              help='Stats store directory (default: the store of DEPLOY_ENV or STATS_STORE_DIR).')
+    query_parser.add_argument('--year', type=int, action='append', help='Only runs of the year (can be repeated).')
+    query_parser.add_argument('--instrument', action='append', help='Only runs of the instrument (can be repeated).')
+    query_parser.add_argument('--last', type=int, help='Only the last runs (by run date).')
+
+    parser = argparse.ArgumentParser(description='Query the demultiplexing stats of all runs.')
+    subparsers = parser.add_subparsers(dest='query', required=True)
+    subparsers.add_parser('runs', parents=[query_parser], help='Reads, yield and undetermined fraction per run.') \
+        .set_defaults(function=query_runs)
+    subparsers.add_parser('undetermined', parents=[query_parser], help='Undetermined fraction per lane.') \
+        .set_defaults(function=query_undetermined)
+    libraries_parser = subparsers.add_parser('libraries', parents=[query_parser],
+                                             help='Reads and yield per library, incl. topups and reruns.')
+    libraries_parser.add_argument('library_ids', nargs='*', metavar='LIBRARY_ID', help='Only these libraries.')
+    libraries_parser.set_defaults(function=query_libraries)
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_arg_parser().parse_args()
+    start = time.perf_counter()
+    result_df = args.function(args)
+    result_df.to_csv(sys.stdout, sep='\t', index=False)
+    print(f"{len(result_df.index)} rows in {(time.perf_counter() - start) * 1000:.0f}ms", file=sys.stderr)
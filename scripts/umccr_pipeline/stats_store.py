@@ -0,0 +1,72 @@
+"""
+Store of the demultiplexing stats of all runs, for queries across runs (and the source of the stats workbook).
+
+The stats of a run are kept as two Parquet files, partitioned by the year and the instrument of the run:
+  <store>/lanes/year=2020/instrument=A00130/<run ID>.parquet    one row per lane (PF and undetermined reads)
+  <store>/samples/year=2020/instrument=A00130/<run ID>.parquet  one row per lane and sample (demultiplexed reads)
+Writing the stats of a run again replaces them, so re-processing a run doesn't duplicate its stats. Queries read
+only the needed columns of the (optionally filtered) partitions.
+"""
+import os
+import pandas
+
+LANES = 'lanes'
+SAMPLES = 'samples'
+# the store of each deployment environment, next to its stats workbook (unless set with STATS_STORE_DIR)
+store_dirs = {
+    'prod': '/storage/shared/dev/Baymax-Run-Stats-store',
+    'dev': '/storage/shared/dev/Baymax-Run-Stats-store.dev'}
+lane_column_names = ('run_id', 'flowcell', 'run_number', 'lane', 'reads_raw', 'reads_PF', 'bases_PF',
+                     'reads_undetermined', 'bases_undetermined')
+sample_column_names = ('run_id', 'lane', 'sample_position', 'sample_id', 'sample_name', 'reads', 'bases')
+
+
+def get_store_dir(deploy_env):
+    return os.getenv('STATS_STORE_DIR', store_dirs.get(deploy_env, store_dirs['dev']))
+
+
+def get_partition(run_id):
+    # year and instrument of a run, e.g. (2020, 'A00130') for 200102_A00130_0002_AHXXXXXXX2
+    return 2000 + int(run_id[:2]), run_id.split('_')[1]
+
+
+def get_run_path(store_dir, table, run_id):
+    year, instrument = get_partition(run_id)
+    return os.path.join(store_dir, table, f"year={year}", f"instrument={instrument}", run_id + '.parquet')
+
+
+def write_run(store_dir, run_id, lanes_df, samples_df):
+    """
+    Store (or replace) the lane and sample stats of the run.
+    """
+    for table, table_df, column_names in ((LANES, lanes_df, lane_column_names),
+                                          (SAMPLES, samples_df, sample_column_names)):
+        path = get_run_path(store_dir, table, run_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary (hidden, so not read by queries) file first, so queries never see a partial file
+        tmp_path = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.tmp')
+        table_df[list(column_names)].to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+
+
+def read_run(store_dir, run_id):
+    # the lane and sample stats of the run
+    return pandas.read_parquet(get_run_path(store_dir, LANES, run_id)), \
+        pandas.read_parquet(get_run_path(store_dir, SAMPLES, run_id))
+
+
+def read_table(store_dir, table, columns=None, years=None, instruments=None):
+    """
+    The stats of all stored runs (of the given years and instruments) from the lanes or samples table, with the
+    year and instrument of the runs as (categorical) columns.
+    """
+    filters = list()
+    if years:
+        filters.append(('year', 'in', [int(year) for year in years]))
+    if instruments:
+        filters.append(('instrument', 'in', list(instruments)))
+    table_dir = os.path.join(store_dir, table)
+    if not os.path.isdir(table_dir):
+        column_names = lane_column_names if table == LANES else sample_column_names
+        return pandas.DataFrame(columns=list(columns) if columns else list(column_names) + ['year', 'instrument'])
+    return pandas.read_parquet(table_dir, columns=list(columns) if columns else None, filters=filters or None)
@@ -0,0 +1,258 @@
+"""
+Incremental append of rows to the sheets of the (cumulative) run stats workbook.
+
+Loading the workbook with openpyxl parses every cell of every sheet and saving it serialises them all
+again, so the cost of adding a run grows with the whole history. An .xlsx file is a zip of XML parts
+though: new rows can be added by inserting their XML at the end of the sheet data of the target sheet.
+Only that sheet's part (and the styles, for the percentage format) is changed, all other parts are
+copied as they are without being parsed. New rows use inline strings, so the shared strings table does
+not need to be rewritten.
+
+If a target sheet does not exist yet (e.g. the first run of a year) or its XML isn't as expected, the
+workbook is updated with openpyxl instead (formatting only the new rows). New sheets get the header row
+of an existing sheet.
+"""
+import os
+import re
+import copy
+import math
+import numbers
+import zipfile
+import posixpath
+import xml.etree.ElementTree as ElementTree
+from xml.sax.saxutils import escape
+from openpyxl import load_workbook
+from openpyxl.utils import get_column_letter, column_index_from_string
+
+PERCENT_FORMAT = '0.00%'
+PERCENT_FORMAT_ID = 10  # the built-in number format for 0.00%
+MAIN_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+RELATIONSHIP_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+PACKAGE_RELATIONSHIP_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+row_start_re = re.compile(rb'<row\b[^>]*?\br="(\d+)"')
+dimension_re = re.compile(rb'<dimension ref="([A-Z]+)(\d+)(?::([A-Z]+)(\d+))?"')
+cell_xfs_re = re.compile(rb'<cellXfs count="(\d+)">(.*?)</cellXfs>', re.DOTALL)
+xf_re = re.compile(rb'<xf\b([^>]*?)/?>')
+attribute_re = re.compile(rb'(\w+)="([^"]*)"')
+
+
+class UnexpectedWorkbookError(Exception):
+    pass
+
+
+def get_cell_xml(reference, value, style_id=None):
+    # the XML of a cell as openpyxl would write it (strings starting with = are formulas), None for an empty cell
+    style = f' s="{style_id}"' if style_id is not None else ''
+    if value is None or value == '':
+        return None
+    if isinstance(value, str):
+        if value.startswith('='):
+            return f'<c r="{reference}"{style}><f>{escape(value[1:])}</f></c>'
+        return f'<c r="{reference}"{style} t="inlineStr"><is><t>{escape(value)}</t></is></c>'
+    if isinstance(value, bool):
+        return f'<c r="{reference}"{style} t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, numbers.Integral):
+        return f'<c r="{reference}"{style} t="n"><v>{int(value)}</v></c>'
+    if isinstance(value, numbers.Real):
+        if not math.isfinite(value):
+            return None
+        return f'<c r="{reference}"{style} t="n"><v>{repr(float(value))}</v></c>'
+    raise ValueError(f"Unsupported cell value {value!r} for {reference}")
+
+
+def get_rows_xml(rows, first_row, percent_columns, percent_style_id):
+    rows_xml = list()
+    for row_number, row in enumerate(rows, start=first_row):
+        cells_xml = list()
+        for column_number, value in enumerate(row, start=1):
+            style_id = percent_style_id if column_number in percent_columns else None
+            cell_xml = get_cell_xml(f"{get_column_letter(column_number)}{row_number}", value, style_id)
+            if cell_xml:
+                cells_xml.append(cell_xml)
+        rows_xml.append(f'<row r="{row_number}">{"".join(cells_xml)}</row>')
+    return ''.join(rows_xml).encode('utf-8')
+
+
+def get_percent_style(styles_xml):
+    # the index of the cell format with the percentage number format (and default font, fill and border),
+    # adding one to the styles if there is none
+    cell_xfs = cell_xfs_re.search(styles_xml)
+    if not cell_xfs:
+        raise UnexpectedWorkbookError("No cell formats in styles")
+    xfs = xf_re.findall(cell_xfs.group(2))
+    for style_id, xf_attributes in enumerate(xfs):
+        attributes = dict(attribute_re.findall(xf_attributes))
+        if attributes.get(b'numFmtId') == str(PERCENT_FORMAT_ID).encode() and \
+                all(attributes.get(name, b'0') == b'0' for name in (b'fontId', b'fillId', b'borderId')):
+            return styles_xml, style_id
+    percent_xf = f'<xf numFmtId="{PERCENT_FORMAT_ID}" fontId="0" fillId="0" borderId="0" xfId="0" ' \
+                 f'applyNumberFormat="1"/>'.encode()
+    styles_xml = styles_xml[:cell_xfs.start()] + \
+        f'<cellXfs count="{len(xfs) + 1}">'.encode() + cell_xfs.group(2) + percent_xf + b'</cellXfs>' + \
+        styles_xml[cell_xfs.end():]
+    return styles_xml, len(xfs)
+
+
+class StatsWorkbook:
+
+    def __init__(self, path, logger=None):
+        self.path = path
+        self.logger = logger
+        self.sheet_parts = self.read_sheet_parts()  # sheet name -> path of the sheet's XML in the workbook zip
+        self.sheet_xmls = dict()  # sheet name -> XML of the sheets rows are appended to
+        self.new_rows = dict()  # sheet name -> (first row number, rows, percent column numbers)
+        self.new_sheets = dict()  # sheet name -> name of the sheet whose header row is copied
+        self.workbook = None  # the workbook loaded with openpyxl, if the XML of a sheet isn't as expected
+
+    def read_sheet_parts(self):
+        with zipfile.ZipFile(self.path) as workbook_zip:
+            workbook = ElementTree.fromstring(workbook_zip.read('xl/workbook.xml'))
+            relationships = ElementTree.fromstring(workbook_zip.read('xl/_rels/workbook.xml.rels'))
+        targets = {relationship.get('Id'): relationship.get('Target')
+                   for relationship in relationships.iter(PACKAGE_RELATIONSHIP_NS + 'Relationship')}
+        sheet_parts = dict()
+        for sheet in workbook.iter(MAIN_NS + 'sheet'):
+            target = targets.get(sheet.get(RELATIONSHIP_NS + 'id'), '')
+            # targets are relative to xl/ unless absolute
+            sheet_parts[sheet.get('name')] = target.lstrip('/') if target.startswith('/') else \
+                posixpath.normpath(posixpath.join('xl', target))
+        return sheet_parts
+
+    @property
+    def sheet_names(self):
+        # the sheets of the workbook, including the ones added (but not saved yet)
+        return list(self.sheet_parts) + [sheet_name for sheet_name in self.new_sheets
+                                         if sheet_name not in self.sheet_parts]
+
+    def add_sheet(self, sheet_name, header_sheet_name=None):
+        """
+        Add a sheet, with the header row (values and styles) of the given existing sheet as its first row.
+        The workbook is only changed by save.
+        """
+        if sheet_name in self.sheet_names:
+            raise ValueError(f"Sheet {sheet_name} exists already")
+        if header_sheet_name is not None and header_sheet_name not in self.sheet_parts:
+            raise ValueError(f"No sheet {header_sheet_name} to copy the header from")
+        self.new_sheets[sheet_name] = header_sheet_name
+
+    def get_sheet_xml(self, sheet_name):
+        if sheet_name not in self.sheet_xmls:
+            with zipfile.ZipFile(self.path) as workbook_zip:
+                self.sheet_xmls[sheet_name] = workbook_zip.read(self.sheet_parts[sheet_name])
+        return self.sheet_xmls[sheet_name]
+
+    def get_row_count(self, sheet_name):
+        """
+        The number of the last row of the sheet (0 for an empty sheet, or a new one without header), including
+        rows appended before.
+        """
+        if sheet_name in self.new_rows:
+            first_row, rows, _ = self.new_rows[sheet_name]
+            return first_row + len(rows) - 1
+        if sheet_name in self.new_sheets:
+            return 1 if self.new_sheets[sheet_name] is not None else 0
+        if sheet_name not in self.sheet_parts:
+            return 0
+        sheet_xml = self.get_sheet_xml(sheet_name)
+        sheet_data_end = sheet_xml.rfind(b'</sheetData>')
+        if sheet_data_end < 0:
+            if sheet_xml.count(b'<sheetData/>') == 1:
+                return 0
+            # count with openpyxl (the workbook is then saved with openpyxl as well)
+            return self.get_workbook()[sheet_name].max_row
+        row_start = sheet_xml.rfind(b'<row ', 0, sheet_data_end)
+        match = row_start_re.match(sheet_xml, row_start) if row_start >= 0 else None
+        return int(match.group(1)) if match else 0
+
+    def append_rows(self, sheet_name, rows, percent_columns=()):
+        """
+        Add the rows after the last row of the sheet (created if needed), formatting the cells of the given
+        columns (letters) as percentages. The workbook is only changed by save.
+        """
+        percent_columns = {column_index_from_string(column) for column in percent_columns}
+        if sheet_name in self.new_rows:
+            first_row, appended_rows, appended_percent_columns = self.new_rows[sheet_name]
+            if appended_percent_columns != percent_columns:
+                raise ValueError(f"Rows of {sheet_name} appended with different percentage columns")
+            appended_rows.extend(rows)
+        else:
+            self.new_rows[sheet_name] = (self.get_row_count(sheet_name) + 1, list(rows), percent_columns)
+
+    def save(self):
+        if not self.new_rows and not self.new_sheets:
+            return
+        try:
+            new_sheet_names = set(self.new_sheets) | (set(self.new_rows) - set(self.sheet_parts))
+            if new_sheet_names:
+                raise UnexpectedWorkbookError(f"New sheets {new_sheet_names}")
+            if self.workbook is not None:
+                raise UnexpectedWorkbookError("Unexpected sheet data")
+            self.save_incremental()
+        except UnexpectedWorkbookError as error:
+            if self.logger:
+                self.logger.info(f"Updating the whole workbook: {error}")
+            self.save_with_openpyxl()
+        self.new_rows.clear()
+        self.new_sheets.clear()
+        self.sheet_xmls.clear()
+        self.sheet_parts = self.read_sheet_parts()
+        self.workbook = None
+
+    def save_incremental(self):
+        with zipfile.ZipFile(self.path) as workbook_zip:
+            styles_xml, percent_style_id = get_percent_style(workbook_zip.read('xl/styles.xml'))
+            changed_parts = {'xl/styles.xml': styles_xml}
+            for sheet_name, (first_row, rows, percent_columns) in self.new_rows.items():
+                rows_xml = get_rows_xml(rows, first_row, percent_columns, percent_style_id)
+                last_column = max((len(row) for row in rows), default=1)
+                changed_parts[self.sheet_parts[sheet_name]] = \
+                    self.get_appended_sheet_xml(sheet_name, rows_xml, first_row + len(rows) - 1, last_column)
+
+            # write a new workbook next to the old one and replace it, so the workbook is never left half written
+            with zipfile.ZipFile(self.path + '.tmp', 'w') as new_workbook_zip:
+                for part in workbook_zip.infolist():
+                    new_workbook_zip.writestr(part, changed_parts.get(part.filename) or workbook_zip.read(part))
+        os.replace(self.path + '.tmp', self.path)
+
+    def get_appended_sheet_xml(self, sheet_name, rows_xml, last_row, last_column):
+        sheet_xml = self.get_sheet_xml(sheet_name)
+        sheet_data_end = sheet_xml.rfind(b'</sheetData>')
+        if sheet_data_end >= 0:
+            sheet_xml = sheet_xml[:sheet_data_end] + rows_xml + sheet_xml[sheet_data_end:]
+        else:
+            sheet_xml = sheet_xml.replace(b'<sheetData/>', b'<sheetData>' + rows_xml + b'</sheetData>')
+
+        # extend the used range of the sheet to the new rows
+        dimension = dimension_re.search(sheet_xml)
+        if dimension:
+            first_column, first_row, old_last_column, _ = dimension.groups()
+            last_column = max(last_column, column_index_from_string((old_last_column or first_column).decode()))
+            new_dimension = b'<dimension ref="%s%s:%s%d"' % (first_column, first_row,
+                                                              get_column_letter(last_column).encode(), last_row)
+            sheet_xml = sheet_xml[:dimension.start()] + new_dimension + sheet_xml[dimension.end():]
+        return sheet_xml
+
+    def get_workbook(self):
+        if self.workbook is None:
+            self.workbook = load_workbook(self.path)
+        return self.workbook
+
+    def save_with_openpyxl(self):
+        workbook = self.get_workbook()
+        for sheet_name, header_sheet_name in self.new_sheets.items():
+            worksheet = workbook.create_sheet(sheet_name)
+            if header_sheet_name is not None:
+                for header_cell in next(workbook[header_sheet_name].iter_rows(min_row=1, max_row=1), ()):
+                    cell = worksheet.cell(row=1, column=header_cell.column, value=header_cell.value)
+                    if header_cell.has_style:
+                        cell._style = copy.copy(header_cell._style)
+        for sheet_name, (first_row, rows, percent_columns) in self.new_rows.items():
+            worksheet = workbook[sheet_name] if sheet_name in workbook.sheetnames else \
+                workbook.create_sheet(sheet_name)
+            for row_number, row in enumerate(rows, start=first_row):
+                for column_number, value in enumerate(row, start=1):
+                    cell = worksheet.cell(row=row_number, column=column_number, value=value)
+                    if column_number in percent_columns:
+                        cell.number_format = PERCENT_FORMAT
+        workbook.save(self.path)
@@ -0,0 +1,166 @@
+"""
+Synthetic SampleSheets and matching tracking sheet data for benchmarking the samplesheet check offline.
+
+The generated sheets resemble the sheets of the pipeline runs: samples spread over the lanes
+(some on more than one lane), dual and single indexed TruSeq libraries with different index
+lengths (shorter ones padded with Ns), 10X libraries and topups of earlier libraries. All samples
+have a record in the generated tracking sheet tab of their year, which also contains records of
+libraries that are not on the sheet, and all metadata values are allowed by the generated
+validation tab. Index combinations are unique per lane, so the sheets pass the parser validation.
+"""
+import random
+import pandas
+from samplesheet import SampleSheet, Section, DataTable
+from tracking_sheet import project_columns
+
+YEAR = '2021'
+LANES = ['1', '2', '3', '4']
+data_column_names = ('Lane', 'Sample_ID', 'Sample_Name', 'Sample_Plate', 'Sample_Well', 'I7_Index_ID', 'index',
+                     'I5_Index_ID', 'index2', 'Sample_Project', 'Description')
+# (library type, i7 length, i5 length, i7 padding with Ns, weight)
+index_profiles = (
+    ('WGS', 8, 8, 0, 50),
+    ('WTS', 8, 8, 2, 15),
+    ('WGS', 10, 10, 0, 10),
+    ('WTS', 6, 8, 2, 5),
+    ('ctTSO', 8, 0, 0, 5),
+    ('10X', 8, 0, 0, 15))
+validation_values = {
+    'PhenotypeValues': ['tumor', 'normal', 'negative-control'],
+    'QualityValues': ['good', 'poor', 'borderline'],
+    'SourceValues': ['tissue', 'FFPE', 'blood', 'cfDNA'],
+    'TypeValues': ['WGS', 'WTS', 'ctTSO', '10X'],
+    'ProjectNameValues': [f"Project{number:02d}" for number in range(40)],
+    'ProjectOwnerValues': [f"Owner{number:02d}" for number in range(10)]}
+
+
+def get_random_index(rnd, length):
+    return ''.join(rnd.choice('ACGT') for _ in range(length))
+
+
+def get_library_id(number):
+    return f"L{YEAR[2:]}{number:05d}"
+
+
+def generate_samples(sample_count, seed=0, topup_fraction=0.05, multi_lane_fraction=0.1):
+    """
+    Generate the [Data] rows (dicts by column name) for a sheet with (about) the given number of samples.
+    """
+    rnd = random.Random(seed)
+    profiles = [profile[:4] for profile in index_profiles]
+    weights = [profile[4] for profile in index_profiles]
+    used_indexes = set()  # (lane, index, index2)
+    samples = list()
+    for number in range(sample_count):
+        library_type, i7_length, i5_length, padding = rnd.choices(profiles, weights)[0]
+        library_id = get_library_id(number)
+        sample_id = f"PRJ{YEAR[2:]}{number % 10000:04d}"
+        if number > 0 and rnd.random() < topup_fraction:
+            # a topup of an earlier library (the primary library itself is not on this sheet)
+            library_id = get_library_id(sample_count + number) + '_topup'
+        lanes = rnd.sample(LANES, 2 if rnd.random() < multi_lane_fraction else 1)
+
+        while True:
+            index = get_random_index(rnd, i7_length) + 'N' * padding
+            index2 = get_random_index(rnd, i5_length)
+            if not any((lane, index, index2) in used_indexes for lane in lanes):
+                break
+        if library_type == '10X':
+            i7_index_id = f"SI-GA-{rnd.choice('ABCDEFGH')}{rnd.randint(1, 12)}"
+        else:
+            i7_index_id = f"UDP{number % 384:04d}"
+
+        for lane in sorted(lanes):
+            used_indexes.add((lane, index, index2))
+            samples.append({
+                'Lane': lane,
+                'Sample_ID': f"{sample_id}_{library_id}",
+                'Sample_Name': library_id,
+                'Sample_Plate': '',
+                'Sample_Well': '',
+                'I7_Index_ID': i7_index_id,
+                'index': index,
+                'I5_Index_ID': i7_index_id if index2 else '',
+                'index2': index2,
+                'Sample_Project': library_type,
+                'Description': ''})
+    samples.sort(key=lambda sample: sample['Lane'])
+    return samples
+
+
+def get_samplesheet(samples):
+    sections = {
+        'Header': Section([('IEMFileVersion', '5'), ('Experiment Name', 'Synthetic'), ('Date', '1/01/2021'),
+                           ('Workflow', 'GenerateFASTQ'), ('Application', 'NovaSeq FASTQ Only'),
+                           ('Instrument Type', 'NovaSeq'), ('Assay', 'TruSeq Nano DNA'),
+                           ('Index Adapters', 'IDT-ILMN TruSeq DNA UD Indexes (96 Indexes)'),
+                           ('Chemistry', 'Amplicon')]),
+        'Reads': ['151', '151'],
+        'Settings': Section([('Adapter', 'AGATCGGAAGAGCACACGTCTGAACTCCAGTCA'),
+                             ('AdapterRead2', 'AGATCGGAAGAGCGTCGTGTAGGGAAAGAGTGT')]),
+        'Data': DataTable.from_columns({column_name: [sample[column_name] for sample in samples]
+                                        for column_name in data_column_names})}
+    return SampleSheet(sections)
+
+
+def write_samplesheet(path, samples):
+    with open(path, 'w', newline='') as samplesheet_file:
+        get_samplesheet(samples).write(samplesheet_file)
+
+
+def get_tracking_sheets(samples, background_records=5000, seed=0):
+    """
+    The tracking sheet tabs (tab name -> DataFrame of strings) for the given samples: the tab of the year with
+    one record per library (incl. the primary libraries of topups) plus background records, and the validation tab.
+    """
+    rnd = random.Random(seed)
+    library_types = dict()
+    for sample in samples:
+        library_types[sample['Sample_Name']] = (sample['Sample_ID'].split('_')[0], sample['Sample_Project'])
+        if sample['Sample_Name'].endswith('_topup'):
+            library_types[sample['Sample_Name'][:-len('_topup')]] = library_types[sample['Sample_Name']]
+    last_number = max([int(library_id[3:8]) for library_id in library_types] + [0])
+    for number in range(last_number + 1, last_number + 1 + background_records):
+        library_types[get_library_id(number)] = (f"PRJ{YEAR[2:]}{number % 10000:04d}", 'WGS')
+
+    records = list()
+    for library_id, (sample_id, library_type) in library_types.items():
+        records.append({
+            'LibraryID': library_id,
+            'SampleName': f"{sample_id}_{rnd.randint(1, 9)}",
+            'SampleID': sample_id,
+            'ExternalSampleID': f"EXT{rnd.randint(0, 99999):05d}",
+            'SubjectID': f"SBJ{rnd.randint(0, 9999):05d}",
+            'ExternalSubjectID': f"EXT-SBJ{rnd.randint(0, 9999):04d}",
+            'Phenotype': rnd.choice(validation_values['PhenotypeValues']),
+            'Quality': rnd.choice(validation_values['QualityValues']),
+            'Source': rnd.choice(validation_values['SourceValues']),
+            'ProjectName': rnd.choice(validation_values['ProjectNameValues']),
+            'ProjectOwner': rnd.choice(validation_values['ProjectOwnerValues']),
+            'Type': library_type,
+            'Assay': 'TsqNano',
+            'OverrideCycles': 'Y151;I8;I8;Y151',
+            'Workflow': 'clinical'})
+    rnd.shuffle(records)
+
+    # the named ranges of the validation tab are columns of different lengths, padded with empty values
+    rows = max(len(values) for values in validation_values.values())
+    validation_df = pandas.DataFrame({column_name: values + [''] * (rows - len(values))
+                                      for column_name, values in validation_values.items()})
+    return {YEAR: pandas.DataFrame(records), 'Validation': validation_df}
+
+
+class FixtureTrackingSheets:
+    """
+    Offline stand-in for the TrackingSheetCache, serving the given tracking sheet tabs.
+    """
+
+    def __init__(self, sheets):
+        self.sheets = sheets
+
+    def get_sheet(self, sheet_name, column_names=None, categorical_column_names=()):
+        return project_columns(self.sheets[sheet_name], column_names, categorical_column_names)
+
+    def get_sheets(self, sheet_names, column_names=None, categorical_column_names=()):
+        return {sheet_name: self.get_sheet(sheet_name, column_names, categorical_column_names)
+                for sheet_name in sheet_names}
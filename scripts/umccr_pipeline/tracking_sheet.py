@@ -0,0 +1,213 @@
+"""
+Access to the lab library tracking sheet (Google Sheets) shared by the pipeline scripts.
+
+Downloading a (year) tab of the tracking sheet is slow and the pipeline steps that need it run only
+minutes apart. Therefore each downloaded tab is kept as a local Parquet snapshot, keyed by spreadsheet
+ID and tab name, and is only downloaded again if the spreadsheet has been modified since the snapshot
+was taken. Google Drive only reports modifications for the spreadsheet as a whole, so a change to any
+tab invalidates the snapshots of all tabs taken before that change.
+
+The scripts only use some of the (many) columns of a tab. If the needed columns are given, the header row
+of the tab is read first and only those columns are fetched, in one batched request. Low cardinality
+columns (e.g. Type or Phenotype) can be requested as categoricals to keep the loaded tabs small.
+"""
+import os
+import json
+import logging
+import pandas
+from concurrent.futures import ThreadPoolExecutor
+from gspread.utils import rowcol_to_a1
+from gspread_pandas import Spread
+from sheets_client import SheetsClient, call_api
+
+# where the snapshots are kept, one sub-directory per spreadsheet
+CACHE_DIR = os.getenv('TRACKING_SHEET_CACHE_DIR',
+                      os.path.join(os.path.expanduser('~'), '.cache', 'umccr_pipeline', 'tracking_sheets'))
+MAX_CONCURRENT_DOWNLOADS = 4  # tabs loaded at the same time by get_sheets
+
+
+def get_sheet_range(sheet_name, cells):
+    # A1 notation for the cells of the tab, e.g. 'Sheet 1'!1:1
+    quoted_sheet_name = sheet_name.replace("'", "''")
+    return f"'{quoted_sheet_name}'!{cells}"
+
+
+def get_column_range(sheet_name, column_number, first_row=2):
+    # the (open ended) column of the tab, e.g. 'Sheet 1'!C2:C
+    column_letter = rowcol_to_a1(1, column_number)[:-1]
+    return get_sheet_range(sheet_name, f"{column_letter}{first_row}:{column_letter}")
+
+
+def covers_columns(loaded_column_names, column_names):
+    # whether a tab loaded with the given columns (None: all columns) has the requested columns
+    return loaded_column_names is None or (column_names is not None and set(column_names) <= set(loaded_column_names))
+
+
+def project_columns(sheet_df, column_names=None, categorical_column_names=()):
+    # the given columns of the tab (those it has, in the given order), with the given columns as categoricals
+    if column_names is not None:
+        sheet_df = sheet_df[[column_name for column_name in column_names if column_name in sheet_df.columns]]
+    categorical_columns = [column_name for column_name in categorical_column_names
+                           if column_name in sheet_df.columns and sheet_df[column_name].dtype != 'category']
+    if categorical_columns:
+        sheet_df = sheet_df.astype({column_name: 'category' for column_name in categorical_columns})
+    return sheet_df
+
+
+class TrackingSheetCache:
+
+    def __init__(self, spreadsheet_id, cache_dir=CACHE_DIR, logger=None):
+        self.spreadsheet_id = spreadsheet_id
+        self.cache_dir = os.path.join(cache_dir, spreadsheet_id)
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.spread = None
+        self.sheets_client = None
+        self.sheets = {}  # tab name -> (modified time, column names, dataframe) of the tabs loaded by this process
+
+    def get_spread(self):
+        # authenticate once and reuse the client for all requests
+        if self.spread is None:
+            self.spread = call_api('open_spread', Spread, self.spreadsheet_id, logger=self.logger)
+        return self.spread
+
+    def get_sheets_client(self):
+        # rate limited and retrying access to the values of the spreadsheet
+        if self.sheets_client is None:
+            self.sheets_client = SheetsClient(self.get_spread().spread, logger=self.logger)
+        return self.sheets_client
+
+    def get_modified_time(self):
+        # the modifiedTime of the spreadsheet from the Drive API (incl. shared drives)
+        return call_api('drive_modified_time', self.get_spread().spread.get_lastUpdateTime, logger=self.logger)
+
+    def get_snapshot_paths(self, sheet_name):
+        snapshot_name = sheet_name.replace(os.sep, '_')
+        return (os.path.join(self.cache_dir, snapshot_name + '.parquet'),
+                os.path.join(self.cache_dir, snapshot_name + '.json'))
+
+    def read_snapshot(self, sheet_name, modified_time, column_names=None):
+        data_path, meta_path = self.get_snapshot_paths(sheet_name)
+        try:
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            if meta.get('modified_time') != modified_time:
+                self.logger.debug(f"Snapshot of {sheet_name} is outdated ({meta.get('modified_time')})")
+                return None
+            if not covers_columns(meta.get('columns'), column_names):
+                self.logger.debug(f"Snapshot of {sheet_name} lacks some of the columns {column_names}")
+                return None
+            return pandas.read_parquet(data_path)
+        except FileNotFoundError:
+            self.logger.debug(f"No snapshot for {sheet_name}")
+        except (ImportError, ValueError, OSError) as error:
+            self.logger.warning(f"Could not read snapshot of {sheet_name}: {error}")
+        return None
+
+    def write_snapshot(self, sheet_name, modified_time, column_names, sheet_df):
+        # write to temporary files first and replace the snapshot (data before metadata),
+        # so concurrent readers never see a partial or mismatched snapshot
+        data_path, meta_path = self.get_snapshot_paths(sheet_name)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            sheet_df.to_parquet(data_path + '.tmp', index=False)
+            os.replace(data_path + '.tmp', data_path)
+            with open(meta_path + '.tmp', 'w') as meta_file:
+                json.dump({'modified_time': modified_time, 'columns': column_names, 'records': len(sheet_df.index)},
+                          meta_file)
+            os.replace(meta_path + '.tmp', meta_path)
+        except (ImportError, ValueError, OSError) as error:
+            self.logger.warning(f"Could not write snapshot of {sheet_name}: {error}")
+
+    def download_columns(self, sheet_name, column_names):
+        # resolve the positions of the columns from the header row, then fetch only those columns
+        spreadsheet = self.get_sheets_client()
+        header_range = spreadsheet.values_get(get_sheet_range(sheet_name, '1:1'))
+        header = header_range.get('values', [[]])[0]
+        column_numbers = dict()
+        for column_number, column_name in enumerate(header, start=1):
+            column_numbers.setdefault(column_name, column_number)
+        found_column_names = [column_name for column_name in column_names if column_name in column_numbers]
+
+        columns = dict()
+        if found_column_names:
+            ranges = [get_column_range(sheet_name, column_numbers[column_name]) for column_name in found_column_names]
+            value_ranges = spreadsheet.values_batch_get(ranges, params={'majorDimension': 'COLUMNS'})['valueRanges']
+            for column_name, value_range in zip(found_column_names, value_ranges):
+                columns[column_name] = value_range.get('values', [[]])[0]
+        # empty cells at the end of a column are not returned, pad all columns to the same length
+        row_count = max((len(values) for values in columns.values()), default=0)
+        return pandas.DataFrame({column_name: values + [''] * (row_count - len(values))
+                                 for column_name, values in columns.items()}, columns=found_column_names)
+
+    def get_sheet(self, sheet_name, column_names=None, categorical_column_names=(), modified_time=None):
+        """
+        Return the tab with the given name as a DataFrame (all values as strings, as from gspread_pandas),
+        from memory or disk if it has not been modified since, otherwise from Google. If column names are given,
+        only those columns are loaded (and returned). The categorical columns are returned as categoricals.
+        """
+        if modified_time is None:
+            modified_time = self.get_modified_time()
+        column_names = list(column_names) if column_names is not None else None
+
+        loaded = self.sheets.get(sheet_name)
+        if loaded and loaded[0] == modified_time and covers_columns(loaded[1], column_names):
+            self.logger.debug(f"Using loaded copy of {sheet_name}")
+            return project_columns(loaded[2], column_names, categorical_column_names)
+
+        sheet_df = self.read_snapshot(sheet_name, modified_time, column_names)
+        if sheet_df is not None:
+            self.logger.info(f"Using snapshot of {sheet_name} (last modified {modified_time})")
+        elif column_names is None:
+            self.logger.info(f"Downloading {sheet_name} (last modified {modified_time})")
+            sheet_df = call_api('sheet_to_df', self.get_spread().sheet_to_df, sheet=sheet_name, index=0, header_rows=1,
+                                start_row=1, logger=self.logger)
+            self.write_snapshot(sheet_name, modified_time, column_names, sheet_df)
+        else:
+            self.logger.info(f"Downloading {len(column_names)} columns of {sheet_name} (last modified {modified_time})")
+            sheet_df = project_columns(self.download_columns(sheet_name, column_names),
+                                       categorical_column_names=categorical_column_names)
+            self.write_snapshot(sheet_name, modified_time, column_names, sheet_df)
+
+        self.sheets[sheet_name] = (modified_time, column_names, sheet_df)
+        return project_columns(sheet_df, column_names, categorical_column_names)
+
+    def get_sheets(self, sheet_names, column_names=None, categorical_column_names=()):
+        """
+        Return the tabs with the given names (tab name -> DataFrame) as get_sheet does, loading them concurrently.
+        """
+        # one modification check for all tabs, which also authenticates before the client is shared by the threads
+        modified_time = self.get_modified_time()
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS) as executor:
+            futures = {sheet_name: executor.submit(self.get_sheet, sheet_name, column_names, categorical_column_names,
+                                                   modified_time)
+                       for sheet_name in sheet_names}
+        return {sheet_name: future.result() for sheet_name, future in futures.items()}
+
+
+class LibraryIndex:
+    """
+    Index of the rows of a tracking sheet tab by library ID, so that metadata lookups don't need to scan the
+    whole tab. Library IDs that appear in more than one row are recorded while the index is built.
+    """
+
+    def __init__(self, sheet_df, library_id_column_name='LibraryID'):
+        self.sheet_df = sheet_df
+        self.positions = {}  # library ID -> row positions in sheet_df
+        self.duplicates = set()  # library IDs with more than one row
+        for position, library_id in enumerate(sheet_df[library_id_column_name].values):
+            if library_id in self.positions:
+                self.positions[library_id].append(position)
+                if library_id:
+                    self.duplicates.add(library_id)
+            else:
+                self.positions[library_id] = [position]
+
+    def __contains__(self, library_id):
+        return library_id in self.positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    def get_rows(self, library_id):
+        # all rows for the library ID (as a DataFrame, which is empty if the ID is unknown)
+        return self.sheet_df.iloc[self.positions.get(library_id, [])]
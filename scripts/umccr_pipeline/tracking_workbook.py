@@ -0,0 +1,79 @@
+"""
+Reading of the tracking sheet from an Excel export (workbook), shared by the showcase scripts.
+
+The year sheets of the workbook are concatenated into one DataFrame. Parsing the workbook is slow, so only the
+needed columns are read, and the result is kept as a local Parquet copy, keyed by the content (SHA-256) of the
+workbook and the requested columns and sheets. The same workbook (even a new download of it) is only parsed once.
+"""
+import os
+import json
+import hashlib
+import logging
+import pandas
+
+# where the parsed workbooks are kept (next to the Google Sheets snapshots of tracking_sheet.py)
+CACHE_DIR = os.path.join(os.getenv('TRACKING_SHEET_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache',
+                                                                            'umccr_pipeline', 'tracking_sheets')),
+                         'workbooks')
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def get_content_hash(path):
+    content_hash = hashlib.sha256()
+    with open(path, 'rb') as workbook_file:
+        for block in iter(lambda: workbook_file.read(HASH_BLOCK_SIZE), b''):
+            content_hash.update(block)
+    return content_hash.hexdigest()
+
+
+def get_year_sheet_names(sheet_names, omitted_sheet_names=()):
+    # the (numeric) year sheets, e.g. 2019, 2020, ...
+    return [sheet_name for sheet_name in sheet_names
+            if sheet_name.isnumeric() and sheet_name not in omitted_sheet_names]
+
+
+def parse_workbook(path, column_names=None, omitted_sheet_names=(), logger=None):
+    logger = logger if logger else logging.getLogger(__name__)
+    logger.info("Loading excel file")
+    with pandas.ExcelFile(path) as workbook:
+        sheet_names = get_year_sheet_names(workbook.sheet_names, omitted_sheet_names)
+        if not sheet_names:
+            raise ValueError(f"Could not find any valid sheet names in {path}")
+        # columns missing in a sheet are left out (not an error), like DataFrame.filter does
+        usecols = (lambda column_name: column_name in column_names) if column_names is not None else None
+        sheets = []
+        for sheet_name in sheet_names:
+            logger.info("Reading sheet %s" % sheet_name)
+            sheets.append(workbook.parse(header=0, sheet_name=sheet_name, usecols=usecols))
+    return pandas.concat(sheets)
+
+
+def read_tracking_workbook(path, column_names=None, omitted_sheet_names=(), cache_dir=CACHE_DIR, logger=None):
+    """
+    Return the year sheets of the workbook (with only the given columns, if given) as one DataFrame, from the
+    local copy if the workbook was read before. Raises ValueError if the workbook has no year sheets.
+    """
+    logger = logger if logger else logging.getLogger(__name__)
+    column_names = list(column_names) if column_names is not None else None
+    key = {'workbook': get_content_hash(path), 'columns': column_names, 'omitted_sheets': sorted(omitted_sheet_names)}
+    key_hash = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+    cache_path = os.path.join(cache_dir, key_hash + '.parquet')
+
+    try:
+        tracking_df = pandas.read_parquet(cache_path)
+        logger.info(f"Using the copy of {path} read before")
+        return tracking_df
+    except FileNotFoundError:
+        pass
+    except (ImportError, ValueError, OSError) as error:
+        logger.warning(f"Could not read the copy of {path}: {error}")
+
+    tracking_df = parse_workbook(path, column_names, omitted_sheet_names, logger=logger)
+    try:
+        # write to a temporary file first, so concurrent readers never see a partial copy
+        os.makedirs(cache_dir, exist_ok=True)
+        tracking_df.to_parquet(cache_path + '.tmp')
+        os.replace(cache_path + '.tmp', cache_path)
+    except (ImportError, ValueError, TypeError, OSError) as error:
+        logger.warning(f"Could not keep a copy of {path}: {error}")
+    return tracking_df
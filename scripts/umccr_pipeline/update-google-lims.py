@@ -5,11 +5,17 @@ import re
 import csv
 from glob import glob
 from datetime import datetime
-from sample_sheet import SampleSheet
+from samplesheet import read_samplesheet
+import time
 import logging
+import requests
 from logging.handlers import RotatingFileHandler
 import gspread  # maybe move to https://github.com/aiguofer/gspread-pandas
-from gspread_pandas import Spread
+from gspread.exceptions import APIError
+from gspread.utils import rowcol_to_a1
+from tracking_sheet import TrackingSheetCache, LibraryIndex, get_sheet_range
+from sheets_client import SheetsClient, call_api, log_call_stats, is_retryable, get_backoff, get_status_code
+from fastq_index import FastqIndex, get_index_path
 from oauth2client.service_account import ServiceAccountCredentials
 
 import warnings
@@ -20,11 +26,14 @@ warnings.simplefilter("ignore")
 
 SHEET_NAME_RUNS = 'Sheet1'
 SHEET_NAME_FAILED = 'Failed Runs'
+LIMS_ROWS_PER_REQUEST = 500  # rows read or written per request, to stay within the API payload limits
+LIMS_APPEND_ATTEMPTS = 4  # appends of rows, checking which rows are still missing before each repetition
 DEPLOY_ENV = os.getenv('DEPLOY_ENV')
 if not DEPLOY_ENV:
     raise ValueError("DEPLOY_ENV needs to be set!")
 SCRIPT = os.path.basename(__file__)
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+CONSOLE_LOG_LEVEL = logging.DEBUG  # what is logged to the console (and returned by the validation service)
 
 # The column names of the Google LIMS (in order!)
 # Names and values should be kept in sync between the lab internal library tracking sheet and the Google LIMS
@@ -75,6 +84,13 @@ metadata_column_names = (
     override_cycles_column_name,
     workflow_column_name
 )
+# Low cardinality columns of the tracking sheet, loaded as categoricals
+categorical_column_names = (
+    type_column_name,
+    phenotype_column_name,
+    source_column_name,
+    quality_column_name
+)
 # Instrument ID mapping
 instrument_name = {
     "A01052": "Po",
@@ -112,6 +128,27 @@ sheet_column_headers = (
     trello_column_name,
     notes_column_name,
     todo_column_name)
+# The columns identifying a LIMS row (a library of a run)
+lims_key_column_names = (illumina_id_column_name, library_id_column_name)
+# The columns derived from the tracking sheet and the FASTQs, the only ones updated in existing LIMS rows. The other
+# columns identify the row, are given by the run (Run, Timestamp) or are edited by hand ('-' in new rows).
+updated_column_names = (
+    subject_id_column_name,
+    sample_id_column_name,
+    subject_ext_id_column_name,
+    sample_ext_id_column_name,
+    sample_name_column_name,
+    project_owner_column_name,
+    project_name_column_name,
+    type_column_name,
+    assay_column_name,
+    override_cycles_column_name,
+    phenotype_column_name,
+    source_column_name,
+    quality_column_name,
+    workflow_column_name,
+    fastq_column_name,
+    number_fastqs_column_name)
 
 # define argument defaults
 if DEPLOY_ENV == 'prod':
@@ -131,10 +168,7 @@ else:
 runfolder_name_expected_length = 29
 fastq_hpc_base_dir = 's3://umccr-fastq-data-prod/'
 csv_outdir = '/tmp'
-write_csv = False
 creds_file = "/home/limsadmin/.google/google-lims-updater-b50921f70155.json"
-skip_lims_update = False
-failed_run = False
 
 # pre-compile regex patterns
 runfolder_pattern = re.compile('([12][0-9][01][0-9][0123][0-9])_(A01052|A00130)_([0-9]{4})_[A-Z0-9]{10}')
@@ -157,7 +191,7 @@ def getLogger():
 
     # create a console handler
     console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.DEBUG)
+    console_handler.setLevel(CONSOLE_LOG_LEVEL)
     console_handler.setFormatter(formatter)
 
     # add the handlers to the logger
@@ -175,28 +209,40 @@ def get_year_from_lib_id(library_id):
         return '20' + library_id[1:3]
 
 
-def get_library_sheet_from_google(year):
-    logger.info(f"Loading tracking data for year {year}")
-    spread = Spread(lab_spreadsheet_id)
-    library_tracking_spreadsheet_df = spread.sheet_to_df(sheet=year, index=0, header_rows=1, start_row=1)
-    hit = library_tracking_spreadsheet_df.iloc[0]
-    logger.debug(f"First record: {hit}")
-    for column_name in metadata_column_names:
-        logger.debug(f"Checking for column name {column_name}...")
-        if column_name not in hit:
-            logger.error(f"Could not find column {column_name}. The file is not structured as expected! Aborting.")
-            exit(-1)
-    logger.info(f"Loaded {len(library_tracking_spreadsheet_df.index)} records from library tracking sheet.")
-    return library_tracking_spreadsheet_df
+def get_library_sheets_from_google(years):
+    # the tabs of the years are loaded concurrently
+    logger.info(f"Loading tracking data for years {years}")
+    library_tracking_spreadsheet_dfs = tracking_sheet_cache.get_sheets(
+        years, column_names=metadata_column_names, categorical_column_names=categorical_column_names)
+    for year, library_tracking_spreadsheet_df in library_tracking_spreadsheet_dfs.items():
+        hit = library_tracking_spreadsheet_df.iloc[0]
+        logger.debug(f"First record: {hit}")
+        for column_name in metadata_column_names:
+            logger.debug(f"Checking for column name {column_name}...")
+            if column_name not in hit:
+                logger.error(f"Could not find column {column_name} for year {year}. " +
+                             "The file is not structured as expected! Aborting.")
+                exit(-1)
+        logger.info(f"Loaded {len(library_tracking_spreadsheet_df.index)} records of year {year} " +
+                    "from library tracking sheet.")
+    return library_tracking_spreadsheet_dfs
+
+
+def get_library_index(year, library_tracking_spreadsheet_df):
+    library_index = LibraryIndex(library_tracking_spreadsheet_df, library_id_column_name)
+    if library_index.duplicates:
+        logger.warning(f"Library IDs with multiple entries for year {year}: {sorted(library_index.duplicates)}")
+    return library_index
 
 
 def get_meta_data_by_library_id(library_id):
     year = get_year_from_lib_id(library_id)
-    library_tracking_spreadsheet_df = library_tracking_spreadsheet.get(year)
-    try:
-        hit = library_tracking_spreadsheet_df[library_tracking_spreadsheet_df[library_id_column_name] == library_id]
-    except (KeyError, NameError, TypeError, Exception) as er:
-        logger.error(f"Error trying to find library ID {library_id}! Error: {er}")
+    library_index = library_tracking_spreadsheet.get(year)
+    if library_index is None:
+        logger.error(f"No tracking data loaded for year {year}, can't look up library ID {library_id}!")
+        hit = list()
+    else:
+        hit = library_index.get_rows(library_id)
 
     # We expect exactly one matching record, not more, not less!
     if len(hit) == 1:
@@ -218,32 +264,164 @@ def write_csv_file(output_file, column_headers, data_rows):
             sheetwriter.writerow(row)
 
 
-def next_available_row(worksheet):
-    str_list = list(filter(None, worksheet.col_values(1)))  # fastest
-    return len(str_list)+1
+def get_lims_client(keyfile):
+    # authorize once per credentials file (and process) and reuse the client
+    if keyfile not in lims_clients:
+        # follow example from:
+        # https://www.twilio.com/blog/2017/02/an-easy-way-to-read-and-write-to-a-google-spreadsheet-in-python.html
+        scope = ['https://www.googleapis.com/auth/drive']
+        creds = ServiceAccountCredentials.from_json_keyfile_name(keyfile, scope)
+        lims_clients[keyfile] = gspread.authorize(creds)
+    return lims_clients[keyfile]
 
 
-def write_to_google_lims(keyfile, lims_spreadsheet_id, data_rows, failed_run):
-    # follow example from:
-    # https://www.twilio.com/blog/2017/02/an-easy-way-to-read-and-write-to-a-google-spreadsheet-in-python.html
-    scope = ['https://www.googleapis.com/auth/drive']
-    creds = ServiceAccountCredentials.from_json_keyfile_name(keyfile, scope)
-    client = gspread.authorize(creds)
+def get_column_letter(column_name):
+    return rowcol_to_a1(1, sheet_column_headers.index(column_name) + 1)[:-1]
+
+
+def get_row_range(sheet_name, row_number, first_column_name=None, last_column_name=None):
+    # the cells of the row (from the first to the last column, by default all columns)
+    first_column_letter = get_column_letter(first_column_name or sheet_column_headers[0])
+    last_column_letter = get_column_letter(last_column_name or sheet_column_headers[-1])
+    return get_sheet_range(sheet_name, f"{first_column_letter}{row_number}:{last_column_letter}{row_number}")
 
+
+def get_column_blocks(column_names):
+    # the (first, last) column positions of the runs of adjacent columns among the given ones
+    positions = sorted(sheet_column_headers.index(column_name) for column_name in column_names)
+    blocks = []
+    for position in positions:
+        if blocks and blocks[-1][1] == position - 1:
+            blocks[-1] = (blocks[-1][0], position)
+        else:
+            blocks.append((position, position))
+    return blocks
+
+
+def is_same_value(value, sheet_value):
+    # values are written as USER_ENTERED, so numbers are read back formatted (e.g. 00123 as 123)
+    if str(value) == sheet_value:
+        return True
+    try:
+        return float(value) == float(sheet_value)
+    except (TypeError, ValueError):
+        return False
+
+
+def get_lims_key(row):
+    return tuple(str(row[sheet_column_headers.index(column_name)]) for column_name in lims_key_column_names)
+
+
+def get_chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def get_lims_key_index(spreadsheet, sheet_name):
+    # The row number of each key (IlluminaID, LibraryID) in the LIMS sheet, from a single request for the key columns
+    key_ranges = [get_sheet_range(sheet_name, f"{get_column_letter(column_name)}:{get_column_letter(column_name)}")
+                  for column_name in lims_key_column_names]
+    value_ranges = spreadsheet.values_batch_get(key_ranges, params={'majorDimension': 'COLUMNS'})['valueRanges']
+    key_columns = [value_range.get('values', [[]])[0] for value_range in value_ranges]
+    row_count = max(len(column) for column in key_columns)
+    key_columns = [column + [''] * (row_count - len(column)) for column in key_columns]
+
+    key_index = dict()
+    for row_number, key in enumerate(zip(*key_columns), start=1):
+        if row_number == 1 or not any(key):
+            continue  # the header and empty rows
+        if key in key_index:
+            logger.warning(f"LIMS row {row_number} duplicates row {key_index[key]}: {key}")
+        else:
+            key_index[key] = row_number
+    return key_index
+
+
+def get_changed_blocks(spreadsheet, sheet_name, rows_by_number):
+    # the blocks of (adjacent) updated columns (by row number) that differ from the values in the LIMS sheet
+    changed_blocks = dict()
+    column_blocks = get_column_blocks(updated_column_names)
+    row_numbers = sorted(rows_by_number)
+    for chunk in get_chunks(row_numbers, LIMS_ROWS_PER_REQUEST):
+        value_ranges = spreadsheet.values_batch_get([get_row_range(sheet_name, row_number) for row_number in chunk])
+        for row_number, value_range in zip(chunk, value_ranges['valueRanges']):
+            sheet_row = value_range.get('values', [[]])[0]
+            sheet_row = sheet_row + [''] * (len(sheet_column_headers) - len(sheet_row))
+            row = rows_by_number[row_number]
+            blocks = [(first, last) for first, last in column_blocks
+                      if not all(is_same_value(row[position], sheet_row[position])
+                                 for position in range(first, last + 1))]
+            if blocks:
+                changed_blocks[row_number] = blocks
+    return changed_blocks
+
+
+def write_to_google_lims(keyfile, lims_spreadsheet_id, data_rows, failed_run):
+    # Only rows of libraries (of the run) that are not in the LIMS yet are appended, rows that are but have changed
+    # are updated in place. So the update can be repeated, e.g. after a partial failure, without duplicating rows.
+    # Only the derived (updated) columns of existing rows are compared and written, the columns edited by hand are
+    # left as they are.
+    client = get_lims_client(keyfile)
+    spreadsheet = SheetsClient(call_api('open_by_key', client.open_by_key, lims_spreadsheet_id, logger=logger),
+                               logger=logger)
+    sheet_name = SHEET_NAME_FAILED if failed_run else SHEET_NAME_RUNS
+
+    rows = dict()
+    for row in data_rows:
+        key = get_lims_key(row)
+        if key in rows:
+            logger.warning(f"Multiple LIMS rows for {key}, using {row}")
+        rows[key] = row
+    key_index = get_lims_key_index(spreadsheet, sheet_name)
+    new_rows = [row for key, row in rows.items() if key not in key_index]
+    rows_by_number = {key_index[key]: row for key, row in rows.items() if key in key_index}
+    changed_blocks = get_changed_blocks(spreadsheet, sheet_name, rows_by_number)
+    logger.info(f"LIMS rows: {len(new_rows)} new, {len(changed_blocks)} changed, " +
+                f"{len(rows) - len(new_rows) - len(changed_blocks)} unchanged")
+
+    changed_row_numbers = sorted(changed_blocks)
+    for chunk in get_chunks(changed_row_numbers, LIMS_ROWS_PER_REQUEST):
+        spreadsheet.values_batch_update({
+            'valueInputOption': 'USER_ENTERED',
+            'data': [{'range': get_row_range(sheet_name, row_number, sheet_column_headers[first],
+                                             sheet_column_headers[last]),
+                      'majorDimension': 'ROWS',
+                      'values': [list(rows_by_number[row_number][first:last + 1])]}
+                     for row_number in chunk for first, last in changed_blocks[row_number]]
+        })
+
+    for chunk in get_chunks(new_rows, LIMS_ROWS_PER_REQUEST):
+        append_lims_rows(spreadsheet, sheet_name, chunk)
+
+
+def append_lims_rows(spreadsheet, sheet_name, rows):
+    # An append isn't idempotent: after a server error or timeout the rows may have been appended nevertheless.
+    # So the keys in the LIMS are read again and only the rows still missing are appended again.
     params = {
         'valueInputOption': 'USER_ENTERED',
         'insertDataOption': 'INSERT_ROWS'
     }
-    body = {
-        'majorDimension': 'ROWS',
-        'values': list(data_rows)
-    }
-
-    spreadsheet = client.open_by_key(lims_spreadsheet_id)
-    if failed_run:
-        spreadsheet.values_append(SHEET_NAME_FAILED, params, body)
-    else:
-        spreadsheet.values_append(SHEET_NAME_RUNS, params, body)
+    for attempt in range(LIMS_APPEND_ATTEMPTS):
+        body = {
+            'majorDimension': 'ROWS',
+            'values': [list(row) for row in rows]
+        }
+        try:
+            spreadsheet.values_append(get_sheet_range(sheet_name, 'A1'), params, body)
+            return
+        except (APIError, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+            if attempt == LIMS_APPEND_ATTEMPTS - 1 or not is_retryable(error):
+                raise
+            backoff = get_backoff(attempt)
+            reason = get_status_code(error) or type(error).__name__
+            logger.warning(f"Appending {len(rows)} LIMS rows failed ({reason}), checking for them in {backoff:.1f}s")
+            time.sleep(backoff)
+        key_index = get_lims_key_index(spreadsheet, sheet_name)
+        rows = [row for row in rows if get_lims_key(row) not in key_index]
+        if not rows:
+            logger.info("The LIMS rows were appended despite the error")
+            return
+        logger.info(f"Appending the {len(rows)} LIMS rows still missing")
 
 
 def split_at(s, c, n):
@@ -251,14 +429,7 @@ def split_at(s, c, n):
     return c.join(words[:n]), c.join(words[n:])
 
 
-if __name__ == "__main__":
-    logger = getLogger()
-    logger.info(f"Invocation with parameters: {sys.argv[1:]}")
-
-    ################################################################################
-    # argument parsing
-
-    logger.debug("Setting up argument parser.")
+def get_arg_parser():
     parser = argparse.ArgumentParser(description='Generate data for LIMS spreadsheet.')
     parser.add_argument('runfolder',
                         help="The run/runfolder name.")
@@ -286,28 +457,12 @@ if __name__ == "__main__":
                         help="Use this flag to skip the update of the Google LIMS.")
     parser.add_argument('--failed-run', action='store_true',
                         help="Use this flag to indicate a failed run (updates the Failed Runs sheet).")
+    return parser
 
-    logger.debug("Parsing arguments.")
-    args = parser.parse_args()
-    if args.raw_data_base_dir:
-        raw_data_base_dir = args.raw_data_base_dir
-    if args.bcl2fastq_base_dir:
-        bcl2fastq_base_dir = args.bcl2fastq_base_dir
-    if args.fastq_hpc_base_dir:
-        fastq_hpc_base_dir = args.fastq_hpc_base_dir
-    if args.csv_outdir:
-        csv_outdir = args.csv_outdir
-    if args.write_csv:
-        write_csv = True
-    if args.lims_spreadsheet_id:
-        lims_spreadsheet_id = args.lims_spreadsheet_id
-    if args.creds_file:
-        creds_file = args.creds_file
-    if args.skip_lims_update:
-        skip_lims_update = True
-    if args.failed_run:
-        failed_run = True
+
+def main(args):
     runfolder = args.runfolder
+    failed_run = args.failed_run
 
     # extract date and run number from runfolder name
     logger.debug("Parsing runfolder name.")
@@ -328,15 +483,7 @@ if __name__ == "__main__":
     logger.info(f"Extracted instrument ID: {run_inst_id} ({instrument_name[run_inst_id]})")
 
     # set raw data base path according to instrument
-    runfolder_base_dir = os.path.join(raw_data_base_dir, instrument_name[run_inst_id])
-
-    # load the library tracking sheet for the run year
-    logger.debug("Loading library tracking data.")
-    # global variables
-    # TODO: should be refactored in proper class variables
-    library_tracking_spreadsheet = dict()  # dict of sheets as dataframes
-    for year in ('2019', '2020', '2021'):  # TODO: this could be determined scanning though all SampleSheets
-        library_tracking_spreadsheet[year] = get_library_sheet_from_google(year)
+    runfolder_base_dir = os.path.join(args.raw_data_base_dir, instrument_name[run_inst_id])
 
     ################################################################################
     # Generate LIMS records from SampleSheet
@@ -355,24 +502,35 @@ if __name__ == "__main__":
         raise ValueError("No sample sheets found!")
     logger.info(f"Using {len(samplesheet_paths)} sample sheet(s).")
 
+    # read all sample sheets first, so only the tracking data of the years of their libraries is loaded
+    samplesheet_samples = dict()
     for samplesheet in samplesheet_paths:
+        samplesheet_samples[samplesheet] = read_samplesheet(samplesheet).samples
+    years = sorted({get_year_from_lib_id(sample.Sample_Name)
+                    for samples in samplesheet_samples.values() for sample in samples})
+    logger.debug("Loading library tracking data.")
+    for year, library_tracking_spreadsheet_df in get_library_sheets_from_google(years).items():
+        library_tracking_spreadsheet[year] = get_library_index(year, library_tracking_spreadsheet_df)
+
+    # index the FASTQs with one walk of the run's bcl2fastq output (instead of a directory listing per sample)
+    bcl2fastq_run_dir = os.path.join(args.bcl2fastq_base_dir, runfolder)
+    fastq_index = FastqIndex.build(bcl2fastq_run_dir)
+    logger.info(f"Indexed {sum(len(files) for files in fastq_index.fastqs.values())} FASTQs in {bcl2fastq_run_dir}")
+
+    for samplesheet, samples in samplesheet_samples.items():
         logger.info(f"Processing samplesheet {samplesheet}")
-        name, extension = os.path.splitext(samplesheet)
-        samples = SampleSheet(samplesheet).samples
         logger.info(f"Found {len(samples)} samples.")
         for sample in samples:
             logger.debug(f"Looking up metadata with {sample.Sample_Name} for samplesheet.Sample_ID (UMCCR SampleID); " +
                          f"{sample.Sample_ID} and samplesheet.sample_Name (UMCCR LibraryID): {sample.Sample_Name}")
             column_values = get_meta_data_by_library_id(sample.Sample_Name)
 
-            fastq_pattern = os.path.join(bcl2fastq_base_dir, runfolder, sample.Sample_Project,
-                                         sample.Sample_ID, sample.Sample_Name + "*.fastq.gz")
-            s3_fastq_pattern = os.path.join(fastq_hpc_base_dir, runfolder, sample.Sample_Project,
+            s3_fastq_pattern = os.path.join(args.fastq_hpc_base_dir, runfolder, sample.Sample_Project,
                                             sample.Sample_ID, sample.Sample_Name + "*.fastq.gz")
 
-            logger.debug('Looking for FASTQs: ' + fastq_pattern)
-            fastq_file_paths = glob(fastq_pattern)
-            if len(fastq_file_paths) < 1:
+            fastq_files = fastq_index.get_fastqs(sample.Sample_Project, sample.Sample_ID, sample.Sample_Name)
+            logger.debug(f"Found {len(fastq_files)} FASTQs for {sample.Sample_ID}")
+            if len(fastq_files) < 1:
                 logger.warn(f"Found no FASTQ files for sample {sample.Sample_ID}!")
 
             # splitting the combined sample name
@@ -410,28 +568,55 @@ if __name__ == "__main__":
                                 column_values[workflow_column_name].item(),
                                 '-',  # Tags
                                 s3_fastq_pattern,
-                                len(fastq_file_paths),
+                                len(fastq_files),
                                 '-',  # Results
                                 '-',  # Trello
                                 '-',  # Notes
                                 '-'  # ToDo
                                 ))
 
+    # keep the FASTQ index for later steps
+    if fastq_index.fastqs:
+        fastq_index_path = get_index_path(args.bcl2fastq_base_dir, runfolder)
+        try:
+            fastq_index.write(fastq_index_path)
+            logger.info(f"Wrote FASTQ index to {fastq_index_path}")
+        except OSError as error:
+            logger.warning(f"Could not write FASTQ index to {fastq_index_path}: {error}")
+
     ################################################################################
     # write the data into a CSV file
 
-    if write_csv:
-        output_file = os.path.join(csv_outdir, runfolder + '-lims-sheet.csv')
+    if args.write_csv:
+        output_file = os.path.join(args.csv_outdir, runfolder + '-lims-sheet.csv')
         logger.info(f"Writing {len(lims_data_rows)} records to CSV file {output_file}")
         write_csv_file(output_file=output_file, column_headers=sheet_column_headers, data_rows=lims_data_rows)
     else:
         logger.info("Not writing CSV file.")
 
-    if skip_lims_update:
+    if args.skip_lims_update:
         logger.warn("Skipping Google LIMS update!")
     else:
-        logger.info(f"Writing {len(lims_data_rows)} records to Google LIMS {lims_spreadsheet_id}")
-        write_to_google_lims(keyfile=creds_file, lims_spreadsheet_id=lims_spreadsheet_id,
+        logger.info(f"Writing {len(lims_data_rows)} records to Google LIMS {args.lims_spreadsheet_id}")
+        write_to_google_lims(keyfile=args.creds_file, lims_spreadsheet_id=args.lims_spreadsheet_id,
                              data_rows=lims_data_rows, failed_run=failed_run)
 
+    log_call_stats(logger)
     logger.info("All done.")
+
+
+# global variables
+# TODO: should be refactored in proper class variables
+logger = getLogger()
+tracking_sheet_cache = TrackingSheetCache(lab_spreadsheet_id, logger=logger)  # local tracking sheet snapshots
+library_tracking_spreadsheet = dict()  # dict of sheets indexed by library ID (LibraryIndex) per year
+lims_clients = dict()  # authorized Google LIMS clients per credentials file
+
+if __name__ == "__main__":
+    logger.info(f"Invocation with parameters: {sys.argv[1:]}")
+
+    ################################################################################
+    # argument parsing
+
+    logger.debug("Parsing arguments.")
+    main(get_arg_parser().parse_args())
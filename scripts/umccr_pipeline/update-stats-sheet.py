@@ -1,12 +1,21 @@
 import os
 import sys
 import json
+import numpy
+import pandas
 from collections import OrderedDict, Counter
-from openpyxl import load_workbook
+from openpyxl.utils import get_column_letter
+from stats_workbook import StatsWorkbook
+from stats_store import get_store_dir, write_run, read_run
 from glob import glob
 import logging
 from logging.handlers import RotatingFileHandler
 
+try:
+    import ijson  # streaming JSON parser
+except ImportError:
+    ijson = None
+
 DEPLOY_ENV = os.getenv('DEPLOY_ENV')
 if not DEPLOY_ENV:
     raise ValueError("DEPLOY_ENV needs to be set!")
@@ -21,7 +30,8 @@ else:
     stats_workbook_name = '/storage/shared/dev/AH-supplied-Baymax-Run-Stats-automated.dev.xlsx'
 
 GENOME_SIZE = 3200000000
-LANES = [1, 2, 3, 4]
+# the (fixed) lane columns of the workbook sheets, runs with fewer lanes have 0 values in the other lane columns
+SHEET_LANES = 4
 
 
 def getLogger():
@@ -42,116 +52,203 @@ def getLogger():
     return new_logger
 
 
+def get_sheet_name(run_id):
+    # the stats of a run go to the sheet of the run's year, e.g. 2020 for 200102_A00130_0002_AHXXXXXXX2
+    return '20' + run_id[:2]
+
+
+def iter_stats(stats_file):
+    # The top level values of a bcl2fastq Stats.json file up to its conversion results as (key, value), followed by
+    # the conversion results of each lane as ('ConversionResults', lane results). The lanes are parsed one by one and
+    # the rest of the file (e.g. the often large UnknownBarcodes) is not read at all. Without ijson the whole file
+    # is loaded.
+    with open(stats_file, 'rb') as fp:
+        if ijson is None:
+            for key, value in json.load(fp).items():
+                if key == 'ConversionResults':
+                    for lane_stat in value:
+                        yield key, lane_stat
+                    return
+                yield key, value
+            return
+
+        builder = None
+        for prefix, event, value in ijson.parse(fp):
+            if builder is not None:
+                builder.event(event, value)
+                if prefix == 'ConversionResults.item' and event == 'end_map':
+                    yield 'ConversionResults', builder.value
+                    builder = None
+            elif prefix == 'ConversionResults.item' and event == 'start_map':
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+            elif prefix == 'ConversionResults' and event == 'end_array':
+                return
+            elif '.' not in prefix and event in ('string', 'number', 'boolean', 'null'):
+                yield prefix, value
+
+
+def interleave(values, other_values):
+    return [value for pair in zip(values, other_values) for value in pair]
+
+
 class Bcl2fastqStats:
 
     separator = "\t"
 
     def __init__(self, stats_file):
         self.stats_file_name = stats_file
-        with open(stats_json) as fp:
-            data = json.load(fp)
-
-            self.flowcell = data[u'Flowcell']  # str
-            self.run_number = data[u'RunNumber']  # int
-            self.run_id = data[u'RunId']
-            self.samples_in_lanes = {}
-
-            # conversion results
-            self.total_reads_PF = 0
-            self.total_bases_PF = 0
-            conversion_stats = data[u'ConversionResults']
-            self.lane_stats = {}
-            for lane_number in LANES:
-                self.lane_stats[lane_number] = {'reads_raw': 0, 'reads_PF': 0, 'bases_PF': 0, 'reads_undetermined': 0,
-                                                'bases_undetermined': 0, 'reads_demuxed': 0, 'bases_demuxed': 0,
-                                                'samples': {}}
-
-            for lane_stat in conversion_stats:
-                lane_number = lane_stat[u'LaneNumber']
-                self.lane_stats[lane_number]['reads_raw'] = lane_stat[u'TotalClustersRaw']
-                self.lane_stats[lane_number]['reads_PF'] = lane_stat[u'TotalClustersPF']
-                self.lane_stats[lane_number]['bases_PF'] = lane_stat[u'Yield']
-                self.lane_stats[lane_number]['reads_undetermined'] = lane_stat[u'Undetermined'][u'NumberReads']
-                self.lane_stats[lane_number]['bases_undetermined'] = lane_stat[u'Undetermined'][u'Yield']
-
-                self.total_reads_PF += self.lane_stats[lane_number]['reads_PF']
-                self.total_bases_PF += self.lane_stats[lane_number]['bases_PF']
-
-                demux_results = lane_stat[u'DemuxResults']
-                for sample_stat in demux_results:
-                    sample_id = sample_stat[u'SampleId']
-                    sample_name = sample_stat[u'SampleName']
-                    sample_reads = sample_stat[u'NumberReads']
-                    sample_bases = sample_stat[u'Yield']
-
-                    self.lane_stats[lane_number]['samples'][(sample_id, sample_name)] = {'reads': sample_reads,
-                                                                                         'bases': sample_bases}
-                    self.lane_stats[lane_number]['reads_demuxed'] += sample_reads
-                    self.lane_stats[lane_number]['bases_demuxed'] += sample_bases
-
-                    if self.samples_in_lanes.get((sample_id, sample_name)) is None:
-                        self.samples_in_lanes[(sample_id, sample_name)] = [
-                            0] * len(LANES)
-                    self.samples_in_lanes[(
-                        sample_id, sample_name)][lane_number-1] = 1
+        self.flowcell = None  # str
+        self.run_number = None  # int
+        self.run_id = None
+
+        # conversion results, collected per lane in file order
+        lane_numbers = []
+        lane_values = []  # per lane: reads raw, reads PF, bases PF, reads undetermined, bases undetermined
+        lane_samples = []  # per lane: sample positions, sample reads, sample bases
+        self.sample_positions = {}  # (sample ID, sample name) -> position (in order of appearance)
+        for key, value in iter_stats(stats_file):
+            if key == 'Flowcell':
+                self.flowcell = value
+            elif key == 'RunNumber':
+                self.run_number = value
+            elif key == 'RunId':
+                self.run_id = value
+            elif key == 'ConversionResults':
+                lane_numbers.append(value['LaneNumber'])
+                lane_values.append((value['TotalClustersRaw'], value['TotalClustersPF'], value['Yield'],
+                                    value['Undetermined']['NumberReads'], value['Undetermined']['Yield']))
+                positions, reads, bases = [], [], []
+                for sample_stat in value['DemuxResults']:
+                    sample = (sample_stat['SampleId'], sample_stat['SampleName'])
+                    positions.append(self.sample_positions.setdefault(sample, len(self.sample_positions)))
+                    reads.append(sample_stat['NumberReads'])
+                    bases.append(sample_stat['Yield'])
+                lane_samples.append((positions, reads, bases))
+        self.set_lane_stats(lane_numbers, lane_values, lane_samples)
+
+    @classmethod
+    def from_store(cls, lanes_df, samples_df):
+        # the stats of a run as read from the stats store (see get_lanes_df and get_samples_df)
+        stats = cls.__new__(cls)
+        stats.stats_file_name = None
+        first_lane = lanes_df.iloc[0]
+        stats.flowcell = first_lane['flowcell']
+        stats.run_number = int(first_lane['run_number']) if pandas.notna(first_lane['run_number']) else None
+        stats.run_id = first_lane['run_id']
+
+        samples_df = samples_df.sort_values('sample_position', kind='stable')
+        stats.sample_positions = {}
+        samples_df = samples_df.assign(position=[
+            stats.sample_positions.setdefault(sample, len(stats.sample_positions))
+            for sample in zip(samples_df['sample_id'], samples_df['sample_name'])])
+        samples_by_lane = {lane: (lane_samples_df['position'].tolist(), lane_samples_df['reads'].tolist(),
+                                 lane_samples_df['bases'].tolist())
+                           for lane, lane_samples_df in samples_df.groupby('lane')}
+        lane_numbers = lanes_df['lane'].tolist()
+        lane_values = list(lanes_df[['reads_raw', 'reads_PF', 'bases_PF', 'reads_undetermined', 'bases_undetermined']]
+                           .itertuples(index=False, name=None))
+        stats.set_lane_stats(lane_numbers, lane_values,
+                             [samples_by_lane.get(lane, ([], [], [])) for lane in lane_numbers])
+        return stats
+
+    def set_lane_stats(self, lane_numbers, lane_values, lane_samples):
+        # the lanes (in lane order) and arrays of their values, indexed [lane] or [lane, sample]
+        lane_order = sorted(range(len(lane_numbers)), key=lambda index: lane_numbers[index])
+        self.lanes = numpy.array([lane_numbers[index] for index in lane_order], dtype=int)
+        lane_array = numpy.array([lane_values[index] for index in lane_order], dtype=numpy.int64).reshape(-1, 5)
+        self.reads_raw, self.reads_PF, self.bases_PF, self.reads_undetermined, self.bases_undetermined = \
+            [lane_array[:, column].copy() for column in range(5)]
+        self.samples = list(self.sample_positions)
+        shape = (len(self.lanes), len(self.samples))
+        self.sample_reads = numpy.zeros(shape, dtype=numpy.int64)
+        self.sample_bases = numpy.zeros(shape, dtype=numpy.int64)
+        self.sample_in_lane = numpy.zeros(shape, dtype=bool)
+        for lane_index, index in enumerate(lane_order):
+            positions, reads, bases = lane_samples[index]
+            self.sample_reads[lane_index, positions] = reads
+            self.sample_bases[lane_index, positions] = bases
+            self.sample_in_lane[lane_index, positions] = True
+        self.reads_demuxed = self.sample_reads.sum(axis=1)
+        self.bases_demuxed = self.sample_bases.sum(axis=1)
+
+        self.total_reads_PF = int(self.reads_PF.sum())
+        self.total_bases_PF = int(self.bases_PF.sum())
+
+    def get_lanes_df(self):
+        # the stats of each lane, as kept in the stats store
+        return pandas.DataFrame({
+            'run_id': self.run_id, 'flowcell': self.flowcell, 'run_number': self.run_number, 'lane': self.lanes,
+            'reads_raw': self.reads_raw, 'reads_PF': self.reads_PF, 'bases_PF': self.bases_PF,
+            'reads_undetermined': self.reads_undetermined, 'bases_undetermined': self.bases_undetermined})
+
+    def get_samples_df(self):
+        # the stats of each sample in each of its lanes, as kept in the stats store
+        lane_indexes, positions = numpy.nonzero(self.sample_in_lane)
+        return pandas.DataFrame({
+            'run_id': self.run_id, 'lane': self.lanes[lane_indexes], 'sample_position': positions,
+            'sample_id': [self.samples[position][0] for position in positions],
+            'sample_name': [self.samples[position][1] for position in positions],
+            'reads': self.sample_reads[lane_indexes, positions], 'bases': self.sample_bases[lane_indexes, positions]})
 
     def get_total_bases_undetermined(self):
-        return sum([self.lane_stats[lane_number]['bases_undetermined'] for lane_number in LANES])
+        return int(self.bases_undetermined.sum())
+
+    def add_samples(self, samples):
+        # add the samples that are not in the stats yet (without reads), return the positions of all given samples
+        new_samples = [sample for sample in samples if sample not in self.sample_positions]
+        if new_samples:
+            for sample in new_samples:
+                self.sample_positions[sample] = len(self.samples)
+                self.samples.append(sample)
+            padding = ((0, 0), (0, len(new_samples)))
+            self.sample_reads = numpy.pad(self.sample_reads, padding)
+            self.sample_bases = numpy.pad(self.sample_bases, padding)
+            self.sample_in_lane = numpy.pad(self.sample_in_lane, padding)
+        return numpy.array([self.sample_positions[sample] for sample in samples], dtype=int)
 
     def merge(self, other):
+        # Add the demultiplexed reads of the stats of another samplesheet of the same run. All lanes are checked
+        # before anything is changed: their PF reads and bases have to match and the undetermined reads of either
+        # stats less the reads demultiplexed by the other have to agree.
         if self.run_id != other.run_id:
             return False
 
-        # check other metrics
-        for lane_number, lane_stat in other.lane_stats.items():
-            # other.lane_stats[lane_number] == lane_stat ??
-            
-            s_lane_stat = self.lane_stats[lane_number]
-            if lane_stat['reads_PF'] == 0:
-                continue
-
-            if lane_stat['reads_PF'] != s_lane_stat['reads_PF']:
-                raise Exception(f"Read PF are not the same - Lane {lane_number}. \
-                                  Reads 'self' = {s_lane_stat['reads_PF']}, \
-                                  'other' = {lane_stat['reads_PF']}")
-            # if s_lane_stat['reads_PF'] == lane_stat['reads_PF']:
-            else:
-                # assert s_lane_stat['reads_PF'] == lane_stat['reads_PF']
-                if s_lane_stat['bases_PF'] != lane_stat['bases_PF']:
-                    raise Exception(f"[{self.run_id}] Base accounting failed - \
-                                        {s_lane_stat['bases_PF']} vs \
-                                        {lane_stat['bases_PF']}")
-
-                undetermined_self = s_lane_stat['reads_undetermined'] - \
-                    lane_stat['reads_demuxed']
-                undetermined_other = lane_stat['reads_undetermined'] - \
-                    s_lane_stat['reads_demuxed']
-
-                if undetermined_self != undetermined_other:
-                    raise Exception(f"Mismatch of undetermined reads after matching up demultiplexed reads - \
-                                     Lane {lane_number}")
-
-                # update the undetermined reads
-                s_lane_stat['reads_undetermined'] = undetermined_self
-                s_lane_stat['bases_undetermined'] = s_lane_stat['bases_undetermined'] - \
-                    lane_stat['bases_demuxed']
-
-                # update the demultiplexed reads
-                s_lane_stat['reads_demuxed'] += lane_stat['reads_demuxed']
-                s_lane_stat['bases_demuxed'] += lane_stat['bases_demuxed']
-
-                # add samples in 'other' into 'self'
-                for sample, sample_info in lane_stat['samples'].items():
-                    # print(sample, sample_info)
-                    if s_lane_stat['samples'].get(sample) is None:
-                        s_lane_stat['samples'][sample] = {
-                            'reads': 0, 'bases': 0}
-                    s_lane_stat['samples'][sample]['reads'] += sample_info['reads']
-                    s_lane_stat['samples'][sample]['bases'] += sample_info['bases']
-                    # print(sample, sample_info)
-
-        for sample, membership in other.samples_in_lanes.items():
-            self.samples_in_lanes[sample] = membership
+        other_lanes = numpy.flatnonzero(other.reads_PF > 0)
+        lane_numbers = other.lanes[other_lanes]
+        lane_positions = {lane: position for position, lane in enumerate(self.lanes)}
+        lane_indexes = numpy.array([lane_positions.get(lane, -1) for lane in lane_numbers], dtype=int)
+        # lanes missing in 'self' have no PF reads there
+        reads_PF = numpy.where(lane_indexes >= 0, self.reads_PF[lane_indexes], 0)
+        mismatches = numpy.flatnonzero(reads_PF != other.reads_PF[other_lanes])
+        if len(mismatches):
+            mismatch = mismatches[0]
+            raise Exception(f"Read PF are not the same - Lane {lane_numbers[mismatch]}. \
+                              Reads 'self' = {reads_PF[mismatch]}, \
+                              'other' = {other.reads_PF[other_lanes[mismatch]]}")
+        mismatches = numpy.flatnonzero(self.bases_PF[lane_indexes] != other.bases_PF[other_lanes])
+        if len(mismatches):
+            mismatch = mismatches[0]
+            raise Exception(f"[{self.run_id}] Base accounting failed - \
+                                {self.bases_PF[lane_indexes[mismatch]]} vs \
+                                {other.bases_PF[other_lanes[mismatch]]}")
+        undetermined_self = self.reads_undetermined[lane_indexes] - other.reads_demuxed[other_lanes]
+        undetermined_other = other.reads_undetermined[other_lanes] - self.reads_demuxed[lane_indexes]
+        mismatches = numpy.flatnonzero(undetermined_self != undetermined_other)
+        if len(mismatches):
+            raise Exception(f"Mismatch of undetermined reads after matching up demultiplexed reads - \
+                             Lane {lane_numbers[mismatches[0]]}")
+
+        # update the undetermined and demultiplexed reads, add the samples in 'other' into 'self'
+        positions = self.add_samples(other.samples)
+        self.reads_undetermined[lane_indexes] = undetermined_self
+        self.bases_undetermined[lane_indexes] -= other.bases_demuxed[other_lanes]
+        self.reads_demuxed[lane_indexes] += other.reads_demuxed[other_lanes]
+        self.bases_demuxed[lane_indexes] += other.bases_demuxed[other_lanes]
+        lane_samples = numpy.ix_(lane_indexes, positions)
+        self.sample_reads[lane_samples] += other.sample_reads[other_lanes]
+        self.sample_bases[lane_samples] += other.sample_bases[other_lanes]
+        self.sample_in_lane[lane_samples] |= other.sample_in_lane[other_lanes]
 
         return True
 
@@ -161,153 +258,128 @@ class Bcl2fastqStats:
     def __cmp__(self, other):
         return cmp(self.run_id, other.run_id)
 
+    def get_sample_order(self):
+        # samples in the most (and first) lanes first, otherwise in order of appearance
+        if len(self.lanes) == 0:
+            return numpy.arange(len(self.samples))
+        return numpy.lexsort(~self.sample_in_lane[::-1])
+
+    def get_sample_stats(self):
+        # Per sample (in output order): reads and fraction of the lane's PF reads per lane, total reads, fraction of
+        # the run's PF reads and genome equivalents. The per lane values are indexed [lane, sample].
+        order = self.get_sample_order()
+        in_lane = self.sample_in_lane[:, order]
+        reads = self.sample_reads[:, order]
+        lane_fractions = numpy.divide(reads, self.reads_PF[:, None], out=numpy.zeros(reads.shape),
+                                      where=in_lane & (self.reads_PF[:, None] > 0))
+        total_reads = reads.sum(axis=0)
+        run_fractions = total_reads / float(self.total_reads_PF)
+        genome_equivalents = self.sample_bases[:, order].sum(axis=0) / float(GENOME_SIZE)
+        return [self.samples[position] for position in order], in_lane, reads, lane_fractions, total_reads, \
+            run_fractions, genome_equivalents
+
+    def reindex_lanes(self, values, lanes):
+        # the values (indexed [lane, ...]) for the given lanes, zeros for lanes not in the stats
+        reindexed = numpy.zeros((len(lanes),) + values.shape[1:], dtype=values.dtype)
+        for index, lane_number in enumerate(lanes):
+            lane_index = numpy.flatnonzero(self.lanes == lane_number)
+            if len(lane_index):
+                reindexed[index] = values[lane_index[0]]
+        return reindexed
+
+    def get_lane_fractions(self, reads, total_reads):
+        # fractions of the reads of lanes with PF reads (0 for the others)
+        return numpy.divide(reads, total_reads, out=numpy.zeros(len(self.lanes)), where=self.reads_PF > 0)
+
     def prepare_output(self):
-        all_sample_names = sorted(
-            self.samples_in_lanes.items(), key=lambda kv: kv[1], reverse=True)
-        all_lanes = set([])
-        for lane_number, lane_data in self.lane_stats.items():
-            all_lanes.add(lane_number)
-        all_lanes = sorted(list(all_lanes))
-
-        total_genome_equivalent = 0
+        samples, in_lane, reads, lane_fractions, total_reads, run_fractions, genome_equivalents = \
+            self.get_sample_stats()
+        has_reads = self.reads_PF > 0
+        total_PF = int(self.reads_PF[has_reads].sum())
+
         output = []
-        for sample_id_value, sample_lane_membership in all_sample_names:
-            sample_id, sample_name = sample_id_value
+        for position, (sample_id, sample_name) in enumerate(samples):
             row = [self.run_id, sample_id, sample_name]
-            total_sample_reads = 0
-            total_sample_bases = 0
-            for lane_number in all_lanes:
-                lane_data = self.lane_stats.get(lane_number)
-
-                sample_reads = lane_data['samples'].get(
-                    (sample_id, sample_name))
-                if sample_reads is not None:
-                    row += ['{:,}'.format(sample_reads['reads']), '{:.2%}'.format(
-                        sample_reads['reads']/float(lane_data['reads_PF']))]
-                    total_sample_reads += sample_reads['reads']
-                    total_sample_bases += sample_reads['bases']
+            for lane_index in range(len(self.lanes)):
+                if in_lane[lane_index, position]:
+                    row += ['{:,}'.format(reads[lane_index, position]),
+                            '{:.2%}'.format(lane_fractions[lane_index, position])]
                 else:
-                    # row += ['{:,}'.format(0), '{:.2%}'.format(0.0)]
                     row += ['.', '.']
+            row += ['{:,}'.format(total_reads[position]), '{:.2%}'.format(run_fractions[position])]
+            row += ['{:.2f}'.format(genome_equivalents[position])]
+            output.append(self.separator.join([str(v) for v in row]))
 
-            genome_equivalent = total_sample_bases/float(GENOME_SIZE)
-            total_genome_equivalent += genome_equivalent
-            row += ['{:,}'.format(total_sample_reads), '{:.2%}'.format(
-                total_sample_reads/float(self.total_reads_PF))]
-            row += ['{:.2f}'.format(genome_equivalent)]
-            row_str = self.separator.join([str(v) for v in row])
-            output.append(row_str)
-
-        total_undetermined = 0
-        total_PF = 0
+        undetermined_fractions = self.get_lane_fractions(self.reads_undetermined, self.reads_PF)
+        PF_fractions = self.get_lane_fractions(self.reads_PF, float(self.total_reads_PF))
         row = [self.run_id, 'Undetermined', 'Undetermined']
         total = [self.run_id, '.', 'TOTAL']
-        for lane_number in all_lanes:
-            lane_data = self.lane_stats.get(lane_number)
-            if lane_data['reads_PF'] == 0:
-                row += ['.', '.']
+        for lane_index in range(len(self.lanes)):
+            if has_reads[lane_index]:
+                row += ['{:,}'.format(self.reads_undetermined[lane_index]),
+                        '{:.2%}'.format(undetermined_fractions[lane_index])]
+                total += ['{:,}'.format(self.reads_PF[lane_index]), '{:.2%}'.format(PF_fractions[lane_index])]
             else:
-                row += ['{:,}'.format(lane_data['reads_undetermined']), '{:.2%}'.format(
-                    lane_data['reads_undetermined']/float(lane_data['reads_PF']))]
-
-            if lane_data['reads_PF'] == 0:
+                row += ['.', '.']
                 total += ['.', '.']
-            else:
-                total_undetermined += lane_data['reads_undetermined']
-                total_PF += lane_data['reads_PF']
-                total += ['{:,}'.format(lane_data['reads_PF']), '{:.2%}'.format(
-                    lane_data['reads_PF']/float(self.total_reads_PF))]
 
+        total_undetermined = int(self.reads_undetermined[has_reads].sum())
         genome_equivalent = self.get_total_bases_undetermined()/float(GENOME_SIZE)
-        total_genome_equivalent += genome_equivalent
+        total_genome_equivalent = sum(genome_equivalents.tolist()) + genome_equivalent
         row += ['{:,}'.format(total_undetermined),
                 '{:.2%}'.format(total_undetermined/float(total_PF))]
         row += ['{:.2f}'.format(genome_equivalent)]
-        row_str = self.separator.join([str(v) for v in row])
         total += ['{:,}'.format(total_PF),
                   '{:.2%}'.format(total_PF/float(self.total_reads_PF))]
         total += ['{:.2f}'.format(total_genome_equivalent)]
-        total_str = self.separator.join([str(v) for v in total])
-
-        output.append(row_str)
-        output.append(total_str)
 
+        output.append(self.separator.join([str(v) for v in row]))
+        output.append(self.separator.join([str(v) for v in total]))
         return output
 
     def __str__(self):
         output = self.prepare_output()
         return '\n'.join(output)
 
-    def prepare_rows(self):
-        all_sample_names = sorted(
-            self.samples_in_lanes.items(), key=lambda kv: kv[1], reverse=True)
-        all_lanes = set([])
-        for lane_number, lane_data in self.lane_stats.items():
-            all_lanes.add(lane_number)
-        all_lanes = sorted(list(all_lanes))
+    def prepare_rows(self, lanes=None):
+        # The rows for the stats workbook, with columns for the given lanes (default: the lanes of the run).
+        # Lanes the sample isn't in, lanes without PF reads and lanes not in the run have 0 values.
+        lanes = self.lanes if lanes is None else lanes
+        samples, in_lane, reads, lane_fractions, total_reads, run_fractions, genome_equivalents = \
+            self.get_sample_stats()
+        reads = self.reindex_lanes(numpy.where(in_lane, reads, 0), lanes).T.tolist()
+        lane_fractions = self.reindex_lanes(lane_fractions, lanes).T.tolist()
+        total_reads = total_reads.tolist()
+        run_fractions = run_fractions.tolist()
+        genome_equivalents = genome_equivalents.tolist()
 
-        total_genome_equivalent = 0
         output = []
-        for sample_id_value, sample_lane_membership in all_sample_names:
-            sample_id, sample_name = sample_id_value
+        for position, (sample_id, sample_name) in enumerate(samples):
             row = [self.run_id, sample_id, sample_name]
-            total_sample_reads = 0
-            total_sample_bases = 0
-            for lane_number in all_lanes:
-                lane_data = self.lane_stats.get(lane_number)
-
-                sample_reads = lane_data['samples'].get(
-                    (sample_id, sample_name))
-                if sample_reads is not None:
-                    row.append(sample_reads['reads'])
-                    row.append(sample_reads['reads']/float(lane_data['reads_PF']))
-                    total_sample_reads += sample_reads['reads']
-                    total_sample_bases += sample_reads['bases']
-                else:
-                    # row += ['{:,}'.format(0), '{:.2%}'.format(0.0)]
-                    row.append(0)
-                    row.append(0)
-
-            genome_equivalent = total_sample_bases/float(GENOME_SIZE)
-            total_genome_equivalent += genome_equivalent
-            row.append(total_sample_reads)
-            row.append(total_sample_reads/float(self.total_reads_PF))
-            row.append(genome_equivalent)
+            row += interleave(reads[position], lane_fractions[position])
+            row += [total_reads[position], run_fractions[position], genome_equivalents[position]]
             output.append(row)
 
-        total_undetermined = 0
-        total_PF = 0
-        undet_row = [self.run_id, 'Undetermined', 'Undetermined']
-        total_row = [self.run_id, '.', 'TOTAL']
-        for lane_number in all_lanes:
-            lane_data = self.lane_stats.get(lane_number)
-            if lane_data['reads_PF'] == 0:
-                undet_row.append(0)
-                undet_row.append(0)
-            else:
-                undet = lane_data['reads_undetermined']
-                undet_row.append(undet)
-                undet_row.append(undet/float(lane_data['reads_PF']))
-
-            if lane_data['reads_PF'] == 0:
-                total_row.append(0)
-                total_row.append(0)
-            else:
-                total_undetermined += lane_data['reads_undetermined']
-                total_PF += lane_data['reads_PF']
-                total_row.append(lane_data['reads_PF'])
-                total_row.append(lane_data['reads_PF']/float(self.total_reads_PF))
-
+        has_reads = self.reads_PF > 0
+        undetermined = numpy.where(has_reads, self.reads_undetermined, 0)
+        lane_PF = numpy.where(has_reads, self.reads_PF, 0)
+        total_undetermined = int(undetermined.sum())
+        total_PF = int(lane_PF.sum())
         genome_equivalent = self.get_total_bases_undetermined()/float(GENOME_SIZE)
-        total_genome_equivalent += genome_equivalent
-        undet_row.append(total_undetermined)
-        undet_row.append(total_undetermined/float(total_PF))
-        undet_row.append(genome_equivalent)
+        total_genome_equivalent = sum(genome_equivalents) + genome_equivalent
+
+        undet_row = [self.run_id, 'Undetermined', 'Undetermined']
+        undet_row += interleave(self.reindex_lanes(undetermined, lanes).tolist(),
+                                self.reindex_lanes(self.get_lane_fractions(self.reads_undetermined, self.reads_PF),
+                                                   lanes).tolist())
+        undet_row += [total_undetermined, total_undetermined/float(total_PF), genome_equivalent]
         output.append(undet_row)
 
-        total_row.append(total_PF)
-        total_row.append(total_PF/float(self.total_reads_PF))
-        total_row.append(total_genome_equivalent)
+        total_row = [self.run_id, '.', 'TOTAL']
+        total_row += interleave(self.reindex_lanes(lane_PF, lanes).tolist(),
+                                self.reindex_lanes(self.get_lane_fractions(self.reads_PF, float(self.total_reads_PF)),
+                                                   lanes).tolist())
+        total_row += [total_PF, total_PF/float(self.total_reads_PF), total_genome_equivalent]
         output.append(total_row)
 
         return output
@@ -374,62 +446,74 @@ if __name__ == '__main__':
         for stats_json in sys.stdin:
             stats_jsons.append(stats_json.strip())
 
-    all_stats = []
+    # the stats of the samplesheets of a run are merged into the stats of the run
+    stats_by_run = {}  # run ID -> stats
     for stats_json in stats_jsons:
         logger.info(f"Processing {stats_json}")
         # get_stats(stats_json)
         stats = Bcl2fastqStats(stats_json)
         stats.separator = ';'
 
-        merged = False
-        for stat in all_stats:
-            if stat.merge(stats):
-                merged = True
-
-        if not merged:
-            all_stats.append(stats)
+        if stats.run_id in stats_by_run:
+            stats_by_run[stats.run_id].merge(stats)
+        else:
+            stats_by_run[stats.run_id] = stats
+    all_stats = list(stats_by_run.values())
+
+    # the stats of the runs are added to the stats store and the workbook rows are generated from the stored stats
+    store_dir = get_store_dir(DEPLOY_ENV)
+    logger.info(f"Updating stats store {store_dir}")
+    try:
+        stored_stats = []
+        for stats in all_stats:
+            write_run(store_dir, stats.run_id, stats.get_lanes_df(), stats.get_samples_df())
+            stored_stats.append(Bcl2fastqStats.from_store(*read_run(store_dir, stats.run_id)))
+            stored_stats[-1].separator = stats.separator
+        all_stats = stored_stats
+    except (ImportError, ValueError, OSError) as error:
+        logger.warning(f"Could not update the stats store, using the stats of the runs as read: {error}")
 
     for stats in all_stats:
         print(stats)
         print()
 
     logger.info(f"Updating stats sheet {stats_workbook_name}")
-    workbook = load_workbook(stats_workbook_name)
-    # TODO: extract sheet name from workbook name/path (contains run name, which contains the run year)
-    worksheet = workbook.get_sheet_by_name('2019')
+    workbook = StatsWorkbook(stats_workbook_name, logger=logger)
+
+    # the rows have the lane columns of the sheets (more only if a run has more lanes): run, sample ID, sample
+    # name, reads and fraction of each lane, total reads and fraction, genome equivalents
+    lanes = list(range(1, max([SHEET_LANES] + [int(lane) for stats in all_stats for lane in stats.lanes]) + 1))
+    fraction_columns = [get_column_letter(5 + 2 * lane_index) for lane_index in range(len(lanes))]
+    fraction_columns.append(get_column_letter(5 + 2 * len(lanes)))
 
-    current_rows = worksheet.max_row  # record the number of existing rows
-    logger.debug(f"Appending data after row {current_rows}")
-    new_rows = 0
+    # the runs of each year are appended to the year's sheet, followed by their per lane totals
+    sheet_stats = OrderedDict()  # sheet name -> stats of the runs
     for stats in all_stats:
-        rows = stats.prepare_rows()
-        new_rows += len(rows)
-        for row in rows:
-            worksheet.append(row)
-
-    block_start = current_rows + 1
-    block_end = current_rows + new_rows - 1  # step one row back to exclude total
-    logger.debug("Adding per lane totals")
-    worksheet.append(['', '', '',
-                      'total per lane', f"=SUM(E{block_start}:E{block_end})",
-                      '', f"=SUM(G{block_start}:G{block_end})",
-                      '', f"=SUM(I{block_start}:I{block_end})",
-                      '', f"=SUM(K{block_start}:K{block_end})",
-                      '', '', ''])
-
-    # Format cells as Percentage
-    logger.debug("Updating cell format (set percentage)")
-    for cell in worksheet['E']:
-        cell.number_format = "0.00%"
-    for cell in worksheet['G']:
-        cell.number_format = "0.00%"
-    for cell in worksheet['I']:
-        cell.number_format = "0.00%"
-    for cell in worksheet['K']:
-        cell.number_format = "0.00%"
-    for cell in worksheet['M']:
-        cell.number_format = "0.00%"
+        sheet_stats.setdefault(get_sheet_name(stats.run_id), []).append(stats)
+    for sheet_name, stats_of_sheet in sheet_stats.items():
+        if sheet_name not in workbook.sheet_names:
+            # the first run of a year: a new sheet with the header of the latest year's sheet
+            year_sheet_names = [name for name in workbook.sheet_names if name.isdigit() and name < sheet_name]
+            header_sheet_name = max(year_sheet_names) if year_sheet_names else None
+            logger.info(f"Adding sheet {sheet_name} with the header of sheet {header_sheet_name}")
+            workbook.add_sheet(sheet_name, header_sheet_name)
+        current_rows = workbook.get_row_count(sheet_name)  # record the number of existing rows
+        logger.debug(f"Appending data to sheet {sheet_name} after row {current_rows}")
+        rows = []
+        for stats in stats_of_sheet:
+            rows += stats.prepare_rows(lanes)
+
+        block_start = current_rows + 1
+        block_end = current_rows + len(rows) - 1  # step one row back to exclude total
+        logger.debug("Adding per lane totals")
+        lane_totals = ['', '', '', 'total per lane']
+        for column in fraction_columns[:-1]:
+            lane_totals += [f"=SUM({column}{block_start}:{column}{block_end})", '']
+        rows.append(lane_totals + ['', ''])
+
+        # only the new cells are formatted as percentage
+        workbook.append_rows(sheet_name, rows, percent_columns=fraction_columns)
 
     logger.info("Saving workbook")
-    workbook.save(stats_workbook_name)
+    workbook.save()
     logger.info("All done.")
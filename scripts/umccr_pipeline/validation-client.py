@@ -0,0 +1,77 @@
+import os
+import sys
+import json
+import socket
+
+################################################################################
+# Thin client for validation-service.py, taking the same command line as the script it replaces:
+#   python validation-client.py <script> [script arguments]
+# e.g.
+#   python validation-client.py /opt/Pipeline/prod/scripts/samplesheet-check.py <samplesheet> [--check-only]
+#   python validation-client.py /opt/Pipeline/prod/scripts/update-google-lims.py <runfolder>
+# The script output and exit code are those of the script run by the service. If the service
+# is not available the script is run directly (as before), so the pipeline does not depend on it.
+# NOTE: this client only uses the standard library, to keep its startup fast.
+
+DEPLOY_ENV = os.getenv('DEPLOY_ENV')
+if not DEPLOY_ENV:
+    raise ValueError("DEPLOY_ENV needs to be set!")
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+SOCKET_PATH = os.getenv('VALIDATION_SERVICE_SOCKET', os.path.join(SCRIPT_DIR, f"validation-service.{DEPLOY_ENV}.sock"))
+CONNECT_TIMEOUT = 5  # seconds; an operation itself may take as long as it takes
+
+
+def get_operation(script, args):
+    script_name = os.path.basename(script)
+    if script_name == 'samplesheet-check.py':
+        return 'validate' if '--check-only' in args else 'split'
+    elif script_name == 'update-google-lims.py':
+        return 'lims-rows'
+    raise ValueError(f"No validation service operation for script {script}!")
+
+
+def connect():
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(CONNECT_TIMEOUT)
+    try:
+        client.connect(SOCKET_PATH)
+    except OSError:
+        client.close()
+        return None
+    client.settimeout(None)
+    return client
+
+
+def run_script(script, args):
+    print(f"Validation service not available on {SOCKET_PATH}, running {script} directly.", file=sys.stderr)
+    os.execv(sys.executable, [sys.executable, script] + args)
+
+
+def main(script, args):
+    operation = get_operation(script, args)
+    client = connect()
+    if client is None:
+        run_script(script, args)
+
+    # only fall back to running the script before the request is sent, never run an operation twice
+    with client, client.makefile('rwb') as stream:
+        # the service resolves relative paths in the args against the working directory of the client
+        request = {'operation': operation, 'args': args, 'deploy_env': DEPLOY_ENV, 'cwd': os.getcwd()}
+        stream.write(json.dumps(request).encode('utf-8') + b'\n')
+        stream.flush()
+        line = stream.readline()
+    if not line:
+        print(f"Validation service closed the connection without a response to {operation}!", file=sys.stderr)
+        return 1
+
+    response = json.loads(line.decode('utf-8'))
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    return response['exit_code']
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"Usage: {os.path.basename(__file__)} <script> [script arguments]", file=sys.stderr)
+        exit(2)
+    exit(main(sys.argv[1], sys.argv[2:]))
@@ -0,0 +1,174 @@
+import os
+import io
+import sys
+import json
+import socketserver
+import traceback
+import logging
+from logging.handlers import RotatingFileHandler
+from contextlib import redirect_stdout, redirect_stderr
+
+################################################################################
+# Long running service that keeps the samplesheet check and LIMS update scripts loaded,
+# so that the pipeline steps don't pay for the interpreter/library startup and the
+# Google authentication on every invocation. The authenticated clients and the tracking
+# sheet tabs loaded by the scripts are kept between requests (and refreshed by the
+# tracking sheet cache if the sheet has been modified).
+#
+# Requests are handled one at a time (the scripts use module level state) and are sent
+# by validation-client.py as one JSON object per connection:
+#   {"operation": "validate"|"split"|"lims-rows", "args": [...], "deploy_env": "prod"|"dev", "cwd": "..."}
+# The operation runs in the working directory of the client, so relative paths in the args work as with the script.
+# The response reports the exit code of the operation and its captured output:
+#   {"exit_code": 0, "stdout": "...", "stderr": "..."}
+
+DEPLOY_ENV = os.getenv('DEPLOY_ENV')
+if not DEPLOY_ENV:
+    raise ValueError("DEPLOY_ENV needs to be set!")
+SCRIPT = os.path.basename(__file__)
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+SOCKET_PATH = os.getenv('VALIDATION_SERVICE_SOCKET', os.path.join(SCRIPT_DIR, f"validation-service.{DEPLOY_ENV}.sock"))
+
+if DEPLOY_ENV == 'prod':
+    LOG_FILE_NAME = os.path.join(SCRIPT_DIR, SCRIPT + ".log")
+else:
+    LOG_FILE_NAME = os.path.join(SCRIPT_DIR, SCRIPT + ".dev.log")
+
+# the scripts are imported by module name (their names are not valid identifiers)
+sys.path.insert(0, SCRIPT_DIR)
+samplesheet_check = __import__('samplesheet-check')
+update_google_lims = __import__('update-google-lims')
+
+
+################################################################################
+# METHODS
+
+def getLogger():
+    new_logger = logging.getLogger(__name__)
+    new_logger.setLevel(logging.DEBUG)
+
+    # create a logging format
+    formatter = logging.Formatter('%(asctime)s - %(module)s - %(name)s - %(levelname)s : %(lineno)d - %(message)s')
+
+    # create a file handler
+    file_handler = RotatingFileHandler(filename=LOG_FILE_NAME, maxBytes=100000000, backupCount=5)
+    file_handler.setLevel(logging.DEBUG)
+    file_handler.setFormatter(formatter)
+
+    # create a console handler
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.DEBUG)
+    console_handler.setFormatter(formatter)
+
+    # add the handlers to the logger
+    new_logger.addHandler(file_handler)
+    new_logger.addHandler(console_handler)
+
+    return new_logger
+
+
+def parse_script_args(module, args):
+    # parse as the script would, incl. usage/error messages naming the script
+    parser = module.get_arg_parser()
+    parser.prog = module.SCRIPT
+    return parser.parse_args(args)
+
+
+def run_samplesheet_check(args, check_only):
+    parsed_args = parse_script_args(samplesheet_check, args)
+    samplesheet_check.main(samplesheet_file_path=parsed_args.samplesheet,
+                           check_only=check_only or parsed_args.check_only,
+                           fail_on_index_clash=parsed_args.fail_on_index_clash,
+                           report_path=parsed_args.report)
+
+
+def run_lims_update(args):
+    update_google_lims.main(parse_script_args(update_google_lims, args))
+
+
+# operation name -> (script module, function running the operation with the script arguments)
+operations = {
+    'validate': (samplesheet_check, lambda args: run_samplesheet_check(args, check_only=True)),
+    'split': (samplesheet_check, lambda args: run_samplesheet_check(args, check_only=False)),
+    'lims-rows': (update_google_lims, run_lims_update)
+}
+
+
+def run_operation(operation, args, cwd=None):
+    # run the operation as the script would (same arguments, working directory, output and exit code),
+    # capturing what the script prints and logs (to the console) so it can be returned to the client
+    module, run = operations[operation]
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    capture_handler = logging.StreamHandler(stderr)
+    capture_handler.setLevel(module.CONSOLE_LOG_LEVEL)
+    capture_handler.setFormatter(logger.handlers[0].formatter)
+    module.logger.addHandler(capture_handler)
+    service_cwd = os.getcwd()
+    try:
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            if cwd:
+                os.chdir(cwd)
+            module.logger.info(f"Invocation with parameters: {args}")
+            run(args)
+        exit_code = 0
+    except SystemExit as exit_error:
+        # argparse errors and explicit exits of the scripts
+        if exit_error.code is None or isinstance(exit_error.code, int):
+            exit_code = exit_error.code or 0
+        else:
+            stderr.write(f"{exit_error.code}\n")
+            exit_code = 1
+    except Exception:
+        stderr.write(traceback.format_exc())
+        exit_code = 1
+    finally:
+        module.logger.removeHandler(capture_handler)
+        os.chdir(service_cwd)
+    return {'exit_code': exit_code, 'stdout': stdout.getvalue(), 'stderr': stderr.getvalue()}
+
+
+class ValidationRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            operation = request['operation']
+            args = [str(arg) for arg in request.get('args', [])]
+            cwd = str(request['cwd']) if request.get('cwd') else None
+        except (ValueError, KeyError, TypeError) as error:
+            logger.error(f"Invalid request: {error}")
+            response = {'exit_code': 2, 'stdout': '', 'stderr': f"Invalid request: {error}\n"}
+        else:
+            if request.get('deploy_env') != DEPLOY_ENV:
+                logger.error(f"Request for env {request.get('deploy_env')} received by {DEPLOY_ENV} service")
+                response = {'exit_code': 2, 'stdout': '',
+                            'stderr': f"Service runs in {DEPLOY_ENV}, not {request.get('deploy_env')}!\n"}
+            elif operation not in operations:
+                logger.error(f"Unsupported operation: {operation}")
+                response = {'exit_code': 2, 'stdout': '', 'stderr': f"Unsupported operation: {operation}\n"}
+            else:
+                logger.info(f"Running {operation} with parameters: {args}")
+                response = run_operation(operation, args, cwd)
+                logger.info(f"Finished {operation} with exit code {response['exit_code']}")
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+# global variables
+logger = getLogger()
+
+if __name__ == "__main__":
+    logger.info(f"Starting validation service in {DEPLOY_ENV} on socket {SOCKET_PATH}")
+
+    # remove the socket of a previous instance, only the service (user) may connect
+    if os.path.exists(SOCKET_PATH):
+        os.remove(SOCKET_PATH)
+    server = socketserver.UnixStreamServer(SOCKET_PATH, ValidationRequestHandler)
+    os.chmod(SOCKET_PATH, 0o600)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Stopping validation service.")
+    finally:
+        server.server_close()
+        os.remove(SOCKET_PATH)
@@ -0,0 +1,54 @@
+"""
+Findings of the samplesheet check, collected in memory while the checks run and written once at the end
+as JSON or TSV, independent of (and complete unlike) the rate limited log output.
+"""
+import csv
+import json
+import collections
+from datetime import datetime
+
+# the columns of the metadata findings of the samplesheet check, plus the check a finding comes from
+finding_field_names = ('Check', 'Sample_ID', 'Sample_Name', 'Level', 'Rule', 'Message', 'FailsCheck')
+Finding = collections.namedtuple('Finding', finding_field_names)
+
+
+class ValidationReport:
+
+    def __init__(self, samplesheet_path=None):
+        self.samplesheet_path = samplesheet_path
+        self.created = datetime.now().isoformat(timespec='seconds')
+        self.findings = list()
+
+    def add_finding(self, check, level, rule, message, sample_id='', sample_name='', fails_check=True):
+        self.findings.append(Finding(check, sample_id, sample_name, level, rule, message, fails_check))
+
+    def get_summary(self):
+        levels = collections.Counter(finding.Level for finding in self.findings)
+        return {
+            'findings': len(self.findings),
+            'errors': levels['ERROR'],
+            'warnings': levels['WARNING'],
+            'fails_check': any(finding.FailsCheck for finding in self.findings),
+            'rules': dict(collections.Counter(finding.Rule for finding in self.findings))}
+
+    def write_json(self, report_file):
+        json.dump({
+            'samplesheet': self.samplesheet_path,
+            'created': self.created,
+            'summary': self.get_summary(),
+            'findings': [finding._asdict() for finding in self.findings]}, report_file, indent=2)
+
+    def write_tsv(self, report_file):
+        writer = csv.writer(report_file, delimiter='\t', lineterminator='\n')
+        writer.writerow(finding_field_names)
+        writer.writerows(self.findings)
+
+    def write(self, report_path):
+        """
+        Write the report to the given path, as TSV if its name ends with .tsv, otherwise as JSON.
+        """
+        with open(report_path, 'w', newline='') as report_file:
+            if report_path.endswith('.tsv'):
+                self.write_tsv(report_file)
+            else:
+                self.write_json(report_file)
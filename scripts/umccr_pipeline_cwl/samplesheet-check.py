@@ -91,16 +91,6 @@ def getLogger():
 logger = getLogger()
 
 
-# method to count the differences between two strings
-# NOTE: strings have to be of equal length
-def str_compare(a, b):
-    cnt = 0
-    for i, j in zip(a, b):
-        if i != j:
-            cnt += 1
-    return cnt
-
-
 def import_library_sheet_from_google(year):
     global library_tracking_spreadsheet_df
     c = conf.get_config(conf_dir=sys.argv[2])
@@ -212,85 +202,136 @@ def checkMetadataCorrespondence(samplesheet):
     return has_error
 
 
-def checkSampleSheetForIndexClashes(samplesheet):
-    logger.info("Checking SampleSheet for index clashes")
-    has_error = False
+# Index comparisons between two samples (in the order they are reported) and their labels
+index_comparisons = {
+    ('i7', 'i7'): (1, 'i7'),
+    ('i7', 'i5'): (2, 'i7/i5'),
+    ('i5', 'i7'): (3, 'i5/i7'),
+    ('i5', 'i5'): (4, 'i5/i5')}
+# The substring checks historically report both mixed i7/i5 comparisons as 'i5/i7'
+substring_comparison_labels = {1: 'i7', 2: 'i5/i7', 3: 'i5/i7', 4: 'i5/i5'}
+
+# A clash between two indexes of the same sample (other_sample is None) or of two samples in the same lane.
+# kinds: the clashing indexes, e.g. ('i7', 'i5'); clash_type: 'too similar' or 'substring'
+IndexClash = collections.namedtuple('IndexClash', ['sample', 'other_sample', 'kinds', 'clash_type', 'message'])
+
+
+def get_index_neighbourhood(index):
+    # Two indexes of equal length differ by at most one base if and only if they share at least
+    # one of these keys: the index with one position masked (an empty index only matches itself)
+    if len(index) == 0:
+        return ['']
+    return [index[:i] + '.' + index[i + 1:] for i in range(len(index))]
+
+
+def get_samples_by_lane(samplesheet):
+    # group samples by lane, keeping their position in the samplesheet (used to report in sheet order)
+    lane_samples = collections.defaultdict(list)
+    for position, sample in enumerate(samplesheet):
+        lane_samples[sample.lane].append((position, sample))
+    return lane_samples
+
+
+def get_lane_indexes(lane_samples):
+    # (position, kind, index, sample) for the N-stripped i7 and i5 of all samples, in samplesheet order
+    lane_indexes = list()
+    for position, sample in lane_samples:
+        lane_indexes.append((position, 'i7', sample.index.replace('N', ''), sample))
+        lane_indexes.append((position, 'i5', sample.index2.replace('N', ''), sample))
+    return lane_indexes
+
+
+def findSimilarIndexes(lane_indexes):
+    # Find all pairs of indexes in a lane with at most one mismatch (i7/i5 of the same sample and
+    # i7/i5 across samples) using a hash index over the 1-mismatch neighbourhood of each index.
+    # Returns clashes keyed by (position, other position, comparison), see checkSampleSheetForIndexClashes.
+    neighbourhood_index = collections.defaultdict(list)
+    for entry in lane_indexes:
+        for key in get_index_neighbourhood(entry[2]):
+            neighbourhood_index[key].append(entry)
+
+    clashes = dict()
+    for entries in neighbourhood_index.values():
+        # entries are in samplesheet order (i7 before i5), so the first of a pair is always the earlier sample
+        for i, (position, kind, index, sample) in enumerate(entries):
+            for other_position, other_kind, other_index, sample_other in entries[i + 1:]:
+                if position == other_position:
+                    # i7 and i5 of the same sample (i5 only if there is one)
+                    if len(index) > 0 and len(other_index) > 0:
+                        clashes[(position, -1, 0)] = IndexClash(
+                            sample, None, ('i7', 'i5'), 'too similar',
+                            f"Too similar: i7 and i5 for sample {sample}")
+                elif sample.Sample_ID != sample_other.Sample_ID:
+                    if kind == 'i5' and other_kind == 'i5' and len(index) == 0:
+                        continue  # no i5 to compare
+                    comparison, label = index_comparisons[(kind, other_kind)]
+                    clashes[(position, other_position, comparison)] = IndexClash(
+                        sample, sample_other, (kind, other_kind), 'too similar',
+                        f"Too similar: {label} for samples {sample} and {sample_other}")
+    return clashes
+
+
+def findSubstringIndexes(lane_indexes):
+    # Find all pairs of indexes of different length in a lane where one is contained in the other.
+    # Every substring of every distinct index is looked up in the set of distinct indexes of the lane
+    # (indexes are short, so this is cheap), which yields all containment relations in one pass.
+    # An empty i7 is contained in every other index; empty i5 indexes are never compared.
+    # Returns clashes keyed by (position, other position, comparison), see checkSampleSheetForIndexClashes.
+    entries_by_index = collections.defaultdict(list)
+    for entry in lane_indexes:
+        if len(entry[2]) > 0 or entry[1] == 'i7':
+            entries_by_index[entry[2]].append(entry)
+
+    containers = collections.defaultdict(set)  # index -> longer indexes in the lane that contain it
+    for index in entries_by_index:
+        if len(index) > 0 and '' in entries_by_index:
+            containers[''].add(index)
+        for length in range(1, len(index)):
+            for start in range(len(index) - length + 1):
+                if index[start:start + length] in entries_by_index:
+                    containers[index[start:start + length]].add(index)
+
+    clashes = dict()
+    for index, container_indexes in containers.items():
+        for container_index in container_indexes:
+            for entry in entries_by_index[index]:
+                for other_entry in entries_by_index[container_index]:
+                    # order each pair by samplesheet position
+                    (position, kind, _, sample), (other_position, other_kind, _, sample_other) = \
+                        sorted((entry, other_entry), key=lambda e: (e[0], e[1] == 'i5'))
+                    if position == other_position:
+                        # i5 of a sample contained in its i7
+                        if entry[1] == 'i5':
+                            clashes[(position, -1, 0)] = IndexClash(
+                                sample, None, ('i7', 'i5'), 'substring',
+                                f"Substring: i5 of i7 for sample {sample}")
+                    elif sample.Sample_ID != sample_other.Sample_ID:
+                        comparison, _ = index_comparisons[(kind, other_kind)]
+                        clashes[(position, other_position, comparison)] = IndexClash(
+                            sample, sample_other, (kind, other_kind), 'substring',
+                            f"Substring: {substring_comparison_labels[comparison]} " +
+                            f"for samples {sample} and {sample_other}")
+    return clashes
 
-    remaining_samples = list()
-    for sample in samplesheet:
-        remaining_samples.append(sample)
 
-    for sample in samplesheet:
-        remaining_samples.remove(sample)
-        logger.info(f"Comparing indexes of sample {sample}")
-        sample_i7 = sample.index.replace('N', '')
-        sample_i5 = sample.index2.replace('N', '')
-        # compare i7 to i5 of sample
-        if len(sample_i5) > 0:
-            if len(sample_i7) == len(sample_i5):
-                if str_compare(sample_i7, sample_i5) <= 1:
-                    logger.error(f"Too similar: i7 and i5 for sample {sample}")
-                    has_error = True
-            else:
-                if sample_i5 in sample_i7:
-                    logger.error(f"Substring: i5 of i7 for sample {sample}")
-                    has_error = True
-        else:
-            logger.debug(f"Skipping i5 index of sample {sample}")
-        for sample_other in remaining_samples:
-            logger.info(f"Checking indexes of sample {sample} against {sample_other}")
-            if sample.Sample_ID != sample_other.Sample_ID and sample.lane == sample_other.lane:
-                sample_other_i7 = sample_other.index.replace('N', '')
-                sample_other_i5 = sample_other.index2.replace('N', '')
-                # compare i7 of sample to i7 of other sample
-                if len(sample_i7) == len(sample_other_i7):
-                    if str_compare(sample_i7, sample_other_i7) <= 1:
-                        logger.error(f"Too similar: i7 for samples {sample} and {sample_other}")
-                        has_error = True
-                else:
-                    if sample_other_i7 in sample_i7 or sample_i7 in sample_other_i7:
-                        logger.error(f"Substring: i7 for samples {sample} and {sample_other}")
-                        has_error = True
-                # compare i7 of sample to i5 of other sample
-                if len(sample_i7) == len(sample_other_i5):
-                    if str_compare(sample_i7, sample_other_i5) <= 1:
-                        logger.error(f"Too similar: i7/i5 for samples {sample} and {sample_other}")
-                        has_error = True
-                elif len(sample_other_i5) > 0:
-                    if sample_other_i5 in sample_i7 or sample_i7 in sample_other_i5:
-                        logger.error(f"Substring: i5/i7 for samples {sample} and {sample_other}")
-                        has_error = True
-                else:
-                    logger.info(f"Skipping i5 index of sample {sample_other}")
-                # compare i5 of sample to i7 of other sample
-                if len(sample_i5) == len(sample_other_i7):
-                    if str_compare(sample_i5, sample_other_i7) <= 1:
-                        logger.error(f"Too similar: i5/i7 for samples {sample} and {sample_other}")
-                        has_error = True
-                elif len(sample_i5) > 0:
-                    if sample_i5 in sample_other_i7 or sample_other_i7 in sample_i5:
-                        logger.error(f"Substring: i5/i7 for samples {sample} and {sample_other}")
-                        has_error = True
-                else:
-                    logger.info(f"Skipping i5 index of sample {sample}")
-                # compare i5 of sample to i5 of other sample
-                if len(sample_i5) > 0:
-                    if len(sample_i5) == len(sample_other_i5):
-                        if str_compare(sample_i5, sample_other_i5) <= 1:
-                            logger.error(f"Too similar: i5/i5 for samples {sample} and {sample_other}")
-                            has_error = True
-                    elif len(sample_other_i5) > 0:
-                        if sample_i5 in sample_other_i5 or sample_other_i5 in sample_i5:
-                            logger.error(f"Substring: i5/i5 for samples {sample} and {sample_other}")
-                            has_error = True
-                    else:
-                        logger.info(f"Skipping i5 index of sample {sample_other}")
-                else:
-                    logger.info(f"Skipping i5 index of sample {sample}")
-            else:
-                logger.info(f"Sample sample or different lane")
+def checkSampleSheetForIndexClashes(samplesheet):
+    logger.info("Checking SampleSheet for index clashes")
 
-    return has_error
+    # Only samples in the same lane can clash, so each lane is checked on its own.
+    # Clashes are reported in samplesheet order, i.e. the own i7/i5 of a sample first,
+    # then its i7/i7, i7/i5, i5/i7 and i5/i5 comparisons with later samples
+    clashes = dict()
+    for lane, lane_samples in get_samples_by_lane(samplesheet).items():
+        logger.debug(f"Checking indexes of {len(lane_samples)} samples in lane {lane}")
+        lane_indexes = get_lane_indexes(lane_samples)
+        clashes.update(findSimilarIndexes(lane_indexes))
+        clashes.update(findSubstringIndexes(lane_indexes))
+
+    index_clashes = [clashes[key] for key in sorted(clashes)]
+    for clash in index_clashes:
+        logger.error(clash.message)
+
+    return index_clashes
 
 
 def getSortedSamples(samplesheet):
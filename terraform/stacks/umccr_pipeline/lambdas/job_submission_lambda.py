@@ -32,6 +32,16 @@ def getSSMParam(name):
            )['Parameter']['Value']
 
 
+def getOptionalSSMParam(name):
+    """
+    Fetch the parameter with the given name from SSM Parameter Store, None if it does not exist.
+    """
+    try:
+        return getSSMParam(name)
+    except ssm_client.exceptions.ParameterNotFound:
+        return None
+
+
 # We could use the in-command notation for Parameter Store parameters as explained here:
 # https://docs.aws.amazon.com/systems-manager/latest/userguide/sysman-paramstore-about.html
 #   Example of in-command parameter usage:
@@ -57,6 +67,9 @@ aws_profile = getSSMParam(SSM_PARAM_PREFIX + "aws_profile")
 aws_profile_spartan = getSSMParam(SSM_PARAM_PREFIX + "aws_profile_spartan")
 s3_sync_dest_bucket = getSSMParam(SSM_PARAM_PREFIX + "s3_sync_dest_bucket")
 s3_raw_data_bucket = getSSMParam(SSM_PARAM_PREFIX + "s3_raw_data_bucket")
+# if set, the samplesheet check and LIMS update are run by the (warm) validation service through its client
+validation_client_script = getOptionalSSMParam(SSM_PARAM_PREFIX + "validation_client_script")
+python_command = f"python {validation_client_script}" if validation_client_script else "python"
 
 
 def build_command(script_case, input_data):
@@ -96,7 +109,7 @@ def build_command(script_case, input_data):
         samplesheet_path = os.path.join(runfolder_path, "SampleSheet.csv")
         command += f" conda activate pipeline &&"
         command += f" DEPLOY_ENV={DEPLOY_ENV} AWS_PROFILE={aws_profile}"
-        command += f" python {samplesheet_check_script} {samplesheet_path}"
+        command += f" {python_command} {samplesheet_check_script} {samplesheet_path}"
     elif script_case == "bcl2fastq":
         execution_timneout = '72000'
         command += f" DEPLOY_ENV={DEPLOY_ENV} AWS_PROFILE={aws_profile}"
@@ -127,7 +140,7 @@ def build_command(script_case, input_data):
     elif script_case == "google_lims_update":
         command += f" conda activate pipeline &&"
         command += f" DEPLOY_ENV={DEPLOY_ENV}"
-        command += f" python {lims_update_script} {runfolder}"
+        command += f" {python_command} {lims_update_script} {runfolder}"
     elif script_case == "create_multiqc_reports":
         command += f" conda activate pipeline &&"
         command += f" DEPLOY_ENV={DEPLOY_ENV} AWS_PROFILE={aws_profile}"